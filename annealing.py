@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec 11 10:03:26 2021
+
+@author: rober
+"""
+
+import math
+
+class LinearSchedule:
+    """
+    A temperature that falls in a straight line from start to 0
+    over num_sweeps sweeps, then stays at 0.
+    """
+    def __init__(self, start, num_sweeps):
+        if start < 0 or num_sweeps <= 0:
+            raise ValueError('bad schedule: {}, {}'.format(start, num_sweeps))
+        
+        self.start = start
+        self.num_sweeps = num_sweeps
+    
+    def __call__(self, sweep):
+        return self.start * max(0.0, 1 - sweep / self.num_sweeps)
+
+class ExponentialSchedule:
+    """
+    A temperature that starts at start and is multiplied by rate every
+    sweep, until it falls below end, when it's 0.
+    """
+    def __init__(self, start, rate, end=0.01):
+        if start < 0 or not 0 < rate < 1:
+            raise ValueError('bad schedule: {}, {}'.format(start, rate))
+        
+        self.start = start
+        self.rate = rate
+        self.end = end
+    
+    def __call__(self, sweep):
+        temperature = self.start * self.rate ** sweep
+        if temperature < self.end:
+            return 0.0
+        
+        return temperature
+
+def acceptance_probability(delta, temperature):
+    """
+    Return the Metropolis probability of accepting a change in energy
+    of delta at the given temperature.
+    """
+    if delta <= 0:
+        return 1.0
+    if temperature <= 0:
+        return 0.0
+    
+    return math.exp(-delta / temperature)
+
+class PlateauDetector:
+    """
+    Tells when an energy has stopped going down.
+    
+    update is called with the energy after each sweep, and returns True
+    once patience sweeps have gone by without the lowest energy so far
+    going down by at least min_improvement.
+    """
+    def __init__(self, patience, min_improvement=1):
+        if patience <= 0:
+            raise ValueError('bad patience: {}'.format(patience))
+        
+        self.patience = patience
+        self.min_improvement = min_improvement
+        
+        self.best = None
+        self.num_stale = 0
+    
+    def update(self, energy):
+        if self.best is None or energy <= self.best - self.min_improvement:
+            self.best = energy
+            self.num_stale = 0
+        else:
+            self.num_stale += 1
+        
+        return self.num_stale >= self.patience
\ No newline at end of file
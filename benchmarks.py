@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 24 09:41:05 2021
+
+@author: rober
+"""
+
+import random
+import tempfile
+import time
+
+import numpy as np
+
+import maps
+import tile_sampler
+import board_builder
+import swap_map_builder
+import swap_map_builder_2
+import annealing
+import instruments
+import topology
+import sampler_cache
+import parallel_builder
+import distributed_swap_builder
+import regions
+from indexed_set import IndexedSet
+
+def time_it(name, func, repeats=3):
+    """
+    Run func repeats times and print the best time.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    
+    print('{}: {:.4f} s'.format(name, best))
+    return best
+
+def get_sampler():
+    terrains = ('P', 'F', 'W')
+    tiles = tile_sampler.get_all_tiles(terrains)
+    
+    return tile_sampler.get_uniform_sampler(tiles)
+
+def map_builder_bench(num_tiles=20000):
+    """
+    The MapBuilder.add_tile loop, as in weighted_builder().
+    """
+    sampler = get_sampler()
+    
+    def run():
+        random.seed(0)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = board_builder.MapBuilder(tile_map, sampler)
+        
+        for _ in range(num_tiles):
+            builder.add_tile()
+    
+    return time_it('MapBuilder.add_tile x {}'.format(num_tiles), run)
+
+def desc_from_tile_bench(num_tiles=20000):
+    """
+    desc_from_tile over every description template.
+    """
+    sampler = get_sampler()
+    random.seed(0)
+    tiles = [sampler.random_tile() for _ in range(num_tiles)]
+    
+    def run():
+        for tile in tiles:
+            for adj_num in (4, 3, 2, 1):
+                for template in board_builder.DESC_FROM_NUM[adj_num]:
+                    board_builder.desc_from_tile(tile, template)
+    
+    return time_it('desc_from_tile x {}'.format(num_tiles * 15), run)
+
+def get_needed_tile_bench(half_diag=100):
+    """
+    SwapMapBuilder.get_needed_tile over the interior of a diamond.
+    """
+    random.seed(0)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    
+    builder = swap_map_builder.SwapMapBuilder(half_diag=half_diag,
+                                              tile_map=tile_map,
+                                              stop_amount=None,
+                                              border_sampler=border_sampler,
+                                              interior_sampler=get_sampler())
+    builder.make_border()
+    builder.sample_inner_tiles()
+    
+    def run():
+        for coords in builder.inner_coords:
+            builder.get_needed_tile(coords)
+    
+    return time_it('get_needed_tile x {}'.format(len(builder.inner_coords)),
+                   run)
+
+def get_square_coords(half_size):
+    """
+    Return the coordinates of a square around (0, 0).
+    """
+    return [(x, y)
+            for x in range(-half_size, half_size)
+            for y in range(-half_size, half_size)]
+
+def get_strip_coords(half_size):
+    """
+    Return the coordinates of a tall, thin strip through (0, 0),
+    like a long tendril. It reaches past |y| = 65536.
+    """
+    return [(x, y)
+            for x in range(-4, 4)
+            for y in range(-half_size, half_size)]
+
+def coord_lookup_bench(num_lookups=10**5):
+    """
+    Dict lookups with fresh CoordPairs, as in TileMap.fits,
+    for maps growing in all four quadrants.
+    """
+    shapes = [(get_square_coords, (50, 160, 500)),
+              (get_strip_coords, (1000, 10000, 100000))]
+    
+    for get_coords, half_sizes in shapes:
+        for half_size in half_sizes:
+            coords_list = get_coords(half_size)
+            tiles = {maps.CoordPair(x, y): None for x, y in coords_list}
+            num_hashes = len({hash(coords) for coords in tiles})
+            
+            random.seed(0)
+            queries = random.choices(coords_list, k=num_lookups)
+            
+            def run():
+                for x, y in queries:
+                    tiles[maps.CoordPair(x, y)]
+            
+            name = '{}, {} tiles'.format(get_coords.__name__, len(tiles))
+            best = time_it(name, run)
+            print('    {:.0f} ns per lookup, {} colliding hashes'
+                  .format(best / num_lookups * 1e9, len(tiles) - num_hashes))
+
+def in_direction_bench(width=300, height=300):
+    """
+    TileMap.in_direction for every cell and direction of a torus,
+    with a displacement function and with a topology.
+    """
+    disp_functions = [('get_torus_disp', maps.get_torus_disp(width, height)),
+                      ('Topology', topology.get_torus_topology(width, height))]
+    
+    coords_list = [maps.CoordPair(x, y)
+                   for x in range(width)
+                   for y in range(height)]
+    
+    for name, disp_function in disp_functions:
+        tile_map = maps.TileMap(disp_function)
+        
+        def run():
+            for coords in coords_list:
+                for direction in maps.DIRECTIONS:
+                    tile_map.in_direction(coords, direction)
+        
+        time_it('in_direction x {}, {}'.format(len(coords_list) * 4, name),
+                run)
+    
+    #All the neighbours of every cell at once
+    torus = topology.get_torus_topology(width, height)
+    indices = np.arange(torus.num_cells)
+    
+    time_it('neighbours_of x {}'.format(torus.num_cells * 4),
+            lambda: torus.neighbours_of(indices))
+
+def get_terrain_weights(terrains):
+    segment_weights = tile_sampler.SegmentWeights([1, 1, 1, 3])
+    
+    terrain_weights = dict()
+    for i, terrain in enumerate(terrains):
+        terrain_weights[terrain] = tile_sampler.TerrainWeight(terrain,
+                                                              1 + i / 10,
+                                                              [0.5, 1, 1, 2])
+    
+    return segment_weights, terrain_weights
+
+def weighted_sampler_bench():
+    """
+    get_weighted_sampler for growing numbers of terrains,
+    and the per-tile get_weights for comparison.
+    """
+    for num_terrains in (3, 10, 20):
+        terrains = ['T{}'.format(i) for i in range(num_terrains)]
+        segment_weights, terrain_weights = get_terrain_weights(terrains)
+        
+        time_it('get_weighted_sampler, {} terrains'.format(num_terrains),
+                lambda: tile_sampler.get_weighted_sampler(segment_weights,
+                                                          terrain_weights))
+        
+        if num_terrains > 10:
+            continue
+        
+        tiles = tile_sampler.get_all_tiles(terrains)
+        
+        time_it('get_weights, {} terrains'.format(num_terrains),
+                lambda: tile_sampler.get_weights(tiles,
+                                                 terrains,
+                                                 segment_weights,
+                                                 terrain_weights),
+                repeats=1)
+
+def sampler_cache_bench():
+    """
+    Making a weighted sampler, against loading it from the cache.
+    """
+    for num_terrains in (3, 10, 20):
+        terrains = ['T{}'.format(i) for i in range(num_terrains)]
+        segment_weights, terrain_weights = get_terrain_weights(terrains)
+        
+        with tempfile.TemporaryDirectory() as cache_dir:
+            sampler_cache.get_weighted_sampler(segment_weights,
+                                               terrain_weights,
+                                               cache_dir)
+            
+            time_it('cached sampler, {} terrains'.format(num_terrains),
+                    lambda: sampler_cache.get_weighted_sampler(segment_weights,
+                                                               terrain_weights,
+                                                               cache_dir))
+
+def bucket_choice_bench(num_steps=2000):
+    """
+    One builder step on a bucket of coords: pick random coords,
+    then move them out and back in, for growing bucket sizes.
+    A set has to be copied to a list for the pick, an IndexedSet doesn't.
+    """
+    for size in (10, 1000, 100000):
+        coords_list = [maps.CoordPair(x, 0) for x in range(size)]
+        
+        for bucket in (set(coords_list), IndexedSet(coords_list)):
+            if isinstance(bucket, IndexedSet):
+                choose = bucket.choice
+            else:
+                choose = lambda: random.choice(list(bucket))
+            
+            def run():
+                for _ in range(num_steps):
+                    coords = choose()
+                    bucket.remove(coords)
+                    bucket.add(coords)
+            
+            random.seed(0)
+            name = '{}, {} coords'.format(type(bucket).__name__, size)
+            best = time_it(name, run, repeats=1)
+            print('    {:.2f} us per step'.format(best / num_steps * 1e6))
+
+def parallel_builder_bench(size=300, region_size=75):
+    """
+    grow_regions with one process and with several.
+    """
+    segment_weights, terrain_weights = get_terrain_weights(('P', 'F', 'W'))
+    sampler = tile_sampler.get_weighted_sampler(segment_weights,
+                                                terrain_weights)
+    
+    for num_workers in (1, 2, 4):
+        time_it('grow_regions, {} tiles, {} workers'
+                .format(size * size, num_workers),
+                lambda: parallel_builder.grow_regions(sampler, size, size,
+                                                      region_size, 0,
+                                                      num_workers),
+                repeats=1)
+
+def distributed_swap_bench(size=424, block_size=106):
+    """
+    DistributedSwapMapBuilder with one process and with several,
+    on about as many cells as a half_diag=300 diamond.
+    """
+    sampler = get_sampler()
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    region = regions.get_rectangle_region(size, size)
+    
+    for num_workers in (1, 2, 4):
+        def run():
+            random.seed(0)
+            tile_map = maps.TileMap(maps.boundless_disp)
+            builder = distributed_swap_builder.DistributedSwapMapBuilder(
+                region, tile_map, border_sampler, sampler, block_size,
+                num_workers)
+            builder.make_map()
+        
+        time_it('DistributedSwapMapBuilder, {} cells, {} workers'
+                .format(size * size, num_workers), run, repeats=1)
+
+def stoch_swap_bench(half_diag=50, num_swaps=200000):
+    """
+    StochSwapMapBuilder.do_random_swap on a fresh board.
+    """
+    sampler = get_sampler()
+    
+    random.seed(0)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder_2.StochSwapMapBuilder(half_diag, tile_map,
+                                                     sampler, None)
+    
+    def run():
+        for _ in range(num_swaps):
+            builder.do_random_swap()
+    
+    best = time_it('do_random_swap x {}'.format(num_swaps), run, repeats=1)
+    print('    {:.2f} us per swap'.format(best / num_swaps * 1e6))
+
+def annealing_bench(half_diag=30, num_swaps=10**6):
+    """
+    StochSwapMapBuilder.do_sweeps, greedy and annealed, with the
+    swaps used and the mismatched edges left.
+    """
+    segment_weights, terrain_weights = get_terrain_weights(('P', 'F', 'W'))
+    sampler = tile_sampler.get_weighted_sampler(segment_weights,
+                                                terrain_weights)
+    
+    schedules = {'greedy': None,
+                 'exponential': annealing.ExponentialSchedule(1.0, 0.98,
+                                                              0.05),
+                 'linear': annealing.LinearSchedule(1.0, 200)}
+    
+    for name, schedule in schedules.items():
+        random.seed(0)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        log = instruments.EventLog()
+        builder = swap_map_builder_2.StochSwapMapBuilder(half_diag, tile_map,
+                                                         sampler, None,
+                                                         observer=log)
+        
+        time_it('do_sweeps, {}'.format(name),
+                lambda: builder.do_sweeps(num_swaps, schedule, patience=20),
+                repeats=1)
+        
+        sweeps = [data for event, data in log.events if event == 'sweep']
+        print('    {} swaps, {} mismatched edges'
+              .format(sweeps[-1]['swaps'], builder.mismatches.count))
+
+def batched_stoch_swap_bench(half_diag=50, num_swaps=10**6):
+    """
+    StochSwapMapBuilder.do_sweeps one swap at a time and in exact and
+    inexact batches, greedy and annealed, with the swaps proposed
+    a second and how many times faster than one at a time that is.
+    
+    Every mode starts from the same board with the same budget, so they
+    go through the same phases. Only exact batches are the same chain
+    as swapping one at a time.
+    """
+    segment_weights, terrain_weights = get_terrain_weights(('P', 'F', 'W'))
+    sampler = tile_sampler.get_weighted_sampler(segment_weights,
+                                                terrain_weights)
+    
+    schedules = {'greedy': None,
+                 'exponential': annealing.ExponentialSchedule(1.0, 0.98,
+                                                              0.05)}
+    
+    modes = {'serial': (False, True),
+             'exact batches': (True, True),
+             'inexact batches': (True, False)}
+    
+    for name, schedule in schedules.items():
+        serial_rate = None
+        for mode, (batched, exact) in modes.items():
+            random.seed(0)
+            tile_map = maps.TileMap(maps.boundless_disp)
+            log = instruments.EventLog()
+            builder = swap_map_builder_2.StochSwapMapBuilder(half_diag,
+                                                             tile_map,
+                                                             sampler, None,
+                                                             observer=log)
+            
+            best = time_it('do_sweeps, {}, {}'.format(name, mode),
+                           lambda: builder.do_sweeps(num_swaps, schedule,
+                                                     batched=batched,
+                                                     exact=exact),
+                           repeats=1)
+            
+            sweeps = [data for event, data in log.events
+                      if event == 'sweep']
+            rate = sweeps[-1]['swaps'] / best
+            if serial_rate is None:
+                serial_rate = rate
+            
+            print('    {:.0f} swaps a second ({:.1f}x), {} mismatched edges'
+                  .format(rate, rate / serial_rate,
+                          builder.mismatches.count))
+
+def targeted_swap_bench(num_swaps=50000):
+    """
+    Uniform and targeted swaps from a board where uniform swaps have
+    stalled, for two board sizes, with the mismatched edges removed.
+    """
+    segment_weights, terrain_weights = get_terrain_weights(('P', 'F', 'W'))
+    sampler = tile_sampler.get_weighted_sampler(segment_weights,
+                                                terrain_weights)
+    
+    for half_diag in (25, 50):
+        random.seed(0)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = swap_map_builder_2.StochSwapMapBuilder(half_diag, tile_map,
+                                                         sampler, None)
+        builder.do_sweeps(10**7, patience=5, batched=True)
+        start = list(builder.mismatches.packed)
+        
+        for targeted in (False, True):
+            random.seed(1)
+            builder.set_board(start)
+            before = builder.mismatches.count
+            
+            time_it('do_swaps x {}, half_diag {}, targeted {}'
+                    .format(num_swaps, half_diag, targeted),
+                    lambda: builder.do_swaps(num_swaps, targeted=targeted),
+                    repeats=1)
+            print('    {} -> {} mismatched edges'
+                  .format(before, builder.mismatches.count))
+
+def batched_swapping_bench(half_diag=300):
+    """
+    One swapping iteration on a fresh board, one cell at a time and
+    a checkerboard colour at a time.
+    """
+    sampler = get_sampler()
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    
+    def get_builder():
+        random.seed(0)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = swap_map_builder.SwapMapBuilder(half_diag, tile_map, None,
+                                                  border_sampler, sampler)
+        builder.make_border()
+        builder.sample_inner_tiles()
+        
+        return builder
+    
+    builder = get_builder()
+    time_it('do_swapping_iteration, {} cells'.format(half_diag ** 2),
+            builder.do_swapping_iteration, repeats=1)
+    print('    {} mismatched edges left'.format(builder.mismatches.count))
+    
+    builder = get_builder()
+    packed, eligible = builder.get_board_arrays()
+    rng = np.random.default_rng(0)
+    time_it('do_batched_iteration, {} cells'.format(half_diag ** 2),
+            lambda: builder.do_batched_iteration(packed, eligible, rng),
+            repeats=1)
+    builder.set_board_arrays(packed, eligible)
+    print('    {} mismatched edges left'.format(builder.mismatches.count))
+
+def region_setup_bench(half_diag=300):
+    """
+    SwapMapBuilder.make_border, the first time for a diamond
+    and once its region has been made.
+    """
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    
+    def run():
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = swap_map_builder.SwapMapBuilder(half_diag, tile_map, None,
+                                                  border_sampler,
+                                                  border_sampler)
+        builder.make_border()
+    
+    regions.clear_regions()
+    time_it('make_border, new region', run, repeats=1)
+    time_it('make_border, cached region', run)
+
+def matching_builder_bench(num_tiles=20000):
+    """
+    MapBuilder.add_tile, which draws a tile and then looks for a place,
+    against add_matching_tile, which picks a place and then draws a tile.
+    """
+    segment_weights, terrain_weights = get_terrain_weights(('P', 'F', 'W'))
+    sampler = tile_sampler.get_weighted_sampler(segment_weights,
+                                                terrain_weights)
+    
+    for method_name in ('add_tile', 'add_matching_tile'):
+        def run():
+            random.seed(0)
+            tile_map = maps.TileMap(maps.boundless_disp)
+            builder = board_builder.MapBuilder(tile_map, sampler)
+            add = getattr(builder, method_name)
+            
+            for _ in range(num_tiles):
+                add()
+            
+            print('    {} tiles placed'.format(len(tile_map.tiles)))
+        
+        time_it('MapBuilder.{} x {}'.format(method_name, num_tiles), run,
+                repeats=1)
+    
+    #Single draws for descriptions with one to four sections known
+    descs = [maps.Tile('P', None, None, None),
+             maps.Tile('P', 'F', None, None),
+             maps.Tile('P', 'F', 'W', None),
+             maps.Tile('P', 'F', 'W', 'W')]
+    
+    def run():
+        for desc in descs:
+            for _ in range(num_tiles):
+                sampler.sample_matching(desc)
+    
+    time_it('sample_matching x {}'.format(num_tiles * len(descs)), run)
+
+def main():
+    map_builder_bench()
+    desc_from_tile_bench()
+    get_needed_tile_bench()
+    coord_lookup_bench()
+    in_direction_bench()
+    weighted_sampler_bench()
+    sampler_cache_bench()
+    bucket_choice_bench()
+    matching_builder_bench()
+    parallel_builder_bench()
+    batched_swapping_bench()
+    region_setup_bench()
+    distributed_swap_bench()
+    stoch_swap_bench()
+    annealing_bench()
+    batched_stoch_swap_bench()
+    targeted_swap_bench()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -7,13 +7,24 @@ Created on Sat Oct 16 10:38:22 2021
 
 import itertools
 import random
+import time
 
 import maps
+import instruments
+from indexed_set import IndexedSet
+
+NONE_DESC = maps.Tile(None, None, None, None)
 
 class CoordsFromAdjacencies:
     """
     For a description of the terrains adjacent to a tile,
     return all coordinates matching that description.
+    
+    The coords are kept in buckets keyed by the packed form of their
+    description. Unknown sections are 0 in the packed form, so the key
+    says both which sections are known and what they are.
+    The buckets are IndexedSets, so random coords can be picked from
+    them in constant time. Empty buckets are removed.
     """
     
     def __init__(self, tile_map):
@@ -23,10 +34,18 @@ class CoordsFromAdjacencies:
         self.adjacencies_from_coords = dict()
     
     def add_coords_to_description(self, coords, desc):
-        if not desc in self.coords_from_adjacencies:
-            self.coords_from_adjacencies[desc] = {coords}
+        bucket = self.coords_from_adjacencies.get(desc.packed)
+        if bucket is None:
+            self.coords_from_adjacencies[desc.packed] = IndexedSet((coords,))
         else:
-            self.coords_from_adjacencies[desc].add(coords)
+            bucket.add(coords)
+    
+    def remove_coords_from_description(self, coords, desc):
+        bucket = self.coords_from_adjacencies[desc.packed]
+        bucket.remove(coords)
+        
+        if not bucket:
+            del self.coords_from_adjacencies[desc.packed]
     
     def set_description(self, coords, desc):
         """
@@ -37,7 +56,7 @@ class CoordsFromAdjacencies:
         #so I need to 
         if coords in self.adjacencies_from_coords:
             prev_desc = self.adjacencies_from_coords[coords]
-            self.coords_from_adjacencies[prev_desc].remove(coords)
+            self.remove_coords_from_description(coords, prev_desc)
         
         self.adjacencies_from_coords[coords] = desc
         self.add_coords_to_description(coords, desc)
@@ -53,7 +72,7 @@ class CoordsFromAdjacencies:
         self.taken_coords.add(coords)
         if coords in self.adjacencies_from_coords:
             curr_desc = self.adjacencies_from_coords[coords]
-            self.coords_from_adjacencies[curr_desc].remove(coords)
+            self.remove_coords_from_description(coords, curr_desc)
             del self.adjacencies_from_coords[coords]
         
         #Update adjacencies for adjacent coords
@@ -61,22 +80,67 @@ class CoordsFromAdjacencies:
             adj_coords = self.tile_map.in_direction(coords, direction)
             
             #These coords already have a tile, so they aren't available
-            if adj_coords in self.taken_coords:
+            #(or they're off the board)
+            if adj_coords is None or adj_coords in self.taken_coords:
                 continue
             
             #Get the previous description of these coords
-            none_desc = maps.Tile(None, None, None, None)
-            prev_desc = self.adjacencies_from_coords.get(adj_coords, none_desc)
+            prev_desc = self.adjacencies_from_coords.get(adj_coords, NONE_DESC)
             
             #Add the new information to the description
-            desc = prev_desc.copy()
             terrain = tile.sections[direction]
-            desc.sections[maps.OPPOSITES[direction]] = terrain
+            desc = prev_desc.with_section(maps.OPPOSITES[direction], terrain)
             
             self.set_description(adj_coords, desc)
     
     def get_coords(self, desc):
-        return self.coords_from_adjacencies.get(desc, set())
+        return self.coords_from_adjacencies.get(desc.packed, set())
+    
+    def get_candidates(self, tile):
+        """
+        Return the buckets of coords the tile would fit in,
+        grouped by how many tiles are adjacent, most first.
+        
+        Every coords has one description, so the buckets never overlap.
+        """
+        buckets = self.coords_from_adjacencies
+        
+        groups = list()
+        for keys in tile_keys(tile):
+            group = [buckets[key] for key in keys if key in buckets]
+            groups.append(group)
+        
+        return groups
+    
+    def random_coords(self, favor_adj=True):
+        """
+        Return random untaken coords next to a tile, and their description,
+        or None if there are none.
+        If favor_adj, only coords with the most tiles adjacent are picked.
+        """
+        #Gather the descriptions with coords, with how many sections
+        #they mention
+        candidates = list()
+        for key, coords_set in self.coords_from_adjacencies.items():
+            desc = maps.Tile.from_packed(key)
+            num_known = sum(code != maps.WILDCARD for code in desc.codes)
+            candidates.append((num_known, desc, coords_set))
+        
+        if not candidates:
+            return None
+        
+        if favor_adj:
+            most_known = max(num_known for num_known, _, _ in candidates)
+            candidates = [candidate for candidate in candidates
+                          if candidate[0] == most_known]
+        
+        #Pick a description by how many coords it has,
+        #so all the coords are equally likely
+        _, desc, coords_set = random.choices(candidates,
+                                             [len(candidate[2])
+                                              for candidate in candidates])[0]
+        
+        return coords_set.choice(), desc
 
 # Initialize the list of all descriptions to get from a tile
 # each description mentions a certain subset of the sections of a tile
@@ -96,32 +160,109 @@ for desc in DESCRIPTIONS:
     num = sum(desc)
     DESC_FROM_NUM[num].append(desc)
 
+def get_desc_mask(desc_sections):
+    """
+    Return the mask keeping the packed sections mentioned by a description.
+    """
+    mask = 0
+    for direction, mentioned in zip(maps.DIRECTIONS, desc_sections):
+        if mentioned:
+            mask |= maps.TERRAIN_MASK << maps.SECTION_SHIFTS[direction]
+    
+    return mask
+
+DESC_MASKS = {desc: get_desc_mask(desc) for desc in DESCRIPTIONS}
+
 def desc_from_tile(tile, desc_sections):
-    desc = tile.copy()
+    return maps.Tile.from_packed(tile.packed & DESC_MASKS[desc_sections])
+
+#The masks of the descriptions with 4, 3, 2 and 1 sections
+MASKS_FROM_NUM = [[DESC_MASKS[desc] for desc in DESC_FROM_NUM[num]]
+                  for num in (4, 3, 2, 1)]
+
+#The description keys of each tile that's been placed, by packed form
+KEYS_FROM_PACKED = dict()
+
+def tile_keys(tile):
+    """
+    Return the packed descriptions the tile fits,
+    grouped by how many sections they mention, most first.
+    """
+    keys = KEYS_FROM_PACKED.get(tile.packed)
+    if keys is None:
+        keys = tuple(tuple(tile.packed & mask for mask in masks)
+                     for masks in MASKS_FROM_NUM)
+        KEYS_FROM_PACKED[tile.packed] = keys
     
-    if not desc_sections[0]:
-        desc.sections[maps.Direction.RIGHT] = None
-        
-    if not desc_sections[1]:
-        desc.sections[maps.Direction.UP] = None
-        
-    if not desc_sections[2]:
-        desc.sections[maps.Direction.LEFT] = None
+    return keys
+
+def random_coords_from(buckets):
+    """
+    Return random coords from a list of buckets that don't overlap,
+    with all the coords equally likely.
+    """
+    if len(buckets) == 1:
+        bucket = buckets[0]
+    else:
+        bucket = random.choices(buckets,
+                                [len(bucket) for bucket in buckets])[0]
+    
+    return bucket.choice()
+
+class GrowthStats:
+    """
+    What happened during a call to MapBuilder.grow.
+    
+    frontier_sizes is a list of (tiles placed, frontier size) pairs,
+    taken at the start, at every progress report and at the end.
+    stalled says whether it stopped because too many draws in a row
+    were rejected.
+    """
+    def __init__(self):
+        self.tiles_placed = 0
+        self.rejected_draws = 0
+        self.stalled = False
+        self.frontier_sizes = list()
+        self.seconds = 0.0
+    
+    @property
+    def draws(self):
+        return self.tiles_placed + self.rejected_draws
+    
+    @property
+    def tiles_per_second(self):
+        if not self.seconds:
+            return 0.0
         
-    if not desc_sections[3]:
-        desc.sections[maps.Direction.DOWN] = None
+        return self.tiles_placed / self.seconds
     
-    return desc
+    def __str__(self):
+        return ('{} tiles placed, {} draws rejected, frontier {}, '
+                '{:.0f} tiles per second{}'
+                .format(self.tiles_placed,
+                        self.rejected_draws,
+                        self.frontier_sizes[-1][1]
+                        if self.frontier_sizes else 0,
+                        self.tiles_per_second,
+                        ', stalled' if self.stalled else ''))
 
 class MapBuilder:
-    def __init__(self, tile_map, tile_sampler, favor_adj=True):
+    def __init__(self, tile_map, tile_sampler, favor_adj=True,
+                 start_coords=None, observer=None):
         self.tile_map = tile_map
         self.tile_sampler = tile_sampler
         self.coords_from_adjacencies = CoordsFromAdjacencies(self.tile_map)
         self.favor_adj = favor_adj
         
+        #Where the first tile goes
+        if start_coords is None:
+            start_coords = maps.CoordPair(0, 0)
+        self.start_coords = start_coords
+        
         self.empty = True
         
+        self.instruments = instruments.Instruments('MapBuilder', observer)
+        
     def add_tile(self):
         """
         Add a randomly selected tile in a suitable location.
@@ -134,7 +275,7 @@ class MapBuilder:
         if self.empty:
             self.empty = False
             
-            coords = maps.CoordPair(0, 0)
+            coords = self.start_coords
             
             self.tile_map.add_tile(coords, tile)
             self.coords_from_adjacencies.add_tile(coords, tile)
@@ -144,39 +285,143 @@ class MapBuilder:
         
         # look for places to put the tile, starting with places
         # that have more tiles adjacent
-        possible_coords = set()
-        for adj_num in (4, 3, 2, 1):
-            for adj_desc_template in DESC_FROM_NUM[adj_num]:
-                adj_desc = desc_from_tile(tile, adj_desc_template)
+        groups = self.coords_from_adjacencies.get_candidates(tile)
+        
+        #If we're favoring adjacency, use the places with the most tiles
+        #adjacent, otherwise, use all the places
+        if self.favor_adj:
+            buckets = next((group for group in groups if group), None)
+        else:
+            buckets = [bucket for group in groups for bucket in group]
+        
+        if not buckets:
+            return False
+        
+        coords = random_coords_from(buckets)
+        
+        self.tile_map.add_tile(coords, tile)
+        self.coords_from_adjacencies.add_tile(coords, tile)
+        
+        return coords
+    
+    def add_matching_tile(self):
+        """
+        Pick a place for a tile first, then draw a tile that fits there
+        from the sampler's distribution.
+        Favors locations that have more tiles adjacent.
+        """
+        if self.empty:
+            return self.add_tile()
+        
+        picked = self.coords_from_adjacencies.random_coords(self.favor_adj)
+        if picked is None:
+            return False
+        
+        coords, desc = picked
+        
+        #None if the sampler has no tile for this place
+        tile = self.tile_sampler.sample_matching(desc)
+        if tile is None:
+            return False
+        
+        self.tile_map.add_tile(coords, tile)
+        self.coords_from_adjacencies.add_tile(coords, tile)
+        
+        return coords
+    
+    def frontier_size(self):
+        """
+        Return the number of untaken coords next to a tile.
+        """
+        return len(self.coords_from_adjacencies.adjacencies_from_coords)
+    
+    def grow(self,
+             num_tiles=None,
+             max_seconds=None,
+             max_draws=None,
+             progress=None,
+             progress_every=10000,
+             matching=False,
+             max_rejections=1000):
+        """
+        Place tiles until num_tiles have been placed, max_seconds have
+        passed or max_draws tiles have been drawn, whichever comes first.
+        Stops early if there's nowhere left to put a tile, or after
+        max_rejections draws in a row are rejected, which happens when
+        the sampler has nothing that fits. max_rejections can be None
+        to keep drawing.
+        
+        progress is called with the GrowthStats every progress_every
+        tiles placed, and a progress event goes to the instruments.
+        progress_every can be 0 or None for no progress at all.
+        If matching, places are picked first, with add_matching_tile.
+        
+        Returns the GrowthStats.
+        """
+        if num_tiles is None and max_seconds is None and max_draws is None:
+            raise ValueError('no budget given')
+        
+        if progress_every is not None and progress_every < 0:
+            raise ValueError('progress_every: {}'.format(progress_every))
+        
+        place = self.add_matching_tile if matching else self.add_tile
+        
+        stats = GrowthStats()
+        stats.frontier_sizes.append((0, self.frontier_size()))
+        
+        start = time.perf_counter()
+        deadline = None if max_seconds is None else start + max_seconds
+        
+        num_rejections = 0
+        while True:
+            if num_tiles is not None and stats.tiles_placed >= num_tiles:
+                break
+            if max_draws is not None and stats.draws >= max_draws:
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            
+            #Nowhere left to put a tile
+            if not self.empty and not self.frontier_size():
+                break
+            
+            if not place():
+                stats.rejected_draws += 1
+                num_rejections += 1
                 
-                matching = self.coords_from_adjacencies.get_coords(adj_desc)
+                if max_rejections is not None\
+                        and num_rejections >= max_rejections:
+                    stats.stalled = True
+                    self.instruments.emit('stalled',
+                                          tiles_placed=stats.tiles_placed,
+                                          rejected_draws=num_rejections)
+                    break
                 
-                for coords in matching:
-                    possible_coords.add(coords)
-            
-            #If there aren't any possibilities, continue
-            if not possible_coords:
                 continue
             
-            #If we're favoring adjacency, put the tile in now
-            #otherwise, put it in after we've checked all possibilities
-            if self.favor_adj:
-                possible_coords = list(possible_coords)
-                coords = random.choice(possible_coords)
+            num_rejections = 0
+            stats.tiles_placed += 1
+            
+            if progress_every and stats.tiles_placed % progress_every == 0:
+                stats.seconds = time.perf_counter() - start
+                stats.frontier_sizes.append((stats.tiles_placed,
+                                             self.frontier_size()))
                 
-                self.tile_map.add_tile(coords, tile)
-                self.coords_from_adjacencies.add_tile(coords, tile)
+                self.instruments.emit('progress',
+                                      tiles_placed=stats.tiles_placed,
+                                      rejected_draws=stats.rejected_draws,
+                                      frontier=stats.frontier_sizes[-1][1])
                 
-                return coords
+                if progress is not None:
+                    progress(stats)
         
-        #If we aren't favoring adjacency, do the selection now
-        if not self.favor_adj:
-            if possible_coords:
-                possible_coords = list(possible_coords)
-                coords = random.choice(possible_coords)
-                
-                self.tile_map.add_tile(coords, tile)
-                self.coords_from_adjacencies.add_tile(coords, tile)
-                
-                return coords
-        return False
\ No newline at end of file
+        stats.seconds = time.perf_counter() - start
+        if stats.frontier_sizes[-1][0] != stats.tiles_placed:
+            stats.frontier_sizes.append((stats.tiles_placed,
+                                         self.frontier_size()))
+        
+        self.instruments.add_phase('grow', stats.seconds)
+        self.instruments.count('tiles_placed', stats.tiles_placed)
+        self.instruments.count('rejected_draws', stats.rejected_draws)
+        
+        return stats
\ No newline at end of file
@@ -5,7 +5,18 @@ Created on Sat Oct 16 11:13:47 2021
 @author: rober
 """
 
+import atexit
+import json
 import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+
+import numpy as np
 
 from IPython.display import display
 
@@ -15,6 +26,19 @@ import board_builder
 import swap_map_builder
 import swap_map_builder_2
 import display_map
+import dense_maps
+import sampler_cache
+import topology
+import parallel_builder
+import distributed_swap_builder
+import regions
+import instruments
+import annealing
+
+#Samplers made by the tests are cached here, rather than in the cache
+#in the user's home directory
+TEST_CACHE_DIR = tempfile.mkdtemp(prefix='mapgen_test_samplers_')
+atexit.register(shutil.rmtree, TEST_CACHE_DIR, True)
 
 def adjacency_test():
     #Get a boundless map
@@ -43,7 +67,7 @@ def adjacency_test():
     desc_above = coords_from_adjacencies.adjacencies_from_coords[coords_above]
     assert desc_above == target_desc_above_1
     
-    fit_coords = coords_from_adjacencies.coords_from_adjacencies[desc_above]
+    fit_coords = coords_from_adjacencies.get_coords(desc_above)
     assert fit_coords == {coords_above}
     
     #Now add another tile and see if updating existing descriptions works
@@ -62,13 +86,19 @@ def adjacency_test():
     desc_above = coords_from_adjacencies.adjacencies_from_coords[coords_above]
     assert desc_above == target_desc_above_2
     
-    fit_coords = coords_from_adjacencies.coords_from_adjacencies[desc_above]
+    fit_coords = coords_from_adjacencies.get_coords(desc_above)
     assert fit_coords == {coords_above}
     
     prev_fit = coords_from_adjacencies\
-               .coords_from_adjacencies.get(target_desc_above_1, set())
+               .coords_from_adjacencies.get(target_desc_above_1.packed, set())
     
     assert prev_fit == set()
+    
+    #The candidates for a tile are grouped by how many tiles are adjacent
+    groups = coords_from_adjacencies.get_candidates(maps.Tile(*'FFPF'))
+    assert [len(group) for group in groups] == [0, 0, 1, 1]
+    assert groups[2] == [{coords_above}]
+    assert maps.CoordPair(0, 1) in groups[3][0]
 
 def builder_test():
     # Get a boundless map
@@ -104,6 +134,52 @@ def builder_test():
     
     display(map_image)
 
+def dense_builder_test():
+    # A dense map should come out the same as a dict map
+    # for the same random state
+    terrains = ('P', 'F')
+    tiles = tile_sampler.get_all_tiles(terrains)
+    sampler = tile_sampler.get_uniform_sampler(tiles)
+    
+    tile_map = maps.TileMap(maps.boundless_disp)
+    dense_map = dense_maps.DenseTileMap(maps.boundless_disp)
+    chunked_map = dense_maps.ChunkedTileMap(maps.boundless_disp)
+    
+    for curr_map in (tile_map, dense_map, chunked_map):
+        random.seed(10)
+        builder = board_builder.MapBuilder(curr_map, sampler)
+        
+        for _ in range(2000):
+            builder.add_tile()
+    
+    assert dict(dense_map.tiles.items()) == tile_map.tiles
+    assert dict(chunked_map.tiles.items()) == tile_map.tiles
+    
+    #Both maps display the same way
+    colors_from_terrains = {'P': (239, 222, 103),
+                            'F': (16, 155, 0)}
+    
+    image_1 = display_map.Map(tile_map).get_image(colors_from_terrains, 1)
+    for curr_map in (dense_map, chunked_map):
+        image_2 = display_map.Map(curr_map).get_image(colors_from_terrains, 1)
+        assert image_1.tobytes() == image_2.tobytes()
+    
+    #A chunked map is kept as its chunks, not copied into squares
+    chunked_display = display_map.Map(chunked_map)
+    assert not chunked_display.squares
+    assert len(chunked_display.chunks) == len(chunked_map.chunks) > 1
+    
+    #Tiles in a chunk that don't match are still caught
+    chunked_map = dense_maps.ChunkedTileMap(maps.boundless_disp)
+    chunked_map.store_arrays(np.array([0, 1]), np.array([0, 0]),
+                             np.array([maps.Tile(*'PPPP').packed,
+                                       maps.Tile(*'FFFF').packed]))
+    try:
+        display_map.Map(chunked_map)
+        assert False
+    except ValueError:
+        pass
+
 def get_normal_sampler():
     # Get the weights
     
@@ -126,12 +202,904 @@ def get_normal_sampler():
     water_weights = tile_sampler.TerrainWeight('W', 1.2, [0.1, 0.1, 0.1, 3])
     terrain_weights['W'] = water_weights
     
-    # Get the sampler
-    sampler = tile_sampler.get_weighted_sampler(segment_weights,
-                                                terrain_weights)
+    # Get the sampler, from the tests' cache if it's been made before
+    sampler = sampler_cache.get_weighted_sampler(segment_weights,
+                                                 terrain_weights,
+                                                 TEST_CACHE_DIR)
     
     return sampler
 
+def alias_sampler_test():
+    tiles = [maps.Tile(*'PPPP'), maps.Tile(*'FFFF'), maps.Tile(*'WWWW')]
+    weights = {tiles[0]: 0.5, tiles[1]: 0.001, tiles[2]: 3.2}
+    
+    sampler = tile_sampler.AliasTileSampler(tiles, weights.get)
+    total_weight = sum(weights.values())
+    
+    #Batch draws and single draws both follow the weights
+    num = 200000
+    
+    random.seed(2)
+    batch = sampler.random_tiles(num)
+    singles = [sampler.random_tile() for _ in range(num)]
+    
+    for drawn in (batch, singles):
+        for tile in tiles:
+            target = weights[tile] / total_weight
+            freq = drawn.count(tile) / num
+            assert abs(freq - target) < 0.01
+    
+    #Batch draws are fixed by random.seed
+    random.seed(2)
+    assert sampler.random_tiles(num) == batch
+    
+    #The alias tables give exactly the normal sampler's weights
+    sampler = get_normal_sampler()
+    assert len(sampler.tiles) == 81
+    
+    num_tiles = len(sampler.tiles)
+    probs = sampler.probs.copy()
+    for j in range(num_tiles):
+        probs[sampler.aliases[j]] += 1 - sampler.probs[j]
+    
+    targets = sampler.weights / sampler.weights.sum()
+    assert np.allclose(probs / num_tiles, targets)
+
+def weight_array_test():
+    random.seed(4)
+    terrains = 'ABCDE'
+    
+    segment_weights = tile_sampler.SegmentWeights([random.random() + 0.5
+                                                   for _ in range(4)])
+    terrain_weights = dict()
+    for terrain in terrains:
+        weights = [random.random() + 0.5 for _ in range(4)]
+        if terrain == 'E':
+            weights = None
+        
+        terrain_weights[terrain] = tile_sampler.TerrainWeight(terrain,
+                                                              random.random(),
+                                                              weights)
+    
+    #The catalogue has the same tiles as get_all_tiles,
+    #and the array weights are the same as the per-tile weights
+    catalogue = tile_sampler.TileCatalogue(terrains)
+    tiles = catalogue.get_tiles()
+    assert set(tiles) == tile_sampler.get_all_tiles(terrains)
+    
+    weights = tile_sampler.get_weights(tiles,
+                                       terrains,
+                                       segment_weights,
+                                       terrain_weights)
+    
+    weight_array = tile_sampler.get_weight_array(catalogue,
+                                                 segment_weights,
+                                                 terrain_weights)
+    
+    assert np.allclose(weight_array, [weights[tile] for tile in tiles])
+
+def sampler_cache_test():
+    segment_weights = tile_sampler.SegmentWeights([1, 1, 1, 3])
+    terrain_weights = {'P': tile_sampler.TerrainWeight('P', 1, [1, 1, 1, 2]),
+                       'F': tile_sampler.TerrainWeight('F', 0.5),
+                       'W': tile_sampler.TerrainWeight('W', 1.2,
+                                                       [0.1, 0.1, 0.1, 3])}
+    
+    target = tile_sampler.get_weighted_sampler(segment_weights,
+                                               terrain_weights)
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        #The first call makes the entry, the second loads it
+        for _ in range(2):
+            sampler = sampler_cache.get_weighted_sampler(segment_weights,
+                                                         terrain_weights,
+                                                         cache_dir)
+            
+            assert np.array_equal(sampler.packed, target.packed)
+            assert np.array_equal(sampler.weights, target.weights)
+            assert np.array_equal(sampler.probs, target.probs)
+            assert np.array_equal(sampler.aliases, target.aliases)
+        
+        assert len(os.listdir(cache_dir)) == 1
+        assert isinstance(sampler.weights.base, np.memmap)
+        
+        #Different weights get a different entry
+        terrain_weights['F'] = tile_sampler.TerrainWeight('F', 0.6)
+        sampler_cache.get_weighted_sampler(segment_weights,
+                                           terrain_weights,
+                                           cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+        
+        #So does a new version of the weight code
+        old_version = tile_sampler.WEIGHTS_VERSION
+        tile_sampler.WEIGHTS_VERSION += 1
+        try:
+            sampler_cache.get_weighted_sampler(segment_weights,
+                                               terrain_weights,
+                                               cache_dir)
+        finally:
+            tile_sampler.WEIGHTS_VERSION = old_version
+        
+        assert len(os.listdir(cache_dir)) == 3
+        
+        #And so does a change to the code that makes the tables,
+        #without anyone changing WEIGHTS_VERSION
+        description = sampler_cache.describe_weights(segment_weights,
+                                                     terrain_weights)
+        assert description['code_hash'] == sampler_cache.get_code_hash()
+        
+        functions = list(sampler_cache.ENTRY_FUNCTIONS)
+        functions[-1] = tile_sampler.get_weights
+        assert sampler_cache.get_code_hash(functions)\
+               != sampler_cache.get_code_hash()
+        
+        #A process that gave the terrains other codes
+        #still gets the same tiles from the cache
+        args = pickle.dumps((segment_weights, terrain_weights, cache_dir))
+        script = ('import pickle\n'
+                  'import maps\n'
+                  'import sampler_cache\n'
+                  'maps.Tile("W", "X", "F", "P")\n'
+                  'args = pickle.loads(bytes.fromhex({!r}))\n'
+                  'sampler = sampler_cache.get_weighted_sampler(*args)\n'
+                  'print([str(tile) for tile in sampler.tiles])')
+        
+        output = subprocess.run([sys.executable, '-c',
+                                 script.format(args.hex())],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        
+        sampler = sampler_cache.get_weighted_sampler(segment_weights,
+                                                     terrain_weights,
+                                                     cache_dir)
+        assert output.stdout.strip() == str([str(tile)
+                                             for tile in sampler.tiles])
+
+def sample_matching_test():
+    random.seed(5)
+    sampler = get_normal_sampler()
+    weights = dict(zip(sampler.tiles, sampler.weights.tolist()))
+    
+    desc = maps.Tile('P', None, 'W', None)
+    matching = [tile for tile in sampler.tiles
+                if tile.sections[maps.Direction.RIGHT] == 'P'
+                and tile.sections[maps.Direction.LEFT] == 'W']
+    total_weight = sum(weights[tile] for tile in matching)
+    
+    #Every draw matches, and they follow the restricted weights
+    num = 100000
+    drawn = [sampler.sample_matching(desc) for _ in range(num)]
+    assert set(drawn) <= set(matching)
+    
+    for tile in matching:
+        target = weights[tile] / total_weight
+        freq = drawn.count(tile) / num
+        assert abs(freq - target) < 0.01
+    
+    #A full description only matches itself
+    tile = maps.Tile(*'PFWF')
+    assert sampler.sample_matching(tile) is tile
+    
+    #Tiles with no weight are never drawn
+    tiles = [maps.Tile(*'PPPP'), maps.Tile(*'PPPF'), maps.Tile(*'FFFF')]
+    counts = {tiles[0]: 0, tiles[1]: 3, tiles[2]: 1}
+    count_sampler = tile_sampler.TileSampler(tiles, counts.get)
+    
+    desc = maps.Tile('P', None, None, None)
+    for _ in range(100):
+        assert count_sampler.sample_matching(desc) is tiles[1]
+    
+    assert count_sampler.sample_matching(maps.Tile(*'PPPP')) is None
+    assert count_sampler.sample_matching(maps.Tile('W', None, None, None))\
+           is None
+    
+    one_sampler = tile_sampler.OneTileSampler(tiles[0])
+    assert one_sampler.sample_matching(desc) is tiles[0]
+    assert one_sampler.sample_matching(maps.Tile(None, 'F', None, None))\
+           is None
+    
+    #Building by picking the place first never wastes a draw
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = board_builder.MapBuilder(tile_map, sampler)
+    
+    for _ in range(3000):
+        assert builder.add_matching_tile()
+    
+    assert len(tile_map.tiles) == 3000
+    assert tile_map.find_mismatches().count == 0
+
+def grow_test():
+    terrains = ('P', 'F')
+    tiles = tile_sampler.get_all_tiles(terrains)
+    sampler = tile_sampler.get_uniform_sampler(tiles)
+    
+    #Growing by a number of tiles places that many
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = board_builder.MapBuilder(tile_map, sampler)
+    
+    reports = list()
+    stats = builder.grow(2500, progress=reports.append, progress_every=1000)
+    
+    assert stats.tiles_placed == len(tile_map.tiles) == 2500
+    assert stats.draws == stats.tiles_placed + stats.rejected_draws
+    assert len(reports) == 2
+    assert [placed for placed, _ in stats.frontier_sizes] == [0, 1000,
+                                                             2000, 2500]
+    assert stats.frontier_sizes[-1][1] == builder.frontier_size()
+    assert stats.tiles_per_second > 0
+    
+    #The same builder keeps growing
+    stats = builder.grow(max_draws=100)
+    assert stats.draws == 100
+    assert len(tile_map.tiles) == 2500 + stats.tiles_placed
+    
+    stats = builder.grow(max_seconds=0.05)
+    assert stats.seconds < 1
+    
+    #No progress at all with progress_every 0 or None
+    for progress_every in (0, None):
+        reports = list()
+        stats = builder.grow(100, progress=reports.append,
+                             progress_every=progress_every)
+        assert stats.tiles_placed == 100
+        assert not reports
+        assert [placed for placed, _ in stats.frontier_sizes] == [0, 100]
+    
+    try:
+        builder.grow(100, progress_every=-1)
+        assert False
+    except ValueError:
+        pass
+    
+    #On a finite board, growth stops when the board is full
+    tile_map = maps.TileMap(topology.get_rectangle_topology(10, 10))
+    builder = board_builder.MapBuilder(tile_map, sampler)
+    
+    stats = builder.grow(1000)
+    assert stats.tiles_placed == len(tile_map.tiles) == 100
+    assert builder.frontier_size() == 0
+    
+    try:
+        builder.grow()
+        assert False
+    except ValueError:
+        pass
+    
+    #A sampler with nothing that fits stops after a run of rejections,
+    #rather than drawing forever
+    sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWPP'))
+    tile_map = maps.TileMap(maps.boundless_disp)
+    log = instruments.EventLog()
+    builder = board_builder.MapBuilder(tile_map, sampler, observer=log)
+    
+    stats = builder.grow(num_tiles=2, max_rejections=50)
+    assert stats.stalled
+    assert stats.tiles_placed == 1
+    assert stats.rejected_draws == 50
+    assert 'stalled' in str(stats)
+    assert log.events[-2][0] == 'stalled'
+
+def parallel_builder_test():
+    sampler = get_normal_sampler()
+    
+    random.seed(8)
+    serial_map = parallel_builder.grow_regions(sampler, 50, 40, 16, seed=8)
+    
+    #The caller's random state is left alone
+    assert random.random() == random.Random(8).random()
+    
+    #The map is full, and every edge matches
+    assert serial_map.num_tiles == 50 * 40
+    assert serial_map.find_mismatches().count == 0
+    
+    tile_map = maps.TileMap(maps.boundless_disp)
+    tile_map.tiles.update(serial_map.iter_tiles())
+    for coords, tile in tile_map.tiles.items():
+        assert tile_map.fits(coords, tile)
+    
+    #Worker processes give the same map
+    pool_map = parallel_builder.grow_regions(sampler, 50, 40, 16, seed=8,
+                                             num_workers=2)
+    assert np.array_equal(pool_map.codes, serial_map.codes)
+    
+    #Another seed gives another map
+    other_map = parallel_builder.grow_regions(sampler, 50, 40, 16, seed=9)
+    assert not np.array_equal(other_map.codes, serial_map.codes)
+    
+    #Without matching, the holes a stalled builder leaves are filled
+    loose_map = parallel_builder.grow_regions(sampler, 50, 40, 16, seed=8,
+                                              matching=False)
+    assert loose_map.num_tiles == 50 * 40
+    assert loose_map.find_mismatches().count == 0
+    
+    #A region that can't be filled is an error, not a map with holes
+    stuck_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWPP'))
+    try:
+        parallel_builder.grow_region((0, 0, 4, 4), 0, True, False,
+                                     stuck_sampler)
+        assert False
+    except ValueError:
+        pass
+    
+    #Seams are redrawn to match
+    tile_map = dense_maps.DenseTileMap(maps.boundless_disp)
+    tile_map.add_tiles({maps.CoordPair(0, 0): maps.Tile(*'PPPP'),
+                        maps.CoordPair(2, 0): maps.Tile(*'WWWW')})
+    tile_map.store_arrays(np.array([1]), np.array([0]),
+                          np.array([maps.Tile(*'FFFF').packed]))
+    
+    assert parallel_builder.reconcile_seams(tile_map, sampler) == 2
+    assert tile_map.find_mismatches().count == 0
+    assert tile_map.num_tiles == 3
+    assert tile_map.at(maps.CoordPair(1, 0)).sections[maps.Direction.LEFT]\
+           == 'P'
+
+def distributed_swap_test():
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    sampler = get_normal_sampler()
+    
+    #A rectangle with a hole in it, so some blocks have holes too
+    mask = np.ones((40, 30), dtype=bool)
+    mask[12:20, 8:14] = False
+    region = regions.get_mask_region(mask, -5, 3)
+    
+    #Blocks of a colour never touch
+    blocks = distributed_swap_builder.get_blocks(region, 8)
+    block_cells, bounds, colours = blocks
+    assert sorted(block_cells.tolist()) == region.inner.tolist()
+    
+    board = region.get_topology()
+    block_of = np.full(board.num_cells + 1, -1)
+    for i, (start, stop) in enumerate(bounds):
+        block_of[block_cells[start:stop]] = i
+    
+    for i, (start, stop) in enumerate(bounds):
+        adj = block_of[board.neighbours[block_cells[start:stop]]]
+        adj_colours = [colours[j] for j in set(adj.ravel().tolist())
+                       if j not in (-1, i)]
+        assert colours[i] not in adj_colours
+    
+    builder_class = distributed_swap_builder.DistributedSwapMapBuilder
+    
+    def make_map(num_workers):
+        random.seed(4)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = builder_class(region, tile_map, border_sampler, sampler,
+                                8, num_workers)
+        builder.make_map()
+        
+        return tile_map
+    
+    serial_map = make_map(1)
+    
+    #The map is full, and every edge matches
+    assert set(serial_map.tiles) == set(region)
+    assert serial_map.find_mismatches().count == 0
+    assert all(serial_map.tiles[coords] == maps.Tile(*'WWWW')
+               for coords in region.border_coords)
+    
+    #Worker processes give the same map
+    pool_map = make_map(2)
+    assert pool_map.tiles == serial_map.tiles
+    
+    #With mixed border tiles, the edges along the border are matched
+    #too, and checked before the rounds stop
+    region = regions.get_rectangle_region(30, 30)
+    
+    random.seed(5)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    log = instruments.EventLog()
+    builder = builder_class(region, tile_map, sampler, sampler, 10,
+                            observer=log)
+    builder.make_map()
+    
+    assert set(tile_map.tiles) == set(region)
+    assert tile_map.find_mismatches().count == 0
+    assert [data for event, data in log.events
+            if event == 'round'][-1]['mismatched'] == 0
+    
+    #Freed shared memory stays mapped while views of it are around,
+    #but nothing new can attach to it
+    shared = distributed_swap_builder.SharedArrays({'packed': np.arange(10)})
+    view = shared.arrays['packed'][2:5]
+    shared.close()
+    assert view.tolist() == [2, 3, 4]
+    
+    try:
+        distributed_swap_builder.attach_arrays(shared.specs)
+        assert False
+    except FileNotFoundError:
+        pass
+    
+    del view
+    distributed_swap_builder.close_unused_memories()
+    assert not distributed_swap_builder.LINGERING_MEMORIES
+    
+    #An error in a block comes through the cleanup as it was
+    class FailingSampler:
+        def __init__(self):
+            self.calls = 0
+        
+        def random_packed(self, num):
+            #The first draw is for the initial board
+            self.calls += 1
+            if self.calls > 1:
+                raise RuntimeError('sampler failed')
+            
+            return sampler.random_packed(num)
+    
+    builder = builder_class(region, maps.TileMap(maps.boundless_disp),
+                            sampler, FailingSampler(), 10)
+    try:
+        builder.make_map()
+        assert False
+    except RuntimeError as error:
+        assert str(error) == 'sampler failed'
+    
+    distributed_swap_builder.close_unused_memories()
+    assert not distributed_swap_builder.LINGERING_MEMORIES
+
+def get_needed_from_tiles(tiles_from_coords, tile_map, coords):
+    # Work out the needed tile the slow way, from the neighbours
+    terrains = list()
+    for direction in maps.DIRECTIONS:
+        adj_coords = tile_map.in_direction(coords, direction)
+        adj_tile = tiles_from_coords[adj_coords]
+        terrains.append(adj_tile.sections[maps.OPPOSITES[direction]])
+    
+    return maps.Tile(*terrains)
+
+def swap_needed_test():
+    random.seed(11)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    sampler = get_normal_sampler()
+    
+    builder = swap_map_builder.SwapMapBuilder(half_diag=20,
+                                              tile_map=tile_map,
+                                              stop_amount=None,
+                                              border_sampler=border_sampler,
+                                              interior_sampler=sampler)
+    builder.make_border()
+    builder.sample_inner_tiles()
+    
+    def check_needed():
+        for coords in builder.inner_coords:
+            target = get_needed_from_tiles(builder.tiles_from_coords,
+                                           tile_map,
+                                           coords)
+            assert builder.get_needed_tile(coords) == target
+    
+    def check_mismatches():
+        mismatches = maps.find_mismatches(builder.tiles_from_coords,
+                                          tile_map.disp_function)
+        assert builder.mismatches.count == mismatches.count
+    
+    #The whole-board needed tiles and the mismatch count are right,
+    #and stay right through swaps and resampling
+    check_needed()
+    check_mismatches()
+    
+    builder.do_swapping_iteration()
+    check_needed()
+    check_mismatches()
+    
+    builder.resample_tiles()
+    check_needed()
+    check_mismatches()
+    
+    builder.fill_in_needed_tiles()
+    check_needed()
+    check_mismatches()
+    
+    #A whole map comes out matching
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder.SwapMapBuilder(half_diag=20,
+                                              tile_map=tile_map,
+                                              stop_amount=None,
+                                              border_sampler=border_sampler,
+                                              interior_sampler=sampler)
+    builder.make_map()
+    
+    assert builder.mismatches.count == 0
+    assert tile_map.find_mismatches().count == 0
+    assert len(tile_map.tiles) == len(builder.board.coords_list)
+
+def swap_region_test():
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    sampler = get_normal_sampler()
+    
+    #A rectangle with a hole in it
+    mask = np.ones((15, 10), dtype=bool)
+    mask[6:9, 3:6] = False
+    region = regions.get_mask_region(mask, 5, -3)
+    
+    random.seed(8)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder.SwapMapBuilder(None, tile_map, None,
+                                              border_sampler, sampler,
+                                              region)
+    builder.make_map()
+    
+    assert tile_map.find_mismatches().count == 0
+    assert set(tile_map.tiles) == set(region)
+    
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder_2.StochSwapMapBuilder(None, tile_map,
+                                                     sampler, None, region)
+    assert builder.board.num_cells == len(region)
+    assert builder.mismatches.count\
+           == maps.find_mismatches(builder.tiles_from_coords,
+                                   tile_map.disp_function).count
+    
+    #A rectangle's border cells are next to each other, so a border
+    #sampler with mixed tiles has to be matched along the border
+    region = regions.get_rectangle_region(12, 9)
+    for batched in (False, True):
+        random.seed(9)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = swap_map_builder.SwapMapBuilder(None, tile_map, None,
+                                                  sampler, sampler, region)
+        builder.make_map(batched)
+        
+        assert tile_map.find_mismatches().count == 0
+        assert set(tile_map.tiles) == set(region)
+    
+    random.seed(9)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder_2.StochSwapMapBuilder(None, tile_map,
+                                                     sampler, None, region)
+    builder.make_map(1000)
+    
+    assert tile_map.find_mismatches().count == 0
+    assert set(tile_map.tiles) == set(region)
+
+def match_tiles_test():
+    rng = np.random.default_rng(3)
+    
+    tiles = np.array([1, 1, 2, 3, 3, 3, 4])
+    needed = np.array([3, 1, 1, 3, 5, 2, 3])
+    
+    new_tiles, satisfied = swap_map_builder.match_tiles(tiles, needed, rng)
+    
+    #The tiles only move around
+    assert sorted(new_tiles) == sorted(tiles)
+    assert np.array_equal(satisfied, new_tiles == needed)
+    
+    #Every cell that could get what it needs does
+    assert satisfied.sum() == 6
+    assert not satisfied[4]
+
+def swap_batched_test():
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    sampler = get_normal_sampler()
+    
+    def make_map(seed):
+        random.seed(seed)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        builder = swap_map_builder.SwapMapBuilder(20, tile_map, None,
+                                                  border_sampler, sampler)
+        builder.make_map(batched=True)
+        
+        return builder, tile_map
+    
+    builder, tile_map = make_map(5)
+    
+    assert builder.mismatches.count == 0
+    assert tile_map.find_mismatches().count == 0
+    assert len(tile_map.tiles) == len(builder.board.coords_list)
+    
+    #The Python structures agree with the board
+    for coords, tile in builder.tiles_from_coords.items():
+        assert builder.packed[builder.board.index(coords)] == tile.packed
+    
+    #One batched iteration keeps the tiles of each colour
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder.SwapMapBuilder(20, tile_map, None,
+                                              border_sampler, sampler)
+    builder.make_border()
+    builder.sample_inner_tiles()
+    packed, eligible = builder.get_board_arrays()
+    before = packed.copy()
+    
+    builder.do_batched_iteration(packed, eligible, np.random.default_rng(0))
+    
+    for colour in (0, 1):
+        cells = np.flatnonzero(builder.colours == colour)
+        assert sorted(packed[cells]) == sorted(before[cells])
+    
+    #Border cells never move
+    assert np.array_equal(packed[:-1][~builder.inner_mask],
+                          before[:-1][~builder.inner_mask])
+    
+    #The same seed gives the same map
+    _, first_map = make_map(5)
+    _, other_map = make_map(5)
+    assert first_map.tiles == other_map.tiles
+
+def stoch_mismatch_test():
+    random.seed(12)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    sampler = get_normal_sampler()
+    
+    builder = swap_map_builder_2.StochSwapMapBuilder(half_diag=8,
+                                                     tile_map=tile_map,
+                                                     sampler=sampler,
+                                                     num_swaps=None)
+    
+    #The count follows the swaps
+    for _ in range(2000):
+        builder.do_random_swap()
+    
+    mismatches = maps.find_mismatches(builder.tiles_from_coords,
+                                      tile_map.disp_function)
+    assert builder.mismatches.count == mismatches.count
+    
+    #Fixing the board by hand stops make_map straight away
+    for coords in builder.board.coords_list:
+        builder.set_tile_at(coords, maps.Tile(*'PPPP'))
+    
+    assert builder.mismatches.count == 0
+    assert not builder.mismatches.erroneous
+    
+    builder.make_map(10**6)
+    assert len(tile_map.tiles) == len(builder.board.coords_list)
+
+def instruments_test():
+    border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
+    sampler = get_normal_sampler()
+    
+    events = list()
+    def observer(event, data):
+        events.append((event, data))
+    
+    random.seed(9)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder.SwapMapBuilder(12, tile_map, None,
+                                              border_sampler, sampler,
+                                              observer=observer)
+    builder.make_map()
+    
+    report = builder.instruments.report()
+    
+    #The report survives JSON, and keeps no events unless asked to
+    assert json.loads(builder.instruments.to_json()) == report
+    assert report['events'] == []
+    
+    rounds = [data for event, data in events if event == 'round']
+    assert len(rounds) == report['counts']['rounds']
+    assert rounds[-1]['mismatched'] == 0
+    assert all(data['eligible'] + data['frozen']
+               == len(builder.inner_coords) for data in rounds)
+    
+    assert report['counts']['swaps_accepted'] > 0
+    assert report['counts']['iterations'] >= len(rounds)
+    for phase in ('make_border', 'sample_inner_tiles', 'swapping', 'save'):
+        assert report['phases'][phase]['seconds'] >= 0
+    assert report['phases']['swapping']['calls']\
+           == report['counts']['iterations']
+    
+    #The stochastic builder counts every swap it tries
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder_2.StochSwapMapBuilder(6, tile_map, sampler,
+                                                     None)
+    builder.make_map(5000)
+    
+    counts = builder.instruments.report()['counts']
+    assert counts['swaps_accepted'] + counts['swaps_rejected'] <= 5000
+    assert 'filled_in_tiles' in counts
+    
+    #As does the MapBuilder
+    del events[:]
+    builder = board_builder.MapBuilder(maps.TileMap(maps.boundless_disp),
+                                       sampler, observer=observer)
+    stats = builder.grow(300, progress_every=100)
+    
+    report = builder.instruments.report()
+    assert report['counts']['tiles_placed'] == stats.tiles_placed
+    assert [data['tiles_placed'] for event, data in events
+            if event == 'progress'] == [100, 200, 300]
+    
+    #Unobserved events aren't kept, and recorded ones only the last few
+    unobserved = instruments.Instruments('unobserved')
+    recorded = instruments.Instruments('recorded', record=3)
+    log = instruments.EventLog(2)
+    for i in range(10):
+        unobserved.emit('step', i=i)
+        recorded.emit('step', i=i)
+        log('step', {'i': i})
+    
+    assert not unobserved.events
+    assert [data['i'] for _, data in recorded.report()['events']]\
+           == [7, 8, 9]
+    assert [data['i'] for _, data in log.events] == [8, 9]
+
+def annealing_test():
+    sampler = get_normal_sampler()
+    
+    def get_builder():
+        random.seed(6)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        log = instruments.EventLog()
+        return swap_map_builder_2.StochSwapMapBuilder(12, tile_map, sampler,
+                                                      None, observer=log)
+    
+    def get_sweeps(builder):
+        return [data for event, data in builder.instruments.observer.events
+                if event == 'sweep']
+    
+    #Without a schedule, the energy never goes up
+    builder = get_builder()
+    builder.do_sweeps(20000)
+    
+    energies = [data['mismatched'] for data in get_sweeps(builder)]
+    assert energies == sorted(energies, reverse=True)
+    assert all(data['temperature'] == 0 for data in get_sweeps(builder))
+    greedy_count = builder.mismatches.count
+    
+    #With one, it can, but the best board is kept
+    builder = get_builder()
+    schedule = annealing.ExponentialSchedule(1.0, 0.9, 0.05)
+    builder.do_sweeps(10**6, schedule, patience=10)
+    
+    sweeps = get_sweeps(builder)
+    energies = [data['mismatched'] for data in sweeps]
+    assert energies != sorted(energies, reverse=True)
+    assert builder.mismatches.count == min(energies)
+    assert sweeps[0]['temperature'] == 1.0
+    assert sweeps[-1]['temperature'] == 0
+    
+    #The plateau stops it well before the budget
+    assert [event for event, _ in builder.instruments.observer.events][-1]\
+           == 'plateau'
+    assert sweeps[-1]['swaps'] < 10**6
+    assert builder.mismatches.count < greedy_count
+    
+    mismatches = maps.find_mismatches(builder.tiles_from_coords,
+                                      builder.tile_map.disp_function)
+    assert builder.mismatches.count == mismatches.count
+    
+    #Worse swaps are taken with the Metropolis probability
+    assert annealing.acceptance_probability(-2, 0) == 1
+    assert annealing.acceptance_probability(1, 0) == 0
+    assert abs(annealing.acceptance_probability(2, 0.5) - np.exp(-4))\
+           < 1e-12
+    
+    detector = annealing.PlateauDetector(3)
+    assert [detector.update(energy) for energy in (9, 8, 8, 9, 7, 7, 7, 7)]\
+           == [False, False, False, False, False, False, False, True]
+    
+    assert annealing.LinearSchedule(2.0, 4)(1) == 1.5
+    assert annealing.LinearSchedule(2.0, 4)(9) == 0
+
+def batched_swaps_test():
+    sampler = get_normal_sampler()
+    
+    def get_builder():
+        random.seed(8)
+        tile_map = maps.TileMap(maps.boundless_disp)
+        log = instruments.EventLog()
+        return swap_map_builder_2.StochSwapMapBuilder(12, tile_map, sampler,
+                                                      None, observer=log)
+    
+    def check_count(builder):
+        mismatches = maps.find_mismatches(builder.tiles_from_coords,
+                                          builder.tile_map.disp_function)
+        assert builder.mismatches.count == mismatches.count
+    
+    #Batches are judged like single swaps, so the count only goes down
+    #without a schedule, and ends up as low
+    serial = get_builder()
+    serial.do_sweeps(20000)
+    check_count(serial)
+    
+    builder = get_builder()
+    builder.do_sweeps(20000, batched=True)
+    check_count(builder)
+    
+    sweeps = [data for event, data in builder.instruments.observer.events
+              if event == 'sweep']
+    energies = [data['mismatched'] for data in sweeps]
+    assert energies == sorted(energies, reverse=True)
+    assert sweeps[-1]['swaps'] <= 20000
+    assert builder.mismatches.count <= serial.mismatches.count * 1.5
+    
+    #Without exact batches, only the pairs next to other swaps are
+    #dropped, and the count still follows the swaps
+    inexact = get_builder()
+    inexact.do_sweeps(20000, batched=True, exact=False)
+    check_count(inexact)
+    assert inexact.mismatches.count <= serial.mismatches.count * 1.5
+    
+    #The swapper's codes follow its tiles
+    board = builder.board
+    packed = np.array(builder.mismatches.packed)
+    swapper = swap_map_builder_2.BatchSwapper(board, packed,
+                                              builder.mismatches.count,
+                                              tile_sampler.get_numpy_rng())
+    for exact in (True, False):
+        swapper.exact = exact
+        swapper.do_swaps(10000, temperature=0.5)
+        
+        fresh = swap_map_builder_2.BatchSwapper(board, swapper.packed,
+                                                swapper.count,
+                                                tile_sampler.get_numpy_rng())
+        assert np.array_equal(swapper.codes, fresh.codes)
+        assert np.array_equal(swapper.facing_codes[:-1],
+                              fresh.facing_codes[:-1])
+        
+        #And so does its count
+        builder.set_board(swapper.packed.tolist())
+        assert builder.mismatches.count == swapper.count
+    
+    #Rows of codes are compared a word at a time
+    codes_1 = np.random.default_rng(1).integers(1, 4, 400, dtype=np.uint8)
+    codes_2 = np.random.default_rng(2).integers(1, 4, 400, dtype=np.uint8)
+    assert swap_map_builder_2.count_unequal(codes_1, codes_2).tolist()\
+           == np.count_nonzero((codes_1 != codes_2).reshape(-1, 4),
+                               axis=1).tolist()
+    
+    #Annealing keeps the best board, and make_map fills in the rest
+    builder = get_builder()
+    schedule = annealing.ExponentialSchedule(1.0, 0.9, 0.05)
+    builder.make_map(10**6, schedule, patience=10, batched=True)
+    assert len(builder.tile_map.tiles) == len(board.coords_list)
+
+def targeted_swaps_test():
+    sampler = get_normal_sampler()
+    
+    random.seed(9)
+    tile_map = maps.TileMap(maps.boundless_disp)
+    builder = swap_map_builder_2.StochSwapMapBuilder(12, tile_map, sampler,
+                                                     None)
+    mismatches = builder.mismatches
+    
+    #Get to where uniform swaps have stalled
+    builder.do_sweeps(10**6, patience=5)
+    start = list(mismatches.packed)
+    
+    def run(targeted):
+        random.seed(10)
+        builder.set_board(start)
+        builder.do_swaps(5000, targeted=targeted)
+        
+        return mismatches.count
+    
+    #Drawing from the cells with errors does far better from there
+    uniform_count = run(False)
+    targeted_count = run(True)
+    assert targeted_count < uniform_count
+    
+    #The count and the tile index still follow the swaps
+    found = maps.find_mismatches(builder.tiles_from_coords,
+                                 tile_map.disp_function)
+    assert mismatches.count == found.count
+    
+    for packed, cells in mismatches.cells_from_tile.items():
+        assert all(mismatches.packed[i] == packed for i in cells)
+    assert sum(map(len, mismatches.cells_from_tile.values()))\
+           == builder.board.num_cells
+    
+    #The better tiles really are better
+    for i in list(mismatches.erroneous)[:20]:
+        needed = mismatches.get_needed(i)
+        error = swap_map_builder_2.num_packed_differences(
+            mismatches.packed[i], needed)
+        
+        for packed in builder.get_better_tiles(i):
+            assert swap_map_builder_2.num_packed_differences(packed, needed)\
+                   < error
+    
+    #Targeted swaps aren't batched
+    try:
+        builder.do_sweeps(100, batched=True, targeted=True)
+        assert False
+    except ValueError:
+        pass
+    
+    builder.make_map(10**5, targeted=True)
+    assert len(tile_map.tiles) == builder.board.num_cells
+
 def weighted_builder():
     # Get a boundless map
     tile_map = maps.TileMap(maps.boundless_disp)
@@ -148,10 +1116,8 @@ def weighted_builder():
     
     num_tiles = 10**5
     
-    for i in range(num_tiles):
-        builder.add_tile()
-        if (i+1) % 100000 == 0:
-            print('{} tiles'.format(i+1))
+    stats = builder.grow(num_tiles, progress=print, progress_every=10**4)
+    print(stats)
     
     #Display the map
     colors_from_terrains = {'P': (239, 222, 103),
@@ -168,6 +1134,7 @@ def weighted_builder():
 
 def swap_builder():
     tile_map = maps.TileMap(maps.boundless_disp)
+    observer = instruments.print_observer
     
     # Surround the map with water
     border_sampler = tile_sampler.OneTileSampler(maps.Tile(*'WWWW'))
@@ -177,7 +1144,8 @@ def swap_builder():
                                               tile_map=tile_map,
                                               stop_amount=None,
                                               border_sampler=border_sampler,
-                                              interior_sampler=sampler)
+                                              interior_sampler=sampler,
+                                              observer=observer)
     
     filename = 'genmap_35.png'
     if os.path.exists(filename):
@@ -200,19 +1168,22 @@ def swap_builder():
 
 def stoch_swap_builder():
     tile_map = maps.TileMap(maps.boundless_disp)
+    observer = instruments.print_observer
     
     sampler = get_normal_sampler()
     
     builder = swap_map_builder_2.StochSwapMapBuilder(half_diag=50,
                                                      tile_map=tile_map,
                                                      sampler=sampler,
-                                                     num_swaps=10**5)
+                                                     num_swaps=10**5,
+                                                     observer=observer)
     
     filename = 'genmap_46.png'
     if os.path.exists(filename):
         raise ValueError('file already exists: {}'.format(filename))
         
-    builder.make_map(10**7)
+    schedule = annealing.ExponentialSchedule(1.0, 0.98, 0.05)
+    builder.make_map(10**7, schedule, patience=20)
     
     #Display the map
     colors_from_terrains = {'P': (239, 222, 103),
@@ -227,9 +1198,35 @@ def stoch_swap_builder():
     display(map_image)
     map_image.save(filename)
 
+def run_test(test):
+    try:
+        test()
+    except Exception:
+        print('{} Failed'.format(test.__name__))
+        traceback.print_exc()
+        return
+    print('{} Succeeded'.format(test.__name__))
+
 def main():
     # adjacency_test()
     # builder_test()
+    run_test(dense_builder_test)
+    run_test(alias_sampler_test)
+    run_test(weight_array_test)
+    run_test(sample_matching_test)
+    run_test(sampler_cache_test)
+    run_test(grow_test)
+    run_test(parallel_builder_test)
+    run_test(swap_needed_test)
+    run_test(stoch_mismatch_test)
+    run_test(match_tiles_test)
+    run_test(swap_batched_test)
+    run_test(swap_region_test)
+    run_test(instruments_test)
+    run_test(distributed_swap_test)
+    run_test(annealing_test)
+    run_test(batched_swaps_test)
+    run_test(targeted_swaps_test)
     weighted_builder()
     # swap_builder()
     # stoch_swap_builder()
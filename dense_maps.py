@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 23 11:02:17 2021
+
+@author: rober
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+import maps
+
+class TilesView(Mapping):
+    """
+    A read-only coords->tile view of an array-backed map,
+    so it can be used wherever TileMap.tiles is used.
+    """
+    def __init__(self, tile_map):
+        self.tile_map = tile_map
+    
+    def __getitem__(self, coords):
+        return self.tile_map.at(coords)
+    
+    def __contains__(self, coords):
+        return self.tile_map.has_tile(coords)
+    
+    def __iter__(self):
+        for coords, _ in self.tile_map.iter_tiles():
+            yield coords
+    
+    def __len__(self):
+        return self.tile_map.num_tiles
+    
+    def items(self):
+        return self.tile_map.iter_tiles()
+
+class PackedTileMap:
+    """
+    The parts of a map of packed tiles in numpy arrays that don't depend
+    on how the arrays are laid out.
+    
+    Subclasses provide get_packed, lookup_arrays, store_tile,
+    store_arrays, clear_tile and tile_arrays.
+    """
+    def in_direction(self, coords, direction):
+        c_disp = maps.ADJ_DISPS[direction]
+        return self.disp_function(coords, c_disp)
+    
+    def has_tile(self, coords):
+        if coords is None:
+            return False
+        
+        return self.get_packed(coords.x, coords.y) is not None
+    
+    def fits(self, coords, tile):
+        #For all the adjacent tiles, check whether this tile matches,
+        #comparing the packed sections so no tiles are made
+        mask = maps.TERRAIN_MASK
+        for direction, (shift, adj_shift) in zip(maps.DIRECTIONS,
+                                                 maps.MATCH_SHIFTS):
+            
+            #Get the coordinates in this direction
+            other_coords = self.in_direction(coords, direction)
+            
+            #If there are no coords in that direction, continue
+            if other_coords is None:
+                continue
+            
+            other_packed = self.get_packed(other_coords.x, other_coords.y)
+            if other_packed is None:
+                continue
+            
+            #It doesn't match
+            if (tile.packed >> shift) & mask\
+               != (other_packed >> adj_shift) & mask:
+                return False
+        
+        return True
+    
+    def add_tile(self, coords, tile):
+        if self.has_tile(coords):
+            raise ValueError('coords in self.tiles: {}'.format(coords))
+        
+        if not self.fits(coords, tile):
+            raise ValueError('tile doesn\'t fit: {}, {}'.format(coords, tile))
+        
+        self.store_tile(coords.x, coords.y, tile.packed)
+    
+    def remove_tile(self, coords):
+        if not self.has_tile(coords):
+            raise KeyError(coords)
+        
+        self.clear_tile(coords.x, coords.y)
+    
+    def add_tiles(self, tiles):
+        """
+        Add all the tiles in a coords->tile mapping,
+        checking the whole batch in one pass.
+        """
+        if not tiles:
+            return
+        
+        xs, ys, packed = maps.get_tile_arrays(tiles)
+        
+        _, taken = self.lookup_arrays(xs, ys)
+        if taken.any():
+            raise ValueError('coords in self.tiles: {}'
+                             .format(maps.CoordPair(int(xs[taken][0]),
+                                                    int(ys[taken][0]))))
+        
+        #Get the tiles around the batch
+        around_keys = list()
+        for direction in maps.DIRECTIONS:
+            adj_xs, adj_ys, valid = maps.disp_arrays(xs, ys,
+                                                     maps.ADJ_DISPS[direction],
+                                                     self.disp_function)
+            adj_xs = adj_xs[valid]
+            adj_ys = adj_ys[valid]
+            
+            _, on_map = self.lookup_arrays(adj_xs, adj_ys)
+            around_keys.append(maps.coord_key(adj_xs[on_map], adj_ys[on_map]))
+        
+        around_keys = np.unique(np.concatenate(around_keys))
+        around_xs = maps.key_x(around_keys)
+        around_ys = maps.key_y(around_keys)
+        around_packed, _ = self.lookup_arrays(around_xs, around_ys)
+        
+        #Check the batch against itself and the tiles around it
+        checked = np.zeros(len(around_keys) + len(xs), dtype=bool)
+        checked[len(around_keys):] = True
+        
+        mismatches = maps.check_edges(np.concatenate((around_xs, xs)),
+                                      np.concatenate((around_ys, ys)),
+                                      np.concatenate((around_packed, packed)),
+                                      self.disp_function,
+                                      checked)
+        if mismatches.count:
+            raise ValueError('{} tiles don\'t fit: {}'
+                             .format(mismatches.count,
+                                     mismatches.positions()[:10]))
+        
+        self.store_arrays(xs, ys, packed)
+    
+    def find_mismatches(self):
+        """
+        Return EdgeMismatches for every mismatched edge on the map.
+        """
+        xs, ys, packed = self.tile_arrays()
+        return maps.check_edges(xs, ys, packed, self.disp_function)
+    
+    def at(self, coords):
+        packed = self.get_packed(coords.x, coords.y)
+        if packed is None:
+            raise KeyError(coords)
+        
+        return maps.Tile.from_packed(packed)
+    
+    def iter_tiles(self):
+        """
+        Yield (coords, tile) for every tile on the map.
+        """
+        xs, ys, packed = self.tile_arrays()
+        
+        for x, y, code in zip(xs.tolist(), ys.tolist(), packed.tolist()):
+            yield maps.CoordPair(x, y), maps.Tile.from_packed(code)
+
+class DenseTileMap(PackedTileMap):
+    """
+    A map of tiles, stored as packed tiles in a numpy grid
+    with an occupancy mask.
+    The grid grows geometrically when a tile is added past its edge.
+    """
+    def __init__(self, disp_function, width=16, height=16):
+        if width < 1 or height < 1:
+            raise ValueError('width: {}, height: {}'.format(width, height))
+        
+        self.disp_function = disp_function
+        
+        #The coordinates of grid[0, 0]
+        #start with (0, 0) in the middle of the grid
+        self.min_x = -(width // 2)
+        self.min_y = -(height // 2)
+        
+        self.codes = np.zeros((width, height), dtype=np.uint32)
+        self.occupied = np.zeros((width, height), dtype=bool)
+        
+        self.num_tiles = 0
+        self.tiles = TilesView(self)
+    
+    @classmethod
+    def from_arrays(cls, disp_function, codes, occupied, min_x, min_y):
+        """
+        Return a map holding the given grid of packed tiles,
+        without checking them.
+        """
+        tile_map = cls(disp_function, 1, 1)
+        
+        tile_map.codes = codes
+        tile_map.occupied = occupied
+        tile_map.min_x = min_x
+        tile_map.min_y = min_y
+        tile_map.num_tiles = int(np.count_nonzero(occupied))
+        
+        return tile_map
+    
+    @property
+    def width(self):
+        return self.codes.shape[0]
+    
+    @property
+    def height(self):
+        return self.codes.shape[1]
+    
+    def in_bounds(self, coords):
+        gx = coords.x - self.min_x
+        gy = coords.y - self.min_y
+        
+        return 0 <= gx < self.width and 0 <= gy < self.height
+    
+    def in_bounds_arrays(self, xs, ys):
+        gxs = xs - self.min_x
+        gys = ys - self.min_y
+        
+        return (0 <= gxs) & (gxs < self.width)\
+               & (0 <= gys) & (gys < self.height)
+    
+    def grow_to(self, coords):
+        """
+        Grow the grid so that it contains the given coords.
+        Each dimension that needs to grow at least doubles.
+        """
+        if self.in_bounds(coords):
+            return
+        
+        min_x, min_y = self.min_x, self.min_y
+        max_x = min_x + self.width
+        max_y = min_y + self.height
+        
+        if coords.x < min_x:
+            min_x = min(coords.x, min_x - self.width)
+        elif coords.x >= max_x:
+            max_x = max(coords.x + 1, max_x + self.width)
+        
+        if coords.y < min_y:
+            min_y = min(coords.y, min_y - self.height)
+        elif coords.y >= max_y:
+            max_y = max(coords.y + 1, max_y + self.height)
+        
+        new_codes = np.zeros((max_x - min_x, max_y - min_y),
+                             dtype=self.codes.dtype)
+        new_occupied = np.zeros(new_codes.shape, dtype=bool)
+        
+        #Copy the old grid into the new one
+        ox = self.min_x - min_x
+        oy = self.min_y - min_y
+        new_codes[ox:ox+self.width, oy:oy+self.height] = self.codes
+        new_occupied[ox:ox+self.width, oy:oy+self.height] = self.occupied
+        
+        self.codes = new_codes
+        self.occupied = new_occupied
+        self.min_x = min_x
+        self.min_y = min_y
+    
+    def get_packed(self, x, y):
+        """
+        Return the packed tile at (x, y), or None if there's no tile there.
+        """
+        gx = x - self.min_x
+        gy = y - self.min_y
+        
+        if not (0 <= gx < self.width and 0 <= gy < self.height):
+            return None
+        
+        if not self.occupied[gx, gy]:
+            return None
+        
+        return int(self.codes[gx, gy])
+    
+    def lookup_arrays(self, xs, ys):
+        """
+        Return the packed tiles at the given coordinates,
+        and a mask of which coordinates have tiles.
+        """
+        in_bounds = self.in_bounds_arrays(xs, ys)
+        gxs = (xs - self.min_x)[in_bounds]
+        gys = (ys - self.min_y)[in_bounds]
+        
+        packed = np.zeros(len(xs), dtype=np.int64)
+        occupied = np.zeros(len(xs), dtype=bool)
+        
+        packed[in_bounds] = self.codes[gxs, gys]
+        occupied[in_bounds] = self.occupied[gxs, gys]
+        
+        return packed, occupied
+    
+    def store_tile(self, x, y, packed):
+        """
+        Put a packed tile on empty coordinates, without checking.
+        """
+        self.grow_to(maps.CoordPair(x, y))
+        
+        gx = x - self.min_x
+        gy = y - self.min_y
+        
+        self.codes[gx, gy] = packed
+        self.occupied[gx, gy] = True
+        self.num_tiles += 1
+    
+    def clear_tile(self, x, y):
+        """
+        Take the tile off (x, y), without checking there is one.
+        """
+        self.occupied[x - self.min_x, y - self.min_y] = False
+        self.num_tiles -= 1
+    
+    def store_arrays(self, xs, ys, packed):
+        """
+        Put the given packed tiles on empty coordinates, without checking.
+        """
+        self.grow_to(maps.CoordPair(int(xs.min()), int(ys.min())))
+        self.grow_to(maps.CoordPair(int(xs.max()), int(ys.max())))
+        
+        gxs = xs - self.min_x
+        gys = ys - self.min_y
+        
+        self.codes[gxs, gys] = packed
+        self.occupied[gxs, gys] = True
+        self.num_tiles += len(xs)
+    
+    def tile_arrays(self):
+        """
+        Return the x, y and packed tile arrays for every tile on the map.
+        """
+        gxs, gys = np.nonzero(self.occupied)
+        
+        return (gxs + self.min_x,
+                gys + self.min_y,
+                self.codes[gxs, gys].astype(np.int64))
+    
+    def find_mismatches(self):
+        """
+        Return EdgeMismatches for every mismatched edge on the map.
+        """
+        if self.disp_function is not maps.boundless_disp:
+            return PackedTileMap.find_mismatches(self)
+        
+        #On a boundless map, every edge is inside the grid,
+        #so the grid can be compared with a shifted copy of itself
+        bad_xs = list()
+        bad_ys = list()
+        bad_directions = list()
+        
+        shifted = [(maps.Direction.RIGHT, np.s_[:-1, :], np.s_[1:, :]),
+                   (maps.Direction.DOWN, np.s_[:, :-1], np.s_[:, 1:])]
+        
+        for direction, here, there in shifted:
+            codes = maps.get_section_codes(self.codes[here], direction)
+            adj_codes = maps.get_section_codes(self.codes[there],
+                                               maps.OPPOSITES[direction])
+            
+            bad = self.occupied[here] & self.occupied[there]\
+                  & (codes != adj_codes)
+            
+            gxs, gys = np.nonzero(bad)
+            bad_xs.append(gxs + self.min_x)
+            bad_ys.append(gys + self.min_y)
+            bad_directions.append(np.full(len(gxs),
+                                          maps.SECTION_INDICES[direction]))
+        
+        return maps.EdgeMismatches(np.concatenate(bad_xs).astype(np.int64),
+                                   np.concatenate(bad_ys).astype(np.int64),
+                                   np.concatenate(bad_directions))
+
+#Chunks are CHUNK_SIZE by CHUNK_SIZE, so coordinates split into
+#a chunk index and a position in the chunk with shifts and masks
+CHUNK_BITS = 6
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+class Chunk:
+    """
+    One CHUNK_SIZE by CHUNK_SIZE block of a chunked map.
+    """
+    def __init__(self, chunk_x, chunk_y):
+        self.chunk_x = chunk_x
+        self.chunk_y = chunk_y
+        
+        #The coordinates of codes[0, 0]
+        self.min_x = chunk_x << CHUNK_BITS
+        self.min_y = chunk_y << CHUNK_BITS
+        
+        self.codes = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=np.uint32)
+        self.occupied = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=bool)
+        self.num_tiles = 0
+    
+    def tile_arrays(self):
+        """
+        Return the x, y and packed tile arrays for every tile in the chunk.
+        """
+        lxs, lys = np.nonzero(self.occupied)
+        
+        return (lxs + self.min_x,
+                lys + self.min_y,
+                self.codes[lxs, lys].astype(np.int64))
+
+class ChunkedTileMap(PackedTileMap):
+    """
+    A map of tiles, stored as fixed-size dense chunks
+    that are made the first time a tile is put in them.
+    
+    Memory goes with the area that has tiles,
+    not with the bounding box of the map.
+    """
+    def __init__(self, disp_function):
+        self.disp_function = disp_function
+        
+        #chunk key->Chunk, where the key is the packed chunk coordinates
+        self.chunks = dict()
+        
+        self.num_tiles = 0
+        self.tiles = TilesView(self)
+    
+    def get_packed(self, x, y):
+        """
+        Return the packed tile at (x, y), or None if there's no tile there.
+        """
+        chunk = self.chunks.get(maps.coord_key(x >> CHUNK_BITS,
+                                               y >> CHUNK_BITS))
+        if chunk is None:
+            return None
+        
+        lx = x & CHUNK_MASK
+        ly = y & CHUNK_MASK
+        
+        if not chunk.occupied[lx, ly]:
+            return None
+        
+        return int(chunk.codes[lx, ly])
+    
+    def group_by_chunk(self, xs, ys):
+        """
+        Yield (chunk key, indices) for the chunks the given coordinates
+        fall in, whether or not the chunks exist yet.
+        """
+        chunk_keys = maps.coord_key(xs >> CHUNK_BITS, ys >> CHUNK_BITS)
+        
+        order = np.argsort(chunk_keys, kind='stable')
+        sorted_keys = chunk_keys[order]
+        
+        #Where each run of equal chunk keys starts
+        starts = np.flatnonzero(np.diff(sorted_keys)) + 1
+        starts = np.concatenate(([0], starts))
+        ends = np.concatenate((starts[1:], [len(order)]))
+        
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield int(sorted_keys[start]), order[start:end]
+    
+    def lookup_arrays(self, xs, ys):
+        """
+        Return the packed tiles at the given coordinates,
+        and a mask of which coordinates have tiles.
+        The coordinates can fall in any number of chunks.
+        """
+        packed = np.zeros(len(xs), dtype=np.int64)
+        occupied = np.zeros(len(xs), dtype=bool)
+        
+        if not len(xs):
+            return packed, occupied
+        
+        for chunk_key, indices in self.group_by_chunk(xs, ys):
+            chunk = self.chunks.get(chunk_key)
+            if chunk is None:
+                continue
+            
+            lxs = xs[indices] & CHUNK_MASK
+            lys = ys[indices] & CHUNK_MASK
+            
+            packed[indices] = chunk.codes[lxs, lys]
+            occupied[indices] = chunk.occupied[lxs, lys]
+        
+        return packed, occupied
+    
+    def store_tile(self, x, y, packed):
+        """
+        Put a packed tile on empty coordinates, without checking.
+        """
+        chunk_key = maps.coord_key(x >> CHUNK_BITS, y >> CHUNK_BITS)
+        chunk = self.chunks.get(chunk_key)
+        if chunk is None:
+            chunk = Chunk(x >> CHUNK_BITS, y >> CHUNK_BITS)
+            self.chunks[chunk_key] = chunk
+        
+        lx = x & CHUNK_MASK
+        ly = y & CHUNK_MASK
+        
+        chunk.codes[lx, ly] = packed
+        chunk.occupied[lx, ly] = True
+        chunk.num_tiles += 1
+        self.num_tiles += 1
+    
+    def clear_tile(self, x, y):
+        """
+        Take the tile off (x, y), without checking there is one.
+        """
+        chunk = self.chunks[maps.coord_key(x >> CHUNK_BITS, y >> CHUNK_BITS)]
+        
+        chunk.occupied[x & CHUNK_MASK, y & CHUNK_MASK] = False
+        chunk.num_tiles -= 1
+        self.num_tiles -= 1
+    
+    def store_arrays(self, xs, ys, packed):
+        """
+        Put the given packed tiles on empty coordinates, without checking.
+        """
+        for chunk_key, indices in self.group_by_chunk(xs, ys):
+            chunk = self.chunks.get(chunk_key)
+            if chunk is None:
+                chunk = Chunk(maps.key_x(chunk_key), maps.key_y(chunk_key))
+                self.chunks[chunk_key] = chunk
+            
+            lxs = xs[indices] & CHUNK_MASK
+            lys = ys[indices] & CHUNK_MASK
+            
+            chunk.codes[lxs, lys] = packed[indices]
+            chunk.occupied[lxs, lys] = True
+            chunk.num_tiles += len(indices)
+        
+        self.num_tiles += len(xs)
+    
+    def iter_chunks(self):
+        """
+        Yield every chunk that has tiles in it.
+        """
+        for chunk in self.chunks.values():
+            if chunk.num_tiles:
+                yield chunk
+    
+    def tile_arrays(self):
+        """
+        Return the x, y and packed tile arrays for every tile on the map.
+        """
+        arrays = [chunk.tile_arrays() for chunk in self.iter_chunks()]
+        if not arrays:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        
+        xs, ys, packed = zip(*arrays)
+        
+        return np.concatenate(xs), np.concatenate(ys), np.concatenate(packed)
+    
+    def iter_tiles(self):
+        """
+        Yield (coords, tile) for every tile on the map, chunk by chunk.
+        """
+        for chunk in self.iter_chunks():
+            xs, ys, packed = chunk.tile_arrays()
+            
+            for x, y, code in zip(xs.tolist(), ys.tolist(), packed.tolist()):
+                yield maps.CoordPair(x, y), maps.Tile.from_packed(code)
\ No newline at end of file
@@ -29,6 +29,25 @@ def get_embedded_coords(coords, direction):
     
     return maps.CoordPair(bx + dx, by + dy)
 
+def get_chunk_squares(chunk):
+    """
+    Return the embedded x, y and terrain code arrays of the squares
+    partially in the tiles of a chunk of a chunked map.
+    Squares shared by tiles come up once for each tile.
+    """
+    xs, ys, packed = chunk.tile_arrays()
+    
+    exs = list()
+    eys = list()
+    codes = list()
+    for direction in maps.Direction:
+        dx, dy = EMBEDDED_DISPS[direction]
+        exs.append(xs + ys + dx)
+        eys.append(-xs + ys + dy)
+        codes.append(maps.get_section_codes(packed, direction))
+    
+    return np.concatenate(exs), np.concatenate(eys), np.concatenate(codes)
+
 def get_white_image_array(width, height):
     array = np.ones((width, height, 3), dtype=np.uint8)
     return array * 255
@@ -36,9 +55,13 @@ def get_white_image_array(width, height):
 class Map:
     """
     A map where each coordinate has a single terrain type.
+    
+    A chunked map isn't copied into squares. Its chunks are kept and
+    read again as they're drawn, so the map takes no more memory.
     """
     def __init__(self, tile_map):
         self.squares = dict()
+        self.chunks = list()
         
         self.min_x = float('inf')
         self.max_x = float('-inf')
@@ -47,38 +70,99 @@ class Map:
         self.max_y = float('-inf')
         
         #Get the embedded map out of the given tile map
-        
-        #For each tile, set the four embedded squares that are
-        #partially in the tile
-        #this also checks that all the tiles match
-        for coords, tile in tile_map.tiles.items():
-            for direction in maps.Direction:
-                embedded_coords = get_embedded_coords(coords, direction)
-                
-                #Update mininum and maximum values
-                ex, ey = embedded_coords.x, embedded_coords.y
-                
-                self.min_x = min(self.min_x, ex)
-                self.max_x = max(self.max_x, ex)
-                
-                self.min_y = min(self.min_y, ey)
-                self.max_y = max(self.max_y, ey)
-                
-                terrain = tile.sections[direction]
-                
-                if not embedded_coords in self.squares:
-                    self.squares[embedded_coords] = terrain
-                else:
-                    if self.squares[embedded_coords] != terrain:
-                        raise ValueError('mismatched terrains at {}: '
-                                         '{}, {}'
-                                         .format(embedded_coords,
-                                                 self.squares[embedded_coords],
-                                                 terrain))
+        #chunked maps are read a chunk at a time
+        if hasattr(tile_map, 'iter_chunks'):
+            for chunk in tile_map.iter_chunks():
+                self.add_chunk(chunk)
+        else:
+            for coords, tile in tile_map.tiles.items():
+                self.add_tile(coords, tile)
     
         self.width = self.max_x - self.min_x + 1
         self.height = self.max_y - self.min_y + 1
-                        
+    
+    def set_square(self, embedded_coords, terrain):
+        if not embedded_coords in self.squares:
+            self.squares[embedded_coords] = terrain
+        else:
+            if self.squares[embedded_coords] != terrain:
+                raise ValueError('mismatched terrains at {}: '
+                                 '{}, {}'
+                                 .format(embedded_coords,
+                                         self.squares[embedded_coords],
+                                         terrain))
+    
+    def add_tile(self, coords, tile):
+        """
+        Set the four embedded squares that are partially in the tile.
+        This also checks that the tile matches the squares already set.
+        """
+        for direction in maps.Direction:
+            embedded_coords = get_embedded_coords(coords, direction)
+            
+            #Update mininum and maximum values
+            ex, ey = embedded_coords.x, embedded_coords.y
+            
+            self.min_x = min(self.min_x, ex)
+            self.max_x = max(self.max_x, ex)
+            
+            self.min_y = min(self.min_y, ey)
+            self.max_y = max(self.max_y, ey)
+            
+            terrain = tile.sections[direction]
+            self.set_square(embedded_coords, terrain)
+    
+    def add_chunk(self, chunk):
+        """
+        Add a chunk of a chunked map, checking that the tiles in it
+        match each other. Only the chunk is kept, not its squares.
+        """
+        exs, eys, codes = get_chunk_squares(chunk)
+        
+        #Squares shared by tiles in the chunk have one terrain
+        keys = maps.coord_key(exs, eys)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        codes = codes[order]
+        
+        mismatched = np.flatnonzero((keys[1:] == keys[:-1])
+                                    & (codes[1:] != codes[:-1]))
+        if len(mismatched):
+            i = mismatched[0]
+            raise ValueError('mismatched terrains at {}: {}, {}'
+                             .format(maps.CoordPair(int(maps.key_x(keys[i])),
+                                                    int(maps.key_y(keys[i]))),
+                                     maps.TERRAINS.terrain(int(codes[i])),
+                                     maps.TERRAINS.terrain(int(codes[i + 1]))))
+        
+        #Update mininum and maximum values
+        self.min_x = min(self.min_x, int(exs.min()))
+        self.max_x = max(self.max_x, int(exs.max()))
+        
+        self.min_y = min(self.min_y, int(eys.min()))
+        self.max_y = max(self.max_y, int(eys.max()))
+        
+        self.chunks.append(chunk)
+    
+    def iter_squares(self):
+        """
+        Yield (embedded coords, terrain) for the squares to draw,
+        a chunk at a time for a chunked map.
+        """
+        yield from self.squares.items()
+        
+        for chunk in self.chunks:
+            exs, eys, codes = get_chunk_squares(chunk)
+            
+            #Each square once, though it's in up to four tiles
+            _, first = np.unique(maps.coord_key(exs, eys), return_index=True)
+            exs, eys, codes = exs[first], eys[first], codes[first]
+            
+            terrains = [maps.TERRAINS.terrain(code) for code in codes.tolist()]
+            
+            for ex, ey, terrain in zip(exs.tolist(), eys.tolist(), terrains):
+                yield maps.CoordPair(ex, ey), terrain
+    
     def get_image(self, colors_from_terrains, square_size):
         im_width = self.width * square_size
         im_height = self.height * square_size
@@ -87,7 +171,7 @@ class Map:
         image = Image.new('RGB', (im_width, im_height), 'white')
         draw = ImageDraw.Draw(image)
         
-        for coords, terrain in self.squares.items():
+        for coords, terrain in self.iter_squares():
             x = (coords.x - self.min_x) * square_size
             y = (coords.y - self.min_y) * square_size
             
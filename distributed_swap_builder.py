@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Dec  5 09:37:50 2021
+
+@author: rober
+"""
+
+import random
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import maps
+import tile_sampler
+import topology
+import parallel_builder
+import instruments
+from swap_map_builder import match_tiles
+
+#A block is filled in rather than resampled once this fraction of it
+#is left, as with SwapMapBuilder's default stop_amount
+STOP_FRACTION = 1 / 16
+
+#A block is filled in after this many resamples, whatever is left
+MAX_RESAMPLES = 100
+
+#The sampler and shared arrays each worker process uses
+WORKER_SAMPLER = None
+WORKER_MEMORIES = None
+WORKER_ARRAYS = None
+
+#Freed shared memory whose arrays are still seen somewhere,
+#as (memory, weak reference to the array)
+LINGERING_MEMORIES = list()
+
+class SharedArrays:
+    """
+    Numpy arrays kept in shared memory, so worker processes can attach
+    to them by name rather than having them pickled.
+    
+    arrays is a dict from names to the arrays in shared memory,
+    and specs says how to attach to them, for attach_arrays.
+    """
+    def __init__(self, arrays):
+        self.memories = list()
+        self.array_refs = list()
+        self.arrays = dict()
+        self.specs = dict()
+        
+        for name, array in arrays.items():
+            memory = shared_memory.SharedMemory(create=True,
+                                                size=max(array.nbytes, 1))
+            self.memories.append(memory)
+            
+            shared = np.ndarray(array.shape, array.dtype, buffer=memory.buf)
+            shared[...] = array
+            
+            self.arrays[name] = shared
+            self.array_refs.append(weakref.ref(shared))
+            self.specs[name] = (memory.name, array.shape, array.dtype.str)
+    
+    def close(self):
+        """
+        Free the shared memory, so nothing new can attach to it.
+        
+        Views of the arrays kept elsewhere, like in the traceback of an
+        error from a block, keep their memory mapped until they go,
+        rather than being left pointing at nothing or making this raise
+        BufferError over the error.
+        """
+        #Drop our own arrays first, so only views kept elsewhere are left
+        self.arrays.clear()
+        
+        for memory, array_ref in zip(self.memories, self.array_refs):
+            memory.unlink()
+            LINGERING_MEMORIES.append((memory, array_ref))
+        
+        self.memories.clear()
+        self.array_refs.clear()
+        
+        close_unused_memories()
+
+def close_unused_memories():
+    """
+    Close the freed shared memory whose arrays nothing sees any more.
+    """
+    still_used = list()
+    for memory, array_ref in LINGERING_MEMORIES:
+        if array_ref() is None:
+            memory.close()
+        else:
+            still_used.append((memory, array_ref))
+    
+    LINGERING_MEMORIES[:] = still_used
+
+def attach_arrays(specs):
+    """
+    Return the shared memory and arrays described by SharedArrays.specs.
+    """
+    memories = list()
+    arrays = dict()
+    
+    for name, (memory_name, shape, dtype) in specs.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        memories.append(memory)
+        
+        arrays[name] = np.ndarray(shape, dtype, buffer=memory.buf)
+    
+    return memories, arrays
+
+def init_worker(terrains, sampler, specs):
+    """
+    Set up a worker process to swap blocks.
+    """
+    global WORKER_SAMPLER, WORKER_ARRAYS, WORKER_MEMORIES
+    
+    parallel_builder.check_terrain_codes(terrains)
+    
+    WORKER_SAMPLER = sampler
+    
+    #The memories have to stay open as long as the arrays are used
+    WORKER_MEMORIES, WORKER_ARRAYS = attach_arrays(specs)
+
+def get_blocks(region, block_size):
+    """
+    Split the inner cells of a region into block_size squares.
+    
+    Return:
+        block_cells:
+            The indices of the inner cells, block by block.
+        
+        bounds:
+            The (start, stop) of each block in block_cells.
+        
+        colours:
+            The colour of each block. No two blocks of the same colour
+            have cells next to each other.
+    """
+    inner = region.inner
+    block_xs = (region.xs[inner] - region.min_x) // block_size
+    block_ys = (region.ys[inner] - region.min_y) // block_size
+    
+    keys = block_xs * (block_ys.max() + 1) + block_ys
+    order = np.argsort(keys, kind='stable')
+    
+    _, starts, counts = np.unique(keys[order], return_index=True,
+                                  return_counts=True)
+    
+    bounds = list(zip(starts.tolist(), (starts + counts).tolist()))
+    colours = ((block_xs + block_ys) % 2)[order][starts].tolist()
+    
+    return inner[order], bounds, colours
+
+def count_mismatched(packed, cells, neighbours):
+    """
+    Return the number of cells with a side that doesn't match,
+    given their rows of the neighbour table.
+    """
+    mismatched = topology.get_mismatched_cells(packed[cells], packed,
+                                               neighbours)
+    return int(np.count_nonzero(mismatched))
+
+def solve_block(packed, cells, neighbours, colours, sampler, rng):
+    """
+    Rearrange the tiles of some cells, as in SwapMapBuilder's batched
+    mode, until they match each other and the tiles around them.
+    The tiles around them stay put.
+    
+    Parameters:
+        packed:
+            The packed tile of every cell of the board, which is changed
+            in place.
+        
+        cells:
+            The indices of the cells to change.
+        
+        neighbours, colours:
+            The rows of the neighbour table and the checkerboard colours
+            of the cells.
+    
+    Returns a dict of counts for the builder's instruments.
+    """
+    counts = {'iterations': 0,
+              'swaps_accepted': 0,
+              'swaps_rejected': 0,
+              'resampled_tiles': 0,
+              'filled_in_tiles': 0}
+    
+    stop_amount = round(len(cells) * STOP_FRACTION)
+    eligible = np.ones(len(cells), dtype=bool)
+    
+    for _ in range(MAX_RESAMPLES + 1):
+        #Do iterations until nothing happens
+        num_eligible = int(np.count_nonzero(eligible))
+        while True:
+            for colour in (0, 1):
+                picked = np.flatnonzero(eligible & (colours == colour))
+                if not len(picked):
+                    continue
+                
+                picked_cells = cells[picked]
+                needed = topology.get_needed_tiles(packed,
+                                                   neighbours[picked])
+                new_tiles, satisfied = match_tiles(packed[picked_cells],
+                                                   needed, rng)
+                
+                packed[picked_cells] = new_tiles
+                eligible[picked[satisfied]] = False
+                
+                num_satisfied = int(np.count_nonzero(satisfied))
+                counts['swaps_accepted'] += num_satisfied
+                counts['swaps_rejected'] += len(picked) - num_satisfied
+            
+            counts['iterations'] += 1
+            
+            if not count_mismatched(packed, cells, neighbours):
+                return counts
+            
+            new_num_eligible = int(np.count_nonzero(eligible))
+            if new_num_eligible == num_eligible:
+                break
+            
+            num_eligible = new_num_eligible
+        
+        if num_eligible <= stop_amount:
+            break
+        
+        picked_cells = cells[eligible]
+        packed[picked_cells] = sampler.random_packed(len(picked_cells))
+        counts['resampled_tiles'] += len(picked_cells)
+    
+    # Put the tiles we need in, one colour at a time, so each cell
+    # gets what it needs after its neighbours are filled in
+    for colour in (0, 1):
+        picked = np.flatnonzero(eligible & (colours == colour))
+        
+        needed = topology.get_needed_tiles(packed, neighbours[picked])
+        packed[cells[picked]] = needed
+        
+        counts['filled_in_tiles'] += len(picked)
+    
+    return counts
+
+def swap_block(bounds, seed, arrays=None, sampler=None):
+    """
+    Solve one block of the shared board, in a worker process or not.
+    """
+    if arrays is None:
+        arrays = WORKER_ARRAYS
+    if sampler is None:
+        sampler = WORKER_SAMPLER
+    
+    random.seed(seed)
+    rng = tile_sampler.get_numpy_rng()
+    
+    start, stop = bounds
+    cells = arrays['block_cells'][start:stop]
+    
+    return solve_block(arrays['packed'],
+                       cells,
+                       arrays['neighbours'][cells],
+                       arrays['colours'][cells],
+                       sampler,
+                       rng)
+
+class DistributedSwapMapBuilder:
+    """
+    Makes a map of a region like SwapMapBuilder's batched mode,
+    with the inner cells split into block_size squares that are solved
+    in num_workers processes.
+    
+    The blocks are coloured like a checkerboard. Each round solves every
+    block of one colour, then every block of the other, each against
+    the latest tiles in the one-cell halo around it. Blocks of a colour
+    don't touch, so they can be solved at the same time.
+    Rounds go on until the whole board matches.
+    
+    The board lives in shared memory, which the workers attach to.
+    Each block gets its own seed from random, so the map doesn't depend
+    on num_workers.
+    """
+    def __init__(self,
+                 region,
+                 tile_map,
+                 border_sampler,
+                 interior_sampler,
+                 block_size,
+                 num_workers=1,
+                 observer=None):
+        self.region = region
+        self.tile_map = tile_map
+        self.border_sampler = border_sampler
+        self.interior_sampler = interior_sampler
+        self.block_size = block_size
+        self.num_workers = num_workers
+        
+        self.instruments = instruments.Instruments(type(self).__name__,
+                                                   observer)
+    
+    def get_initial_board(self):
+        """
+        Return the packed tiles of a board with sampled border and
+        inner tiles, with an extra 0 at the end for off the board.
+        The border tiles are matched to each other, as the blocks only
+        change inner cells.
+        """
+        border = self.region.border
+        inner = self.region.inner
+        
+        packed = np.zeros(self.region.num_cells + 1, dtype=np.int64)
+        packed[border] = self.border_sampler.random_packed(len(border))
+        packed[inner] = self.interior_sampler.random_packed(len(inner))
+        
+        self.region.match_border(packed, self.tile_map.disp_function)
+        
+        return packed
+    
+    def solve_blocks(self, pool, shared, bounds, seeds):
+        """
+        Solve the given blocks, which mustn't touch, and count what
+        happened.
+        """
+        if pool is None:
+            results = [swap_block(block_bounds, seed, shared.arrays,
+                                  self.interior_sampler)
+                       for block_bounds, seed in zip(bounds, seeds)]
+        else:
+            results = list(pool.map(swap_block, bounds, seeds))
+        
+        for counts in results:
+            for name, count in counts.items():
+                self.instruments.count(name, count)
+    
+    def make_map(self, max_rounds=10):
+        """
+        Fill the region of the map, sending a round event with the
+        number of mismatched inner cells after each round.
+        """
+        region = self.region
+        board = region.get_topology(self.tile_map.disp_function)
+        all_cells = np.arange(region.num_cells)
+        
+        with self.instruments.phase('make_board'):
+            packed = self.get_initial_board()
+            block_cells, bounds, colours = get_blocks(region,
+                                                      self.block_size)
+        
+        seed_rng = random.Random(random.getrandbits(64))
+        
+        #Keep the caller's random state
+        state = random.getstate()
+        
+        shared = SharedArrays({'packed': packed,
+                               'neighbours': board.neighbours,
+                               'colours': region.colours,
+                               'block_cells': block_cells})
+        pool = None
+        
+        try:
+            if self.num_workers > 1:
+                terrains = maps.TERRAINS.terrains_from_codes[1:]
+                pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                           initializer=init_worker,
+                                           initargs=(terrains,
+                                                     self.interior_sampler,
+                                                     shared.specs))
+            
+            for i in range(1, max_rounds + 1):
+                seeds = [seed_rng.getrandbits(64) for _ in bounds]
+                
+                with self.instruments.phase('swapping'):
+                    for colour in (0, 1):
+                        picked = [j for j, block_colour in enumerate(colours)
+                                  if block_colour == colour]
+                        
+                        self.solve_blocks(pool,
+                                          shared,
+                                          [bounds[j] for j in picked],
+                                          [seeds[j] for j in picked])
+                
+                #Every edge is checked, not just those of inner cells,
+                #before the board counts as done
+                num_mismatched = count_mismatched(shared.arrays['packed'],
+                                                  all_cells,
+                                                  board.neighbours)
+                
+                self.instruments.count('rounds')
+                self.instruments.emit('round',
+                                      round=i,
+                                      mismatched=num_mismatched,
+                                      blocks=len(bounds))
+                
+                if not num_mismatched:
+                    break
+            else:
+                raise ValueError('board doesn\'t match after {} rounds'
+                                 .format(max_rounds))
+            
+            packed = shared.arrays['packed'].copy()
+        finally:
+            random.setstate(state)
+            
+            if pool is not None:
+                pool.shutdown()
+            
+            shared.close()
+        
+        #Save what we have to the map
+        with self.instruments.phase('save'):
+            self.tile_map.add_tiles({coords: maps.Tile.from_packed(tile)
+                                     for coords, tile
+                                     in zip(region.coords_list,
+                                            packed.tolist())})
\ No newline at end of file
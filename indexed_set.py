@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov 14 09:27:03 2021
+
+@author: rober
+"""
+
+import random
+from collections.abc import MutableSet
+
+class IndexedSet(MutableSet):
+    """
+    A set that can also pick a random item in constant time.
+    
+    The items are kept in a list, with a dict from each item to its
+    position. Removing an item moves the last item into its place,
+    so adding, removing and picking are all constant time.
+    """
+    def __init__(self, items=()):
+        self.items = list()
+        self.positions = dict()
+        
+        for item in items:
+            self.add(item)
+    
+    def __contains__(self, item):
+        return item in self.positions
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __repr__(self):
+        return 'IndexedSet({})'.format(self.items)
+    
+    def add(self, item):
+        if item in self.positions:
+            return
+        
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+    
+    def discard(self, item):
+        pos = self.positions.pop(item, None)
+        if pos is None:
+            return
+        
+        #Move the last item into the gap
+        last = self.items.pop()
+        if pos < len(self.items):
+            self.items[pos] = last
+            self.positions[last] = pos
+    
+    def remove(self, item):
+        if item not in self.positions:
+            raise KeyError(item)
+        
+        self.discard(item)
+    
+    def choice(self, exclude=None):
+        """
+        Return a random item, other than exclude if it's given.
+        """
+        pos = self.positions.get(exclude) if exclude is not None else None
+        
+        if pos is None:
+            return random.choice(self.items)
+        
+        if len(self.items) < 2:
+            raise IndexError('no items other than {}'.format(exclude))
+        
+        #Pick from every position but the excluded one
+        i = random.randrange(len(self.items) - 1)
+        if i >= pos:
+            i += 1
+        
+        return self.items[i]
+    
+    def copy(self):
+        return IndexedSet(self.items)
\ No newline at end of file
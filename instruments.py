@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Dec  4 10:22:09 2021
+
+@author: rober
+"""
+
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class Instruments:
+    """
+    Collects what a builder does: the wall time of each phase,
+    running counts, and events like the end of an iteration.
+    
+    observer is called with (event, data) as each event comes in,
+    where event is a string and data a dict of numbers.
+    Phases send a 'phase' event when they end.
+    The last record events are kept in events; by default none are,
+    and with no observer an event costs one check.
+    
+    Builders count things in the hot loops with plain ints, and only
+    hand the totals over here, so this costs next to nothing per swap.
+    """
+    def __init__(self, name, observer=None, record=0):
+        self.name = name
+        self.observer = observer
+        self.record = record
+        
+        self.phase_seconds = dict()
+        self.phase_calls = dict()
+        self.counts = dict()
+        self.events = deque(maxlen=record)
+    
+    def emit(self, event, **data):
+        """
+        Pass an event to the observer, and keep it if events are recorded.
+        """
+        if self.observer is None and not self.record:
+            return
+        
+        if self.record:
+            self.events.append([event, data])
+        
+        if self.observer is not None:
+            self.observer(event, data)
+    
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + int(amount)
+    
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the body of a with statement as the named phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+    
+    def add_phase(self, name, seconds):
+        """
+        Add a run of the named phase that took the given time.
+        """
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+        self.phase_calls[name] = self.phase_calls.get(name, 0) + 1
+        
+        self.emit('phase', phase=name, seconds=seconds)
+    
+    def report(self):
+        """
+        Return everything collected, as a dict that can go to JSON.
+        """
+        return {'builder': self.name,
+                'phases': {name: {'seconds': seconds,
+                                  'calls': self.phase_calls[name]}
+                           for name, seconds in self.phase_seconds.items()},
+                'counts': dict(self.counts),
+                'events': [[event, dict(data)]
+                           for event, data in self.events]}
+    
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+class EventLog:
+    """
+    An observer that keeps the events it's sent,
+    or the last max_events of them.
+    """
+    def __init__(self, max_events=None):
+        self.events = deque(maxlen=max_events)
+    
+    def __call__(self, event, data):
+        self.events.append([event, data])
+
+def print_observer(event, data):
+    """
+    An observer that prints progress, as the builders used to.
+    """
+    if event == 'phase':
+        return
+    
+    print('{}: {}'.format(event,
+                          ', '.join('{} {}'.format(key, value)
+                                    for key, value in data.items())))
\ No newline at end of file
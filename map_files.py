@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov  7 14:20:31 2021
+
+@author: rober
+"""
+
+import json
+import struct
+
+import numpy as np
+
+import maps
+import dense_maps
+import topology
+
+#The file layout is:
+#   the prefix: MAGIC, the format version and the header length
+#   the header: JSON with the terrain table, topology and bounding box
+#   the packed tiles, as a little-endian uint32 width by height grid
+#   the occupancy bitmap, each row of the grid packed into bytes
+#Both arrays start on a multiple of ALIGNMENT bytes.
+MAGIC = b'MAPGEN\x00\x00'
+VERSION = 1
+
+PREFIX_FORMAT = '<8sII'
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+
+ALIGNMENT = 64
+
+CODES_DTYPE = np.dtype('<u4')
+
+#Terrains have to survive being written as JSON
+SAVABLE_TERRAIN_TYPES = (str, int, float, bool)
+
+def aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def describe_disp_function(disp_function):
+    """
+    Return a JSON-friendly description of a displacement function.
+    """
+    if disp_function is maps.boundless_disp:
+        return {'type': 'boundless'}
+    
+    torus_size = getattr(disp_function, 'torus_size', None)
+    if torus_size is not None:
+        return {'type': 'torus_disp',
+                'width': torus_size[0],
+                'height': torus_size[1]}
+    
+    description = getattr(disp_function, 'description', None)
+    if description is not None:
+        return {'type': 'topology', 'topology': description}
+    
+    raise ValueError('can\'t save disp_function: {}'.format(disp_function))
+
+def get_disp_function(description):
+    """
+    Return the displacement function with the given description.
+    """
+    if description['type'] == 'boundless':
+        return maps.boundless_disp
+    
+    if description['type'] == 'torus_disp':
+        return maps.get_torus_disp(description['width'],
+                                   description['height'])
+    
+    if description['type'] == 'topology':
+        return topology.get_topology(description['topology'])
+    
+    raise ValueError('unknown disp_function: {}'.format(description))
+
+def get_map_arrays(tile_map):
+    """
+    Return the x, y and packed tile arrays for any kind of map.
+    """
+    if hasattr(tile_map, 'tile_arrays'):
+        return tile_map.tile_arrays()
+    
+    return maps.get_tile_arrays(tile_map.tiles)
+
+def save_map(tile_map, path):
+    """
+    Save any kind of map to the given path.
+    The bounding box of the map is saved as a dense grid.
+    """
+    xs, ys, packed = get_map_arrays(tile_map)
+    
+    if len(xs):
+        min_x, min_y = int(xs.min()), int(ys.min())
+        width = int(xs.max()) - min_x + 1
+        height = int(ys.max()) - min_y + 1
+    else:
+        min_x, min_y, width, height = 0, 0, 0, 0
+    
+    #Only the terrains up to the highest code used are needed
+    max_code = 0
+    for direction in maps.DIRECTIONS:
+        codes = maps.get_section_codes(packed, direction)
+        if len(codes):
+            max_code = max(max_code, int(codes.max()))
+    
+    terrains = maps.TERRAINS.terrains_from_codes[1:max_code+1]
+    for terrain in terrains:
+        if not isinstance(terrain, SAVABLE_TERRAIN_TYPES):
+            raise ValueError('can\'t save terrain: {}'.format(terrain))
+    
+    #Make the grids
+    codes = np.zeros((width, height), dtype=CODES_DTYPE)
+    occupied = np.zeros((width, height), dtype=bool)
+    codes[xs - min_x, ys - min_y] = packed
+    occupied[xs - min_x, ys - min_y] = True
+    bits = np.packbits(occupied, axis=1)
+    
+    #Lay out the file
+    header = {'terrains': terrains,
+              'topology': describe_disp_function(tile_map.disp_function),
+              'min_x': min_x,
+              'min_y': min_y,
+              'width': width,
+              'height': height,
+              'num_tiles': len(xs)}
+    
+    header_bytes = json.dumps(header).encode('utf-8')
+    codes_offset = aligned(PREFIX_SIZE + len(header_bytes))
+    bits_offset = aligned(codes_offset + codes.nbytes)
+    
+    with open(path, 'wb') as file:
+        file.write(struct.pack(PREFIX_FORMAT, MAGIC, VERSION,
+                               len(header_bytes)))
+        file.write(header_bytes)
+        
+        file.seek(codes_offset)
+        file.write(codes.tobytes())
+        
+        file.seek(bits_offset)
+        file.write(bits.tobytes())
+
+class MapFile:
+    """
+    A saved map, opened without reading the tiles.
+    The packed tiles and the occupancy bitmap are memory-mapped,
+    so only the parts that get used are read.
+    """
+    def __init__(self, path):
+        self.path = path
+        
+        with open(path, 'rb') as file:
+            prefix = file.read(PREFIX_SIZE)
+            if len(prefix) < PREFIX_SIZE:
+                raise ValueError('not a map file: {}'.format(path))
+            
+            magic, version, header_length = struct.unpack(PREFIX_FORMAT,
+                                                          prefix)
+            if magic != MAGIC:
+                raise ValueError('not a map file: {}'.format(path))
+            
+            if version != VERSION:
+                raise ValueError('unsupported map file version: {}'
+                                 .format(version))
+            
+            header = json.loads(file.read(header_length).decode('utf-8'))
+        
+        self.terrains = header['terrains']
+        self.disp_function = get_disp_function(header['topology'])
+        self.min_x = header['min_x']
+        self.min_y = header['min_y']
+        self.width = header['width']
+        self.height = header['height']
+        self.num_tiles = header['num_tiles']
+        
+        codes_offset = aligned(PREFIX_SIZE + header_length)
+        bits_offset = aligned(codes_offset
+                              + self.width * self.height
+                              * CODES_DTYPE.itemsize)
+        bits_shape = (self.width, -(-self.height // 8))
+        
+        if self.width and self.height:
+            #Copy-on-write, so maps loaded from the file
+            #can be changed without changing the file
+            self.codes = np.memmap(path, dtype=CODES_DTYPE, mode='c',
+                                   offset=codes_offset,
+                                   shape=(self.width, self.height))
+            self.bits = np.memmap(path, dtype=np.uint8, mode='r',
+                                  offset=bits_offset, shape=bits_shape)
+        else:
+            self.codes = np.zeros((self.width, self.height),
+                                  dtype=CODES_DTYPE)
+            self.bits = np.zeros(bits_shape, dtype=np.uint8)
+        
+        #The codes in the file are the codes the terrains had when it
+        #was saved, which might not be their codes now
+        self.code_table = np.arange(maps.TERRAIN_MASK + 1, dtype=np.uint32)
+        for file_code, terrain in enumerate(self.terrains, 1):
+            self.code_table[file_code] = maps.TERRAINS.code(terrain)
+        
+        self.same_codes = np.array_equal(self.code_table,
+                                         np.arange(maps.TERRAIN_MASK + 1))
+    
+    def translate(self, codes):
+        """
+        Return packed tiles from the file with the current terrain codes.
+        """
+        if self.same_codes:
+            return codes
+        
+        codes = np.ascontiguousarray(codes, dtype=CODES_DTYPE)
+        sections = codes.view(np.uint8).reshape(codes.shape + (4,))
+        
+        return self.code_table[sections].astype(np.uint8)\
+                   .view(CODES_DTYPE).reshape(codes.shape)
+    
+    def read_region(self, min_x, min_y, width, height):
+        """
+        Return the packed tiles and the occupancy in the given rectangle.
+        Only the pages of the file covering the rectangle are read.
+        """
+        codes = np.zeros((width, height), dtype=np.uint32)
+        occupied = np.zeros((width, height), dtype=bool)
+        
+        #The part of the rectangle inside the saved grid
+        gx_0 = max(min_x - self.min_x, 0)
+        gy_0 = max(min_y - self.min_y, 0)
+        gx_1 = min(min_x + width - self.min_x, self.width)
+        gy_1 = min(min_y + height - self.min_y, self.height)
+        
+        if gx_0 >= gx_1 or gy_0 >= gy_1:
+            return codes, occupied
+        
+        rx = gx_0 - (min_x - self.min_x)
+        ry = gy_0 - (min_y - self.min_y)
+        
+        region_codes = self.translate(self.codes[gx_0:gx_1, gy_0:gy_1])
+        codes[rx:rx+gx_1-gx_0, ry:ry+gy_1-gy_0] = region_codes
+        
+        #Only unpack the bytes of the bitmap that cover the rectangle
+        bits = self.bits[gx_0:gx_1, gy_0 // 8:-(-gy_1 // 8)]
+        region_occupied = np.unpackbits(bits, axis=1).astype(bool)
+        start = gy_0 % 8
+        region_occupied = region_occupied[:, start:start+gy_1-gy_0]
+        occupied[rx:rx+gx_1-gx_0, ry:ry+gy_1-gy_0] = region_occupied
+        
+        return codes, occupied
+    
+    def read_arrays(self, xs, ys):
+        """
+        Return the packed tiles at the given coordinates, and a mask of
+        which coordinates have tiles, like DenseTileMap.lookup_arrays.
+        Only the pages of the file with the coordinates are read.
+        """
+        gxs = xs - self.min_x
+        gys = ys - self.min_y
+        in_bounds = (0 <= gxs) & (gxs < self.width)\
+                    & (0 <= gys) & (gys < self.height)
+        gxs = gxs[in_bounds]
+        gys = gys[in_bounds]
+        
+        packed = np.zeros(len(xs), dtype=np.int64)
+        occupied = np.zeros(len(xs), dtype=bool)
+        
+        #The bitmap is packed big end first, as by np.packbits
+        bytes_at = self.bits[gxs, gys >> 3]
+        occupied[in_bounds] = (bytes_at >> (7 - (gys & 7))) & 1
+        packed[in_bounds] = self.translate(self.codes[gxs, gys])
+        
+        return packed, occupied
+    
+    def get_packed(self, x, y):
+        """
+        Return the packed tile at (x, y), or None if there's no tile there.
+        """
+        gx = x - self.min_x
+        gy = y - self.min_y
+        
+        if not (0 <= gx < self.width and 0 <= gy < self.height):
+            return None
+        
+        if not (int(self.bits[gx, gy >> 3]) >> (7 - (gy & 7))) & 1:
+            return None
+        
+        return int(self.translate(self.codes[gx:gx+1, gy])[0])
+    
+    def get_occupied(self):
+        """
+        Return the whole occupancy grid.
+        """
+        occupied = np.unpackbits(self.bits, axis=1, count=self.height)
+        return occupied.astype(bool)
+
+class MappedTileMap(dense_maps.DenseTileMap):
+    """
+    A DenseTileMap that reads its tiles from a MapFile as they're
+    asked for, so opening a map is instant whatever its size, and
+    lookups only touch the pages of the file they need.
+    
+    The occupancy stays a packed bitmap, and terrain codes are
+    translated as they're read. The first change to the map unpacks
+    the whole grid into the arrays of a plain DenseTileMap.
+    """
+    #Rows of the grid read at a time when going over every tile
+    BLOCK_ROWS = 256
+    
+    def __init__(self, map_file):
+        dense_maps.DenseTileMap.__init__(self, map_file.disp_function, 1, 1)
+        
+        self.map_file = map_file
+        
+        #codes only gives the shape until the map is unpacked
+        self.codes = map_file.codes
+        self.occupied = None
+        self.min_x = map_file.min_x
+        self.min_y = map_file.min_y
+        self.num_tiles = map_file.num_tiles
+    
+    def unpack(self):
+        """
+        Read the whole grid in, so the map can be changed.
+        The codes stay memory-mapped if they don't need translating.
+        """
+        if self.map_file is None:
+            return
+        
+        map_file = self.map_file
+        self.codes = map_file.translate(map_file.codes)
+        self.occupied = map_file.get_occupied()
+        self.map_file = None
+    
+    def get_packed(self, x, y):
+        if self.map_file is None:
+            return dense_maps.DenseTileMap.get_packed(self, x, y)
+        
+        return self.map_file.get_packed(x, y)
+    
+    def lookup_arrays(self, xs, ys):
+        if self.map_file is None:
+            return dense_maps.DenseTileMap.lookup_arrays(self, xs, ys)
+        
+        return self.map_file.read_arrays(xs, ys)
+    
+    def tile_arrays(self):
+        if self.map_file is None:
+            return dense_maps.DenseTileMap.tile_arrays(self)
+        
+        #A block of rows at a time, so the whole grid is never unpacked
+        map_file = self.map_file
+        arrays = [np.zeros(0, dtype=np.int64) for _ in range(3)]
+        for gx in range(0, self.width, self.BLOCK_ROWS):
+            codes, occupied = map_file.read_region(self.min_x + gx,
+                                                   self.min_y,
+                                                   self.BLOCK_ROWS,
+                                                   self.height)
+            gxs, gys = np.nonzero(occupied)
+            
+            arrays[0] = np.concatenate((arrays[0], gxs + self.min_x + gx))
+            arrays[1] = np.concatenate((arrays[1], gys + self.min_y))
+            arrays[2] = np.concatenate((arrays[2],
+                                        codes[gxs, gys].astype(np.int64)))
+        
+        return tuple(arrays)
+    
+    def find_mismatches(self):
+        if self.map_file is None:
+            return dense_maps.DenseTileMap.find_mismatches(self)
+        
+        return dense_maps.PackedTileMap.find_mismatches(self)
+    
+    def grow_to(self, coords):
+        self.unpack()
+        dense_maps.DenseTileMap.grow_to(self, coords)
+    
+    def store_tile(self, x, y, packed):
+        self.unpack()
+        dense_maps.DenseTileMap.store_tile(self, x, y, packed)
+    
+    def store_arrays(self, xs, ys, packed):
+        self.unpack()
+        dense_maps.DenseTileMap.store_arrays(self, xs, ys, packed)
+    
+    def clear_tile(self, x, y):
+        self.unpack()
+        dense_maps.DenseTileMap.clear_tile(self, x, y)
+
+def load_map(path):
+    """
+    Load a saved map as a MappedTileMap, a DenseTileMap that reads the
+    file as it's used.
+    """
+    return MappedTileMap(MapFile(path))
+
+def load_tile_map(path):
+    """
+    Load a saved map as a dict-backed maps.TileMap.
+    """
+    dense_map = load_map(path)
+    
+    tile_map = maps.TileMap(dense_map.disp_function)
+    tile_map.tiles.update(dense_map.iter_tiles())
+    
+    return tile_map
\ No newline at end of file
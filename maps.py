@@ -6,28 +6,56 @@ Created on Fri Oct 15 12:59:50 2021
 """
 
 from enum import Enum
+from types import MappingProxyType
+
+import numpy as np
+
+#Packed coordinate keys: x in the high bits, y offset into the low bits
+#every coordinate pair with |x|, |y| < 2**31 gets its own key
+COORD_BITS = 32
+COORD_MASK = (1 << COORD_BITS) - 1
+COORD_OFFSET = 1 << (COORD_BITS - 1)
+
+def coord_key(x, y):
+    """
+    Return the packed integer key for the given coordinates.
+    """
+    return (x << COORD_BITS) + (y + COORD_OFFSET)
+
+def key_x(key):
+    return key >> COORD_BITS
+
+def key_y(key):
+    return (key & COORD_MASK) - COORD_OFFSET
 
 class CoordPair:
     """
     A single coordinate pair.
     """
+    __slots__ = ('x', 'y', 'key')
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
         
-        self._hash = x<<16 ^ y
+        #Same as coord_key(x, y), without the function call
+        self.key = (x << COORD_BITS) + (y + COORD_OFFSET)
+    
+    @classmethod
+    def from_key(cls, key):
+        return cls(key_x(key), key_y(key))
     
     def __eq__(self, other):
         if not isinstance(other, CoordPair):
             return False
         
-        return self.x == other.x and self.y == other.y
+        return self.key == other.key
     
     def __neq__(self, other):
         return not(self == other)
     
     def __hash__(self):
-        return self._hash
+        return self.key
     
     def __str__(self):
         return '({}, {})'.format(self.x, self.y)
@@ -45,43 +73,134 @@ OPPOSITES = {Direction.RIGHT: Direction.LEFT,
              Direction.UP: Direction.DOWN,
              Direction.DOWN: Direction.UP}
 
+#The order of the sections in a tile, and in its packed form
+DIRECTIONS = (Direction.RIGHT, Direction.UP, Direction.LEFT, Direction.DOWN)
+
+SECTION_INDICES = {direction: i for i, direction in enumerate(DIRECTIONS)}
+
+#Each section of a packed tile takes TERRAIN_BITS bits
+TERRAIN_BITS = 8
+TERRAIN_MASK = (1 << TERRAIN_BITS) - 1
+PACKED_MASK = (1 << (TERRAIN_BITS * 4)) - 1
+
+SECTION_SHIFTS = {direction: SECTION_INDICES[direction] * TERRAIN_BITS
+                  for direction in DIRECTIONS}
+
+#The code standing in for None in descriptions
+WILDCARD = 0
+
+class TerrainRegistry:
+    """
+    Gives each terrain label a small integer code.
+    """
+    def __init__(self):
+        self.codes_from_terrains = {None: WILDCARD}
+        self.terrains_from_codes = [None]
+    
+    def code(self, terrain):
+        """
+        Return the code for the given terrain, giving it one if it has none.
+        """
+        code = self.codes_from_terrains.get(terrain)
+        if code is None:
+            code = len(self.terrains_from_codes)
+            if code > TERRAIN_MASK:
+                raise ValueError('too many terrains: {}'.format(terrain))
+            
+            self.codes_from_terrains[terrain] = code
+            self.terrains_from_codes.append(terrain)
+        
+        return code
+    
+    def terrain(self, code):
+        return self.terrains_from_codes[code]
+
+TERRAINS = TerrainRegistry()
+
+def pack_codes(right, up, left, down):
+    """
+    Return the packed form of a tile with the given terrain codes.
+    """
+    return right | (up << TERRAIN_BITS) | (left << (2 * TERRAIN_BITS))\
+                 | (down << (3 * TERRAIN_BITS))
+
+def unpack_codes(packed):
+    """
+    Return the four terrain codes in a packed tile.
+    """
+    return tuple((packed >> (i * TERRAIN_BITS)) & TERRAIN_MASK
+                 for i in range(4))
+
+def rotate_packed(packed, rotation):
+    """
+    Return the packed tile rotated 90 degrees counterclockwise rotation times.
+    """
+    shift = (rotation % 4) * TERRAIN_BITS
+    return ((packed << shift) | (packed >> (4 * TERRAIN_BITS - shift)))\
+           & PACKED_MASK
+
+#All the tiles that have been made, by packed form
+TILES_FROM_PACKED = dict()
+
 class Tile:
     """
     A tile.
+    
+    Tiles are immutable and interned: equal tiles are the same object.
     """
-    def __init__(self, right, up, left, down):
-        self.sections = {Direction.RIGHT: right,
-                         Direction.UP: up,
-                         Direction.LEFT: left,
-                         Direction.DOWN: down}
+    __slots__ = ('packed', 'codes', 'sections', '_rotations')
+    
+    def __new__(cls, right, up, left, down):
+        packed = pack_codes(TERRAINS.code(right),
+                            TERRAINS.code(up),
+                            TERRAINS.code(left),
+                            TERRAINS.code(down))
+        
+        tile = TILES_FROM_PACKED.get(packed)
+        if tile is None:
+            tile = cls._make(packed)
+        
+        return tile
+    
+    @classmethod
+    def _make(cls, packed):
+        tile = object.__new__(cls)
+        tile.packed = packed
+        tile.codes = unpack_codes(packed)
+        
+        terrains = [TERRAINS.terrain(code) for code in tile.codes]
+        tile.sections = MappingProxyType(dict(zip(DIRECTIONS, terrains)))
+        tile._rotations = None
+        
+        TILES_FROM_PACKED[packed] = tile
+        return tile
+    
+    @classmethod
+    def from_packed(cls, packed):
+        """
+        Return the tile with the given packed form.
+        """
+        tile = TILES_FROM_PACKED.get(packed)
+        if tile is None:
+            tile = cls._make(packed)
         
-        # self._hash = 17
-        # self._hash = (self._hash + hash(right)) * 31
-        # self._hash = (self._hash + hash(up)) * 31
-        # self._hash = (self._hash + hash(left)) * 31
-        # self._hash = (self._hash + hash(down)) * 31
+        return tile
+    
+    def __reduce__(self):
+        return (Tile, tuple(self.sections[direction]
+                            for direction in DIRECTIONS))
     
     def __eq__(self, other):
         if not isinstance(other, Tile):
             return False
         
-        for direction in Direction:
-            if self.sections[direction] != other.sections[direction]:
-                return False
-        
-        return True
+        return self.packed == other.packed
     
     def __neq__(self, other):
         return not(self == other)
     
     def __hash__(self):
-        _hash = 17
-        _hash = (_hash + hash(self.sections[Direction.RIGHT])) * 31
-        _hash = (_hash + hash(self.sections[Direction.UP])) * 31
-        _hash = (_hash + hash(self.sections[Direction.LEFT])) * 31
-        _hash = (_hash + hash(self.sections[Direction.DOWN])) * 31
-        
-        return _hash
+        return self.packed
     
     def __str__(self):
         return '({} {} {} {})'\
@@ -96,28 +215,45 @@ class Tile:
         """
         Return this tile, rotated 90 degrees counterclockwise rotation times.
         """
-        rotation = rotation % 4
-        sections = [self.sections[Direction.RIGHT],
-                    self.sections[Direction.UP],
-                    self.sections[Direction.LEFT],
-                    self.sections[Direction.DOWN]]
-        
-        sections = sections[-rotation:] + sections[:-rotation]
+        if self._rotations is None:
+            self._rotations = tuple(Tile.from_packed(rotate_packed(self.packed,
+                                                                   i))
+                                    for i in range(4))
         
-        return Tile(*sections)
+        return self._rotations[rotation % 4]
     
     def matches(self, other, side):
         """
         Return whether the side of this tile indicate by side matches
         the opposite side of the other tile.
         """
-        return self.sections[side] == other.sections[OPPOSITES[side]]
+        i, other_i = MATCH_INDICES[side]
+        return self.codes[i] == other.codes[other_i]
+    
+    def with_section(self, side, terrain):
+        """
+        Return this tile with the section at side replaced by terrain.
+        """
+        shift = SECTION_SHIFTS[side]
+        packed = (self.packed & ~(TERRAIN_MASK << shift)) \
+                 | (TERRAINS.code(terrain) << shift)
+        
+        return Tile.from_packed(packed)
     
     def copy(self):
-        return Tile(self.sections[Direction.RIGHT],
-                    self.sections[Direction.UP],
-                    self.sections[Direction.LEFT],
-                    self.sections[Direction.DOWN])
+        #Tiles are immutable, so there's no need for a new one
+        return self
+
+#The section indices compared by Tile.matches for each side
+MATCH_INDICES = {direction: (SECTION_INDICES[direction],
+                             SECTION_INDICES[OPPOSITES[direction]])
+                 for direction in DIRECTIONS}
+
+#The same for the packed forms of tiles, as the shift of each side
+#and of the opposite side of the tile next to it, in DIRECTIONS order
+MATCH_SHIFTS = [(SECTION_SHIFTS[direction],
+                 SECTION_SHIFTS[OPPOSITES[direction]])
+                for direction in DIRECTIONS]
 
 ADJ_DISPS = {Direction.RIGHT: CoordPair( 1,  0),
              Direction.UP: CoordPair( 0, -1),
@@ -148,7 +284,177 @@ def get_torus_disp(width, height):
     if height <= 1:
         raise ValueError('width: {}'.format(height))
     
-    return lambda coords, disp: torus_disp(coords, disp, width, height)
+    disp_function = lambda coords, disp: torus_disp(coords, disp,
+                                                    width, height)
+    
+    #So the displacement can be done on whole arrays
+    disp_function.torus_size = (width, height)
+    
+    return disp_function
+
+def disp_arrays(xs, ys, disp, disp_function):
+    """
+    Displace whole arrays of coordinates.
+    
+    Return:
+        The displaced x and y arrays, and a mask of which of them
+        are on the board.
+    """
+    #Topologies have their own array displacement
+    topology_disp_arrays = getattr(disp_function, 'disp_arrays', None)
+    if topology_disp_arrays is not None:
+        return topology_disp_arrays(xs, ys, disp)
+    
+    if disp_function is boundless_disp:
+        valid = np.ones(len(xs), dtype=bool)
+        return xs + disp.x, ys + disp.y, valid
+    
+    torus_size = getattr(disp_function, 'torus_size', None)
+    if torus_size is not None:
+        width, height = torus_size
+        valid = np.ones(len(xs), dtype=bool)
+        return (xs + disp.x) % width, (ys + disp.y) % height, valid
+    
+    #Otherwise, fall back on the displacement function itself
+    new_xs = np.zeros(len(xs), dtype=np.int64)
+    new_ys = np.zeros(len(ys), dtype=np.int64)
+    valid = np.zeros(len(xs), dtype=bool)
+    
+    for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+        new_coords = disp_function(CoordPair(x, y), disp)
+        if new_coords is None:
+            continue
+        
+        new_xs[i] = new_coords.x
+        new_ys[i] = new_coords.y
+        valid[i] = True
+    
+    return new_xs, new_ys, valid
+
+class EdgeMismatches:
+    """
+    Edges where adjacent tiles don't match.
+    
+    Edge i is the side directions[i] of the tile at (xs[i], ys[i]).
+    """
+    def __init__(self, xs, ys, directions):
+        self.xs = xs
+        self.ys = ys
+        self.directions = directions
+    
+    @property
+    def count(self):
+        return len(self.xs)
+    
+    def __len__(self):
+        return self.count
+    
+    def positions(self):
+        """
+        Return a list of (coords, direction) for each mismatched edge.
+        """
+        return [(CoordPair(x, y), DIRECTIONS[d])
+                for x, y, d in zip(self.xs.tolist(),
+                                   self.ys.tolist(),
+                                   self.directions.tolist())]
+
+def get_section_codes(packed, direction):
+    """
+    Return the terrain codes at the given side of an array of packed tiles.
+    """
+    return (packed >> SECTION_SHIFTS[direction]) & TERRAIN_MASK
+
+def check_edges(xs, ys, packed, disp_function, checked=None):
+    """
+    Check every edge between the given tiles with array comparisons.
+    
+    Parameters:
+        xs, ys:
+            The coordinates of the tiles.
+        
+        packed:
+            The packed tiles.
+        
+        disp_function:
+            The displacement function of the map.
+        
+        checked:
+            If given, a mask of the tiles to check. Edges between two
+            unchecked tiles are skipped.
+    
+    Return:
+        EdgeMismatches for every mismatched edge.
+    """
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    packed = np.asarray(packed, dtype=np.int64)
+    
+    if not len(xs):
+        empty = np.zeros(0, dtype=np.int64)
+        return EdgeMismatches(empty, empty, empty)
+    
+    keys = (xs << COORD_BITS) + (ys + COORD_OFFSET)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    
+    bad_xs = list()
+    bad_ys = list()
+    bad_directions = list()
+    
+    #Each edge is the right or down side of some tile
+    for direction in (Direction.RIGHT, Direction.DOWN):
+        adj_xs, adj_ys, valid = disp_arrays(xs, ys,
+                                            ADJ_DISPS[direction],
+                                            disp_function)
+        
+        #Find the tile in this direction, if there is one
+        adj_keys = (adj_xs << COORD_BITS) + (adj_ys + COORD_OFFSET)
+        pos = np.searchsorted(sorted_keys, adj_keys)
+        pos = np.minimum(pos, len(sorted_keys) - 1)
+        found = valid & (sorted_keys[pos] == adj_keys)
+        adj = order[pos]
+        
+        if checked is not None:
+            found &= checked | checked[adj]
+        
+        codes = get_section_codes(packed, direction)
+        adj_codes = get_section_codes(packed[adj], OPPOSITES[direction])
+        
+        bad = found & (codes != adj_codes)
+        
+        bad_xs.append(xs[bad])
+        bad_ys.append(ys[bad])
+        bad_directions.append(np.full(np.count_nonzero(bad),
+                                      SECTION_INDICES[direction]))
+    
+    return EdgeMismatches(np.concatenate(bad_xs),
+                          np.concatenate(bad_ys),
+                          np.concatenate(bad_directions))
+
+def get_tile_arrays(tiles):
+    """
+    Return the x, y and packed tile arrays for a coords->tile mapping.
+    """
+    num = len(tiles)
+    xs = np.zeros(num, dtype=np.int64)
+    ys = np.zeros(num, dtype=np.int64)
+    packed = np.zeros(num, dtype=np.int64)
+    
+    for i, (coords, tile) in enumerate(tiles.items()):
+        xs[i] = coords.x
+        ys[i] = coords.y
+        packed[i] = tile.packed
+    
+    return xs, ys, packed
+
+def find_mismatches(tiles, disp_function):
+    """
+    Return EdgeMismatches for every mismatched edge
+    in a coords->tile mapping.
+    """
+    xs, ys, packed = get_tile_arrays(tiles)
+    
+    return check_edges(xs, ys, packed, disp_function)
 
 class TileMap:
     """
@@ -195,5 +501,39 @@ class TileMap:
         
         self.tiles[coords] = tile
     
+    def add_tiles(self, tiles):
+        """
+        Add all the tiles in a coords->tile mapping,
+        checking the whole batch in one pass.
+        """
+        for coords in tiles:
+            if coords in self.tiles:
+                raise ValueError('coords in self.tiles: {}'.format(coords))
+        
+        #Check the batch against itself and the tiles around it
+        batch = dict(tiles)
+        around = dict()
+        for coords in tiles:
+            for direction in DIRECTIONS:
+                other_coords = self.in_direction(coords, direction)
+                
+                if other_coords in self.tiles:
+                    around[other_coords] = self.tiles[other_coords]
+        
+        xs, ys, packed = get_tile_arrays({**around, **batch})
+        checked = np.zeros(len(xs), dtype=bool)
+        checked[len(around):] = True
+        
+        mismatches = check_edges(xs, ys, packed, self.disp_function, checked)
+        if mismatches.count:
+            raise ValueError('{} tiles don\'t fit: {}'
+                             .format(mismatches.count,
+                                     mismatches.positions()[:10]))
+        
+        self.tiles.update(batch)
+    
+    def find_mismatches(self):
+        return find_mismatches(self.tiles, self.disp_function)
+    
     def at(self, coords):
         return self.tiles[coords]
\ No newline at end of file
@@ -5,9 +5,23 @@ Created on Fri Oct 15 13:16:51 2021
 @author: rober
 """
 
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
 import traceback
 
+import numpy as np
+
 import maps
+import dense_maps
+import topology
+import map_files
+import regions
+from indexed_set import IndexedSet
+from mismatch_counter import MismatchCounter, get_swap_deltas
 
 def tile_test():
     tile1 = maps.Tile(1, 2, 3, 4)
@@ -31,6 +45,602 @@ def tile_test():
     assert tile1.matches(tile3, maps.Direction.UP)
     assert not tile1.matches(tile3, maps.Direction.DOWN)
 
+def interned_tile_test():
+    tile1 = maps.Tile('P', 'F', 'W', None)
+    
+    #Equal tiles are the same object
+    assert maps.Tile('P', 'F', 'W', None) is tile1
+    assert maps.Tile.from_packed(tile1.packed) is tile1
+    assert pickle.loads(pickle.dumps(tile1)) is tile1
+    assert tile1.copy() is tile1
+    
+    #None is the wildcard code
+    assert tile1.codes[3] == maps.WILDCARD
+    assert tile1.sections[maps.Direction.DOWN] is None
+    
+    #Rotations of packed tiles agree with rotations of sections
+    assert tile1.rotated(1) is maps.Tile(None, 'P', 'F', 'W')
+    assert tile1.rotated(-1) is maps.Tile('F', 'W', None, 'P')
+    
+    assert tile1.with_section(maps.Direction.UP, None)\
+           is maps.Tile('P', None, 'W', None)
+    
+    #Tiles can't be changed in place
+    try:
+        tile1.sections[maps.Direction.UP] = 'W'
+        assert False
+    except TypeError:
+        pass
+
+def dense_map_test():
+    tile_map = dense_maps.DenseTileMap(maps.boundless_disp, 2, 2)
+    
+    tile_1 = maps.Tile(1, 2, 3, 4)
+    tile_2 = maps.Tile(5, 5, 1, 5)
+    
+    tile_map.add_tile(maps.CoordPair(0, 0), tile_1)
+    
+    #Far past the edge of the grid, in the negative direction
+    tile_map.add_tile(maps.CoordPair(-20, -7), tile_2)
+    assert tile_map.width >= 21
+    assert tile_map.height >= 8
+    
+    #Growing kept the old tiles where they were
+    assert tile_map.at(maps.CoordPair(0, 0)) == tile_1
+    assert tile_map.at(maps.CoordPair(-20, -7)) == tile_2
+    
+    #Test fitting
+    assert tile_map.fits(maps.CoordPair(1, 0), tile_2)
+    assert not tile_map.fits(maps.CoordPair(-1, 0), tile_2)
+    
+    try:
+        tile_map.add_tile(maps.CoordPair(-1, 0), tile_2)
+        assert False
+    except ValueError:
+        pass
+    
+    try:
+        tile_map.add_tile(maps.CoordPair(0, 0), tile_2)
+        assert False
+    except ValueError:
+        pass
+    
+    #Test the tiles view
+    assert len(tile_map.tiles) == 2
+    assert maps.CoordPair(0, 0) in tile_map.tiles
+    assert not maps.CoordPair(1, 0) in tile_map.tiles
+    assert dict(tile_map.tiles.items()) == {maps.CoordPair(0, 0): tile_1,
+                                            maps.CoordPair(-20, -7): tile_2}
+
+def count_mismatches(tiles, disp_function):
+    """
+    Count mismatched edges one tile at a time.
+    """
+    num = 0
+    for coords, tile in tiles.items():
+        for direction in (maps.Direction.RIGHT, maps.Direction.DOWN):
+            other_coords = disp_function(coords, maps.ADJ_DISPS[direction])
+            if other_coords in tiles:
+                if not tile.matches(tiles[other_coords], direction):
+                    num += 1
+    
+    return num
+
+def mismatch_test():
+    random.seed(3)
+    
+    disp_functions = [maps.boundless_disp, maps.get_torus_disp(7, 5)]
+    
+    for disp_function in disp_functions:
+        #Random tiles on a torus-sized patch, with holes
+        tiles = dict()
+        for x in range(7):
+            for y in range(5):
+                if random.random() < 0.8:
+                    terrains = [random.choice('PF') for _ in range(4)]
+                    tiles[maps.CoordPair(x, y)] = maps.Tile(*terrains)
+        
+        target = count_mismatches(tiles, disp_function)
+        assert target > 0
+        
+        mismatches = maps.find_mismatches(tiles, disp_function)
+        assert mismatches.count == target
+        
+        for coords, direction in mismatches.positions():
+            other_coords = disp_function(coords, maps.ADJ_DISPS[direction])
+            assert not tiles[coords].matches(tiles[other_coords], direction)
+        
+        #A dense map finds the same edges
+        dense_map = dense_maps.DenseTileMap(disp_function)
+        for coords, tile in tiles.items():
+            gx = coords.x - dense_map.min_x
+            gy = coords.y - dense_map.min_y
+            dense_map.codes[gx, gy] = tile.packed
+            dense_map.occupied[gx, gy] = True
+        
+        assert dense_map.find_mismatches().count == target
+        
+        #Batches that don't fit can't be added
+        for tile_map in (maps.TileMap(disp_function), dense_map):
+            try:
+                tile_map.add_tiles(tiles)
+                assert False
+            except ValueError:
+                pass
+    
+    #Batches that fit can be added
+    tile_1 = maps.Tile(*'PPFF')
+    tile_2 = maps.Tile(*'FPPP')
+    
+    for tile_map in (maps.TileMap(maps.boundless_disp),
+                     dense_maps.DenseTileMap(maps.boundless_disp, 2, 2)):
+        tile_map.add_tile(maps.CoordPair(0, 0), tile_1)
+        tile_map.add_tiles({maps.CoordPair(1, 0): tile_2,
+                            maps.CoordPair(-1, 0): tile_2,
+                            maps.CoordPair(5, 5): tile_1})
+        
+        assert len(tile_map.tiles) == 4
+        assert tile_map.find_mismatches().count == 0
+        
+        #This one doesn't fit against the tile already there
+        try:
+            tile_map.add_tiles({maps.CoordPair(2, 0): tile_2})
+            assert False
+        except ValueError:
+            pass
+        assert len(tile_map.tiles) == 4
+
+def chunked_map_test():
+    tile_map = dense_maps.ChunkedTileMap(maps.boundless_disp)
+    
+    #Two tiles on either side of a chunk corner
+    corner = dense_maps.CHUNK_SIZE
+    tile_1 = maps.Tile(*'PFPF')
+    tile_2 = maps.Tile(*'PPPP')
+    
+    tile_map.add_tile(maps.CoordPair(corner, corner), tile_1)
+    assert len(tile_map.chunks) == 1
+    
+    #Neighbours across chunk boundaries are checked
+    assert tile_map.fits(maps.CoordPair(corner - 1, corner), tile_2)
+    assert not tile_map.fits(maps.CoordPair(corner, corner - 1), tile_2)
+    
+    tile_map.add_tiles({maps.CoordPair(corner - 1, corner): tile_2,
+                        maps.CoordPair(-10**6, 3): tile_2})
+    
+    #Far-away tiles only make their own chunk
+    assert len(tile_map.chunks) == 3
+    assert len(list(tile_map.iter_chunks())) == 3
+    assert len(tile_map.tiles) == 3
+    
+    assert tile_map.at(maps.CoordPair(-10**6, 3)) == tile_2
+    assert tile_map.at(maps.CoordPair(corner - 1, corner)) == tile_2
+    assert not maps.CoordPair(corner - 1, corner - 1) in tile_map.tiles
+    
+    try:
+        tile_map.add_tile(maps.CoordPair(corner, corner - 1), tile_2)
+        assert False
+    except ValueError:
+        pass
+    
+    assert tile_map.find_mismatches().count == 0
+
+def add_tile_test():
+    #Adding tiles one at a time gives the same map as adding them at once
+    tiles = {maps.CoordPair(x, y): maps.Tile(*'PPPP')
+             for x in range(-40, 40, 3) for y in range(-9, 70, 7)}
+    
+    for map_class in (dense_maps.DenseTileMap, dense_maps.ChunkedTileMap):
+        one_map = map_class(maps.boundless_disp)
+        for coords, tile in tiles.items():
+            one_map.add_tile(coords, tile)
+        
+        batch_map = map_class(maps.boundless_disp)
+        batch_map.add_tiles(tiles)
+        
+        assert one_map.num_tiles == batch_map.num_tiles == len(tiles)
+        assert dict(one_map.tiles.items()) == dict(batch_map.tiles.items())
+        
+        if map_class is dense_maps.ChunkedTileMap:
+            assert sum(chunk.num_tiles for chunk
+                       in one_map.chunks.values()) == len(tiles)
+        
+        #Removed tiles leave the map, and can be put back
+        coords = maps.CoordPair(-1, -2)
+        one_map.remove_tile(coords)
+        assert coords not in one_map.tiles
+        assert one_map.num_tiles == len(tiles) - 1
+        
+        try:
+            one_map.remove_tile(coords)
+            assert False
+        except KeyError:
+            pass
+        
+        one_map.add_tile(coords, tiles[coords])
+        assert dict(one_map.tiles.items()) == dict(batch_map.tiles.items())
+
+def topology_test():
+    width, height = 5, 4
+    torus_disp = maps.get_torus_disp(width, height)
+    torus = topology.get_torus_topology(width, height)
+    
+    #The neighbour table agrees with the displacement function
+    for i, coords in enumerate(torus.coords_list):
+        assert torus.index(coords) == i
+        
+        for direction in maps.DIRECTIONS:
+            target = torus_disp(coords, maps.ADJ_DISPS[direction])
+            adj = torus.neighbours[i, maps.SECTION_INDICES[direction]]
+            
+            assert torus.coords_list[adj] == target
+            assert torus.in_direction(coords, direction) == target
+    
+    #Off the edge of a bounded board is off_board
+    diamond = topology.get_diamond_topology(3)
+    assert diamond.num_cells == 25
+    
+    left_tip = diamond.index(maps.CoordPair(0, 0))
+    right = maps.SECTION_INDICES[maps.Direction.RIGHT]
+    neighbours = diamond.neighbours_of([left_tip])[0]
+    assert (neighbours == diamond.off_board).sum() == 3
+    assert diamond.coords_list[neighbours[right]] == maps.CoordPair(1, 0)
+    
+    left = maps.ADJ_DISPS[maps.Direction.LEFT]
+    assert diamond(maps.CoordPair(0, 0), left) is None
+    assert diamond(maps.CoordPair(-5, 0), left) is None
+    
+    #Topologies work as displacement functions for maps
+    tile_map = maps.TileMap(torus)
+    tile_map.add_tile(maps.CoordPair(0, 0), maps.Tile(*'PFPF'))
+    assert not tile_map.fits(maps.CoordPair(width - 1, 0),
+                             maps.Tile(*'FFFF'))
+    assert tile_map.fits(maps.CoordPair(width - 1, 0), maps.Tile(*'PFPF'))
+    
+    random.seed(5)
+    tiles = {coords: maps.Tile(*[random.choice('PF') for _ in range(4)])
+             for coords in torus.coords_list}
+    
+    assert maps.find_mismatches(tiles, torus).count\
+           == maps.find_mismatches(tiles, torus_disp).count
+
+def get_random_tiles(coords_list, terrains):
+    return {coords: maps.Tile(*[random.choice(terrains) for _ in range(4)])
+            for coords in coords_list}
+
+def map_file_test():
+    random.seed(7)
+    
+    diamond = topology.get_diamond_topology(6)
+    
+    #Maps with holes, negative coordinates and different topologies
+    tiles = get_random_tiles([maps.CoordPair(x, y)
+                              for x in range(-9, 4)
+                              for y in range(-3, 12)
+                              if (x * y) % 5], 'PFW')
+    
+    saved_maps = [(maps.TileMap(maps.boundless_disp), tiles),
+                  (dense_maps.ChunkedTileMap(maps.get_torus_disp(13, 15)),
+                   tiles),
+                  (maps.TileMap(diamond),
+                   get_random_tiles(diamond.coords_list, 'PF')),
+                  (maps.TileMap(maps.boundless_disp), dict())]
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'map.bin')
+        
+        for tile_map, curr_tiles in saved_maps:
+            if hasattr(tile_map, 'store_arrays'):
+                tile_map.store_arrays(*maps.get_tile_arrays(curr_tiles))
+            else:
+                tile_map.tiles.update(curr_tiles)
+            
+            map_files.save_map(tile_map, path)
+            
+            #Round trips are lossless
+            loaded = map_files.load_map(path)
+            assert dict(loaded.tiles.items()) == curr_tiles
+            
+            loaded = map_files.load_tile_map(path)
+            assert loaded.tiles == curr_tiles
+            assert map_files.describe_disp_function(loaded.disp_function)\
+                   == map_files.describe_disp_function(tile_map.disp_function)
+        
+        #Regions can be read on their own
+        map_files.save_map(saved_maps[0][0], path)
+        map_file = map_files.MapFile(path)
+        
+        codes, occupied = map_file.read_region(-12, 2, 7, 20)
+        for x in range(-12, -5):
+            for y in range(2, 22):
+                coords = maps.CoordPair(x, y)
+                assert occupied[x + 12, y - 2] == (coords in tiles)
+                
+                if coords in tiles:
+                    assert codes[x + 12, y - 2] == tiles[coords].packed
+        
+        #Loading reads nothing until it's used, and lookups only read
+        #what they need
+        loaded = map_files.load_map(path)
+        assert loaded.occupied is None
+        assert loaded.num_tiles == len(tiles)
+        
+        for x in range(-10, 5):
+            for y in range(-4, 13):
+                coords = maps.CoordPair(x, y)
+                assert loaded.has_tile(coords) == (coords in tiles)
+                if coords in tiles:
+                    assert loaded.at(coords) == tiles[coords]
+        
+        xs = np.array([-9, 0, 3, 30], dtype=np.int64)
+        ys = np.array([-2, 4, 11, 0], dtype=np.int64)
+        packed, found = loaded.lookup_arrays(xs, ys)
+        for x, y, tile_packed, is_found in zip(xs.tolist(), ys.tolist(),
+                                               packed.tolist(),
+                                               found.tolist()):
+            coords = maps.CoordPair(x, y)
+            assert is_found == (coords in tiles)
+            if is_found:
+                assert tile_packed == tiles[coords].packed
+        
+        #Going over the tiles a few rows at a time gets them all
+        loaded.BLOCK_ROWS = 3
+        assert dict(loaded.tiles.items()) == tiles
+        assert loaded.occupied is None
+        
+        #Changing the map reads it all in first
+        new_coords = maps.CoordPair(-20, 0)
+        loaded.add_tile(new_coords, maps.Tile(*'PPPP'))
+        assert loaded.occupied is not None
+        assert loaded.num_tiles == len(tiles) + 1
+        assert loaded.at(new_coords) == maps.Tile(*'PPPP')
+        del loaded
+        
+        #A process that gave the terrains other codes still reads the map
+        script = ('import maps, map_files\n'
+                  'maps.Tile("W", "F", "X", "P")\n'
+                  'tile_map = map_files.load_map({!r})\n'
+                  'print(sorted((c.x, c.y, str(t))\n'
+                  '             for c, t in tile_map.tiles.items()))')
+        
+        output = subprocess.run([sys.executable, '-c', script.format(path)],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        
+        target = sorted((c.x, c.y, str(t)) for c, t in tiles.items())
+        assert output.stdout.strip() == str(target)
+        
+        #Including single lookups, which translate just what they read
+        coords = next(iter(tiles))
+        script = ('import maps, map_files\n'
+                  'maps.Tile("W", "F", "X", "P")\n'
+                  'tile_map = map_files.load_map({!r})\n'
+                  'print(tile_map.at(maps.CoordPair({}, {})))')
+        
+        output = subprocess.run([sys.executable, '-c',
+                                 script.format(path, coords.x, coords.y)],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        assert output.stdout.strip() == str(tiles[coords])
+        
+        #Bad files are refused
+        with open(path, 'r+b') as file:
+            file.write(b'NOTAMAP!')
+        
+        try:
+            map_files.MapFile(path)
+            assert False
+        except ValueError:
+            pass
+
+def indexed_set_test():
+    random.seed(6)
+    
+    #Random adds and removes keep it the same as a set
+    indexed = IndexedSet()
+    target = set()
+    for _ in range(5000):
+        item = random.randrange(100)
+        if random.random() < 0.5:
+            indexed.add(item)
+            target.add(item)
+        else:
+            indexed.discard(item)
+            target.discard(item)
+        
+        assert indexed == target
+        assert all(indexed.items[indexed.positions[item]] == item
+                   for item in target)
+    
+    try:
+        indexed.remove(1000)
+        assert False
+    except KeyError:
+        pass
+    
+    #Choices are uniform, and never the excluded item
+    indexed = IndexedSet('abcd')
+    num = 40000
+    
+    counts = {item: 0 for item in indexed}
+    for _ in range(num):
+        counts[indexed.choice(exclude='b')] += 1
+    
+    assert counts['b'] == 0
+    for item in 'acd':
+        assert abs(counts[item] / num - 1 / 3) < 0.01
+    
+    try:
+        IndexedSet('a').choice(exclude='a')
+        assert False
+    except IndexError:
+        pass
+
+def mismatch_counter_test():
+    random.seed(7)
+    
+    tiles = [maps.Tile(*terrains) for terrains in ('ABAB', 'AAAA', 'BBBB',
+                                                   'ABBA', 'BAAB')]
+    
+    for board in (topology.get_diamond_topology(5),
+                  topology.get_torus_topology(6, 4)):
+        packed = [random.choice(tiles).packed
+                  for _ in range(board.num_cells)] + [0]
+        counter = MismatchCounter(board, packed)
+        
+        #Random changes keep the count the same as a full check
+        for _ in range(300):
+            i = random.randrange(board.num_cells)
+            counter.set_tile(i, random.choice(tiles).packed)
+            
+            packed = np.array(counter.packed[:-1])
+            mismatches = maps.check_edges(board.xs, board.ys, packed,
+                                          board)
+            assert counter.count == mismatches.count
+            
+            #Each mismatched edge counts for the cells on both sides
+            errors = np.zeros(board.num_cells, dtype=np.int64)
+            for x, y, d in zip(mismatches.xs.tolist(),
+                               mismatches.ys.tolist(),
+                               mismatches.directions.tolist()):
+                cell = board.index(maps.CoordPair(x, y))
+                errors[cell] += 1
+                errors[board.neighbours[cell, d]] += 1
+            
+            assert counter.errors == errors.tolist()
+            assert set(counter.erroneous) == set(np.flatnonzero(errors)
+                                                 .tolist())
+        
+        #Swap deltas are exact, for neighbours as well
+        for _ in range(300):
+            i = random.randrange(board.num_cells)
+            if random.random() < 0.5:
+                j = random.choice(board.neighbour_lists[i])
+                if j == board.off_board:
+                    continue
+            else:
+                j = random.randrange(board.num_cells)
+            
+            before = counter.count
+            delta = counter.swap_delta(i, j)
+            
+            packed_i = counter.packed[i]
+            counter.set_tile(i, counter.packed[j])
+            counter.set_tile(j, packed_i)
+            
+            assert counter.count - before == delta
+        
+        #And the same for whole arrays of swaps
+        cells_1 = np.array([random.randrange(board.num_cells)
+                            for _ in range(300)])
+        cells_2 = np.array([random.choice(board.neighbour_lists[i])
+                            for i in cells_1.tolist()])
+        cells_2[cells_2 == board.off_board] = 0
+        cells_2[::2] = [random.randrange(board.num_cells)
+                        for _ in range(len(cells_2[::2]))]
+        
+        deltas = get_swap_deltas(board, np.array(counter.packed),
+                                 cells_1, cells_2)
+        assert deltas.tolist() == [counter.swap_delta(i, j) for i, j
+                                   in zip(cells_1.tolist(), cells_2.tolist())]
+        
+        #The tile index follows the changes
+        counter.index_tiles()
+        for _ in range(100):
+            i = random.randrange(board.num_cells)
+            counter.set_tile(i, random.choice(tiles).packed)
+        
+        for tile in tiles:
+            cells = [i for i, packed in enumerate(counter.packed[:-1])
+                     if packed == tile.packed]
+            assert set(counter.cells_from_tile.get(tile.packed, ()))\
+                   == set(cells)
+        
+        #And the needed tiles are the same as the board's
+        needed = board.needed_tiles(counter.packed)
+        assert [counter.get_needed(i) for i in range(board.num_cells)]\
+               == needed.tolist()
+
+def regions_test():
+    half_diag = 4
+    diamond = regions.get_diamond_region(half_diag)
+    
+    #The same cells in the same order as the old diamond
+    xs, ys = topology.get_diamond_coords(half_diag)
+    assert np.array_equal(diamond.xs, xs)
+    assert np.array_equal(diamond.ys, ys)
+    
+    #The border is the top and bottom of each column
+    border = set()
+    for x in range(half_diag * 2 + 1):
+        half_y = half_diag - abs(x - half_diag)
+        border.add(maps.CoordPair(x, -half_y))
+        border.add(maps.CoordPair(x, half_y))
+    
+    assert set(diamond.border_coords) == border
+    assert set(diamond.inner_coords) == set(diamond) - border
+    assert len(diamond.inner) + len(diamond.border) == len(diamond)
+    
+    #Regions and their topologies are made once
+    assert regions.get_diamond_region(half_diag) is diamond
+    board = diamond.get_topology()
+    assert diamond.get_topology(maps.boundless_disp) is board
+    assert board.description == {'type': 'diamond', 'half_diag': half_diag}
+    
+    #Inner cells have all their neighbours, no cells of a colour touch
+    inner_neighbours = board.neighbours[diamond.inner]
+    assert np.all(inner_neighbours != board.off_board)
+    
+    colours = np.append(diamond.colours, -1)
+    assert np.all(colours[board.neighbours] != diamond.colours[:, None])
+    
+    rectangle = regions.get_rectangle_region(4, 3, 2, 5)
+    assert rectangle.coords_list[0] == maps.CoordPair(2, 5)
+    assert rectangle.inner_coords == [maps.CoordPair(3, 6),
+                                      maps.CoordPair(4, 6)]
+    
+    #A ring has a border inside as well as outside
+    mask = np.ones((5, 5), dtype=bool)
+    mask[2, 2] = False
+    ring = regions.get_mask_region(mask, -2, -2)
+    assert len(ring) == 24
+    assert maps.CoordPair(0, 0) not in ring.coords_list
+    assert maps.CoordPair(1, 0) in ring.border_coords
+    assert set(ring.inner_coords) == {maps.CoordPair(-1, -1),
+                                      maps.CoordPair(-1, 1),
+                                      maps.CoordPair(1, -1),
+                                      maps.CoordPair(1, 1)}
+    assert regions.get_mask_region(mask.copy(), -2, -2) is ring
+    
+    try:
+        regions.get_mask_region(np.zeros((3, 3)))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('empty region made')
+    
+    #Topologies are kept by board, not by displacement function
+    rectangle = regions.get_rectangle_region(4, 3)
+    board = rectangle.get_topology(maps.get_torus_disp(4, 3))
+    assert rectangle.get_topology(maps.get_torus_disp(4, 3)) is board
+    assert board.neighbours[0, maps.SECTION_INDICES[maps.Direction.LEFT]]\
+           == rectangle.coords_list.index(maps.CoordPair(3, 0))
+    
+    torus = topology.get_torus_topology(4, 3)
+    assert rectangle.get_topology(torus)\
+           is rectangle.get_topology(topology.get_torus_topology(4, 3))
+    
+    #Functions that can't be told apart aren't kept at all
+    disp_function = lambda coords, disp: maps.boundless_disp(coords, disp)
+    assert rectangle.get_topology(disp_function)\
+           is not rectangle.get_topology(disp_function)
+    assert len(rectangle.topologies) == 2
+    
+    #Only so many regions are kept
+    for other_half_diag in range(10, 11 + regions.MAX_REGIONS):
+        regions.get_diamond_region(other_half_diag)
+    assert regions.get_diamond_region(half_diag) is not diamond
+
 def run_test(test):
     try:
         test()
@@ -42,6 +652,16 @@ def run_test(test):
 
 def main():
     run_test(tile_test)
+    run_test(interned_tile_test)
+    run_test(dense_map_test)
+    run_test(chunked_map_test)
+    run_test(add_tile_test)
+    run_test(mismatch_test)
+    run_test(topology_test)
+    run_test(map_file_test)
+    run_test(indexed_set_test)
+    run_test(mismatch_counter_test)
+    run_test(regions_test)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
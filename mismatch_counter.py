@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov 21 10:14:36 2021
+
+@author: rober
+"""
+
+import numpy as np
+
+import maps
+from indexed_set import IndexedSet
+
+class MismatchCounter:
+    """
+    A running count of the mismatched edges between the cells of a
+    Topology, kept up to date as tiles change.
+    
+    packed is the packed tile at each cell, with one extra slot at the
+    end for off the board, as in Topology.needed_tiles.
+    errors[i] is the number of mismatched edges of cell i,
+    and erroneous is an IndexedSet of the cells with any.
+    Edges off the board never count.
+    
+    After index_tiles, cells_from_tile is a dict from each packed tile
+    to an IndexedSet of the cells with it, also kept up to date.
+    """
+    def __init__(self, board, packed):
+        self.board = board
+        
+        packed = np.asarray(packed, dtype=np.int64)
+        if len(packed) != board.num_cells + 1:
+            raise ValueError('{} tiles for {} cells'
+                             .format(len(packed), board.num_cells))
+        
+        #Count the errors of every cell at once
+        errors = np.zeros(board.num_cells, dtype=np.int64)
+        for direction in maps.DIRECTIONS:
+            adj = board.neighbours[:, maps.SECTION_INDICES[direction]]
+            
+            codes = maps.get_section_codes(packed[:-1], direction)
+            adj_codes = maps.get_section_codes(packed[adj],
+                                               maps.OPPOSITES[direction])
+            
+            errors += (adj != board.off_board) & (codes != adj_codes)
+        
+        self.packed = packed.tolist()
+        self.errors = errors.tolist()
+        
+        #Every mismatched edge is counted by both of its cells
+        self.count = int(errors.sum()) // 2
+        
+        self.erroneous = IndexedSet(np.flatnonzero(errors).tolist())
+        
+        self.cells_from_tile = None
+    
+    def index_tiles(self):
+        """
+        Start keeping cells_from_tile, which costs a little on every
+        change, so it's only done when asked for.
+        """
+        if self.cells_from_tile is not None:
+            return
+        
+        self.cells_from_tile = dict()
+        for i, packed in enumerate(self.packed[:-1]):
+            self.cells_from_tile.setdefault(packed, IndexedSet()).add(i)
+    
+    def get_needed(self, i):
+        """
+        Return the packed tile that would match every neighbour of
+        cell i, with the wildcard on sides off the board,
+        as in Topology.needed_tiles.
+        """
+        mask = maps.TERRAIN_MASK
+        off_board = self.board.off_board
+        
+        needed = 0
+        for adj, (shift, adj_shift) in zip(self.board.neighbour_lists[i],
+                                           maps.MATCH_SHIFTS):
+            if adj != off_board:
+                needed |= ((self.packed[adj] >> adj_shift) & mask) << shift
+        
+        return needed
+    
+    def add_errors(self, i, change):
+        errors = self.errors[i] + change
+        self.errors[i] = errors
+        
+        if errors:
+            self.erroneous.add(i)
+        else:
+            self.erroneous.discard(i)
+    
+    def set_tile(self, i, packed):
+        """
+        Put the packed tile at cell i, and update the counts
+        for its four edges.
+        """
+        old_packed = self.packed[i]
+        if packed == old_packed:
+            return
+        
+        self.packed[i] = packed
+        
+        if self.cells_from_tile is not None:
+            self.cells_from_tile[old_packed].discard(i)
+            self.cells_from_tile.setdefault(packed, IndexedSet()).add(i)
+        
+        mask = maps.TERRAIN_MASK
+        off_board = self.board.off_board
+        
+        for adj, (shift, adj_shift) in zip(self.board.neighbour_lists[i],
+                                           maps.MATCH_SHIFTS):
+            if adj == off_board:
+                continue
+            
+            adj_code = (self.packed[adj] >> adj_shift) & mask
+            was_bad = ((old_packed >> shift) & mask) != adj_code
+            is_bad = ((packed >> shift) & mask) != adj_code
+            
+            if was_bad != is_bad:
+                change = 1 if is_bad else -1
+                
+                self.count += change
+                self.add_errors(i, change)
+                self.add_errors(adj, change)
+    
+    def swap_delta(self, i, j):
+        """
+        Return how much the count would change if the tiles at cells
+        i and j were swapped, looking only at the edges of the two cells.
+        If the cells are next to each other, the edge between them is
+        counted once, with both tiles swapped.
+        """
+        packed = self.packed
+        packed_i = packed[i]
+        packed_j = packed[j]
+        
+        if packed_i == packed_j:
+            return 0
+        
+        mask = maps.TERRAIN_MASK
+        off_board = self.board.off_board
+        neighbour_lists = self.board.neighbour_lists
+        
+        delta = 0
+        for cell, other, old, new in ((i, j, packed_i, packed_j),
+                                      (j, i, packed_j, packed_i)):
+            for adj, (shift, adj_shift) in zip(neighbour_lists[cell],
+                                               maps.MATCH_SHIFTS):
+                if adj == off_board:
+                    continue
+                
+                if adj == other:
+                    #Only count the edge between them from i's side,
+                    #where j's tile changes too
+                    if cell == j:
+                        continue
+                    
+                    was_bad = ((old >> shift) & mask)\
+                              != ((new >> adj_shift) & mask)
+                    is_bad = ((new >> shift) & mask)\
+                             != ((old >> adj_shift) & mask)
+                else:
+                    adj_code = (packed[adj] >> adj_shift) & mask
+                    was_bad = ((old >> shift) & mask) != adj_code
+                    is_bad = ((new >> shift) & mask) != adj_code
+                
+                delta += is_bad - was_bad
+        
+        return delta
+
+#The shifts of each side of a tile, and of the side it meets,
+#in the order of the columns of a neighbour table
+SHIFTS = np.array([shift for shift, _ in maps.MATCH_SHIFTS])
+ADJ_SHIFTS = np.array([adj_shift for _, adj_shift in maps.MATCH_SHIFTS])
+
+def get_swap_deltas(board, packed, cells_1, cells_2):
+    """
+    Return how much the count would change with each swap of the tiles
+    at cells_1[k] and cells_2[k], on its own, like
+    MismatchCounter.swap_delta for whole arrays of swaps.
+    
+    packed is an array of the packed tile at each cell, with an extra
+    slot at the end for off the board.
+    """
+    packed_1 = packed[cells_1][:, None]
+    packed_2 = packed[cells_2][:, None]
+    
+    mask = maps.TERRAIN_MASK
+    deltas = np.zeros(len(cells_1), dtype=np.int64)
+    
+    for cell, other, old, new in ((cells_1, cells_2, packed_1, packed_2),
+                                  (cells_2, cells_1, packed_2, packed_1)):
+        adj = board.neighbours[cell]
+        adj_codes = (packed[adj] >> ADJ_SHIFTS) & mask
+        
+        #The other cell's tile changes too
+        is_other = adj == other[:, None]
+        adj_codes_after = np.where(is_other, (old >> ADJ_SHIFTS) & mask,
+                                   adj_codes)
+        
+        was_bad = ((old >> SHIFTS) & mask) != adj_codes
+        is_bad = ((new >> SHIFTS) & mask) != adj_codes_after
+        
+        #The edge between the two cells only counts from the first
+        counted = adj != board.off_board
+        if cell is cells_2:
+            counted &= ~is_other
+        
+        deltas += np.count_nonzero(is_bad & counted, axis=1)
+        deltas -= np.count_nonzero(was_bad & counted, axis=1)
+    
+    return deltas
\ No newline at end of file
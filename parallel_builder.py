@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Nov 20 11:02:48 2021
+
+@author: rober
+"""
+
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import maps
+import board_builder
+import dense_maps
+import topology
+
+#The sampler each worker process grows its regions with
+WORKER_SAMPLER = None
+
+def get_region_bounds(width, height, region_size):
+    """
+    Return (min_x, min_y, width, height) for each region of a width by
+    height rectangle from (0, 0) split into region_size squares,
+    row by row. Regions at the far edges can be smaller.
+    """
+    bounds = list()
+    for min_y in range(0, height, region_size):
+        for min_x in range(0, width, region_size):
+            bounds.append((min_x,
+                           min_y,
+                           min(region_size, width - min_x),
+                           min(region_size, height - min_y)))
+    
+    return bounds
+
+def get_region_seeds(seed, num_regions):
+    """
+    Return a seed for each region, fixed by the master seed.
+    """
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(num_regions)]
+
+def check_terrain_codes(terrains):
+    """
+    Give the terrains the codes they have in the parent process.
+    
+    The sampler's packed tiles use the parent's terrain codes,
+    so a worker has to give the terrains the same ones.
+    """
+    for code, terrain in enumerate(terrains, 1):
+        if maps.TERRAINS.code(terrain) != code:
+            raise ValueError('terrain codes differ in worker: {}'
+                             .format(terrain))
+
+def init_worker(terrains, sampler):
+    """
+    Set up a worker process to grow regions.
+    """
+    global WORKER_SAMPLER
+    
+    check_terrain_codes(terrains)
+    
+    WORKER_SAMPLER = sampler
+
+def grow_region(bounds, seed, favor_adj, matching, sampler=None):
+    """
+    Fill one region with a MapBuilder, as if nothing were outside it.
+    
+    Without matching, the builder can stall with holes left, which
+    are then filled with matching draws. A region that still isn't
+    full is a ValueError.
+    
+    Return:
+        The x, y and packed tile arrays of the region.
+    """
+    if sampler is None:
+        sampler = WORKER_SAMPLER
+    
+    min_x, min_y, width, height = bounds
+    
+    random.seed(seed)
+    
+    region = topology.get_rectangle_topology(width, height, min_x, min_y)
+    tile_map = maps.TileMap(region)
+    
+    start_coords = maps.CoordPair(min_x + width // 2, min_y + height // 2)
+    builder = board_builder.MapBuilder(tile_map, sampler, favor_adj,
+                                       start_coords)
+    
+    #With no budget but the size of the region, this fills it,
+    #unless the builder stalls
+    num_cells = width * height
+    builder.grow(num_cells, matching=matching)
+    
+    if not matching and len(tile_map.tiles) < num_cells:
+        builder.grow(num_cells - len(tile_map.tiles), matching=True)
+    
+    if len(tile_map.tiles) != num_cells:
+        raise ValueError('region not filled: {}, {} of {} tiles'
+                         .format(bounds, len(tile_map.tiles), num_cells))
+    
+    return maps.get_tile_arrays(tile_map.tiles)
+
+def get_needed_desc(tile_map, coords):
+    """
+    Return the description of what fits at coords,
+    with None for the sides with no tile.
+    """
+    packed = 0
+    for direction in maps.DIRECTIONS:
+        adj_coords = tile_map.in_direction(coords, direction)
+        if adj_coords is None:
+            continue
+        
+        adj_packed = tile_map.get_packed(adj_coords.x, adj_coords.y)
+        if adj_packed is None:
+            continue
+        
+        code = maps.get_section_codes(adj_packed, maps.OPPOSITES[direction])
+        packed |= code << maps.SECTION_SHIFTS[direction]
+    
+    return maps.Tile.from_packed(packed)
+
+def reconcile_seams(tile_map, sampler):
+    """
+    Redraw tiles so every edge on a DenseTileMap matches.
+    The tiles go through the map's remove_tile and add_tile.
+    
+    Of the two tiles at each mismatched edge, the one to the right or
+    below is taken off. Then each one is put back, in order, drawn from
+    the sampler to match whatever is around it.
+    
+    Return:
+        The number of tiles redrawn.
+    """
+    mismatches = tile_map.find_mismatches()
+    
+    redraw = set()
+    for coords, direction in mismatches.positions():
+        redraw.add(tile_map.in_direction(coords, direction))
+    
+    redraw = sorted(redraw, key=lambda coords: (coords.y, coords.x))
+    
+    for coords in redraw:
+        tile_map.remove_tile(coords)
+    
+    for coords in redraw:
+        desc = get_needed_desc(tile_map, coords)
+        
+        tile = sampler.sample_matching(desc)
+        if tile is None:
+            raise ValueError('no tile fits: {}, {}'.format(coords, desc))
+        
+        tile_map.add_tile(coords, tile)
+    
+    return len(redraw)
+
+def grow_regions(sampler,
+                 width,
+                 height,
+                 region_size,
+                 seed,
+                 num_workers=1,
+                 favor_adj=True,
+                 matching=True):
+    """
+    Make a width by height map from (0, 0), growing each region_size
+    square of it separately with a MapBuilder, in num_workers processes.
+    The seams between the regions are then reconciled, so every edge
+    matches.
+    
+    Each region gets its own seed from the master seed, so the map
+    only depends on the seed, not on num_workers.
+    The sampler needs sample_matching for the seams.
+    
+    Returns a boundless DenseTileMap.
+    """
+    bounds = get_region_bounds(width, height, region_size)
+    seeds = get_region_seeds(seed, len(bounds) + 1)
+    
+    #Keep the caller's random state
+    state = random.getstate()
+    
+    try:
+        if num_workers == 1:
+            results = [grow_region(region_bounds, region_seed, favor_adj,
+                                   matching, sampler)
+                       for region_bounds, region_seed in zip(bounds, seeds)]
+        else:
+            terrains = maps.TERRAINS.terrains_from_codes[1:]
+            
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     initializer=init_worker,
+                                     initargs=(terrains, sampler)) as pool:
+                results = list(pool.map(grow_region,
+                                        bounds,
+                                        seeds[:-1],
+                                        [favor_adj] * len(bounds),
+                                        [matching] * len(bounds)))
+        
+        #Put the regions together
+        codes = np.zeros((width, height), dtype=np.uint32)
+        occupied = np.zeros((width, height), dtype=bool)
+        for xs, ys, packed in results:
+            codes[xs, ys] = packed
+            occupied[xs, ys] = True
+        
+        tile_map = dense_maps.DenseTileMap.from_arrays(maps.boundless_disp,
+                                                       codes, occupied, 0, 0)
+        
+        random.seed(seeds[-1])
+        reconcile_seams(tile_map, sampler)
+    finally:
+        random.setstate(state)
+    
+    return tile_map
\ No newline at end of file
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov 28 09:51:12 2021
+
+@author: rober
+"""
+
+import functools
+
+import numpy as np
+
+import maps
+import topology
+
+#How many regions of each kind are kept once made
+MAX_REGIONS = 16
+
+def get_disp_key(disp_function):
+    """
+    Return a key saying which board a displacement function is for,
+    or None if it can't be told apart from any other function.
+    """
+    if disp_function is maps.boundless_disp:
+        return ('boundless',)
+    
+    torus_size = getattr(disp_function, 'torus_size', None)
+    if torus_size is not None:
+        return ('torus',) + tuple(torus_size)
+    
+    description = getattr(disp_function, 'description', None)
+    if description is not None:
+        return ('topology',) + tuple(sorted(description.items()))
+    
+    return None
+
+class Region:
+    """
+    A finite shape of cells, with its border and interior worked out once.
+    
+    The shape is a boolean mask, where mask[gx, gy] says whether
+    (min_x + gx, min_y + gy) is in the region.
+    The cells are numbered by x, then by y, as in get_diamond_coords.
+    
+    A cell is on the border if any cell next to it is outside the region.
+    border and inner are arrays of the indices of the border and inner
+    cells, and inner_mask says which cells are inner.
+    colours colours the cells like a checkerboard, so no two cells of
+    the same colour are next to each other.
+    
+    coords_list, border_coords and inner_coords are lists of CoordPairs
+    for code that works one cell at a time.
+    
+    Topologies are kept by what board their displacement function is
+    for, so a new function for the same board doesn't make another.
+    """
+    def __init__(self, mask, min_x=0, min_y=0, description=None):
+        mask = np.array(mask, dtype=bool)
+        if mask.ndim != 2:
+            raise ValueError('mask is not 2D: {}'.format(mask.shape))
+        
+        mask.flags.writeable = False
+        
+        self.mask = mask
+        self.min_x = min_x
+        self.min_y = min_y
+        self.description = description
+        
+        gxs, gys = np.nonzero(mask)
+        if not len(gxs):
+            raise ValueError('empty region')
+        
+        self.xs = gxs + min_x
+        self.ys = gys + min_y
+        self.num_cells = len(self.xs)
+        
+        #Look at the neighbours of every cell at once,
+        #with a ring of outside cells around the mask
+        padded = np.pad(mask, 1)
+        inner_mask = np.ones(self.num_cells, dtype=bool)
+        for disp in maps.ADJ_DISPS.values():
+            inner_mask &= padded[gxs + 1 + disp.x, gys + 1 + disp.y]
+        
+        self.inner_mask = inner_mask
+        self.inner = np.flatnonzero(inner_mask)
+        self.border = np.flatnonzero(~inner_mask)
+        
+        self.colours = (self.xs + self.ys) % 2
+        
+        self.coords_list = [maps.CoordPair(x, y) for x, y
+                            in zip(self.xs.tolist(), self.ys.tolist())]
+        self.border_coords = [self.coords_list[i] for i in self.border]
+        self.inner_coords = [self.coords_list[i] for i in self.inner]
+        
+        self.topologies = dict()
+    
+    def __len__(self):
+        return self.num_cells
+    
+    def __iter__(self):
+        return iter(self.coords_list)
+    
+    def __repr__(self):
+        return 'Region({})'.format(self.description)
+    
+    def get_topology(self, disp_function=maps.boundless_disp):
+        """
+        Return the Topology of the region with the given displacement
+        function, made the first time it's asked for.
+        Its cells are numbered the same as the region's.
+        Functions get_disp_key can't tell apart get a new one each time.
+        """
+        key = get_disp_key(disp_function)
+        
+        board = self.topologies.get(key)
+        if board is None:
+            #Only the plain shape can be made again from its description
+            description = None
+            if disp_function is maps.boundless_disp:
+                description = self.description
+            
+            board = topology.Topology(self.xs, self.ys, disp_function,
+                                      description)
+            if key is not None:
+                self.topologies[key] = board
+        
+        return board
+    
+    def match_border(self, packed, disp_function=maps.boundless_disp):
+        """
+        Change the border tiles in packed so every edge between two
+        border cells matches, since the builders never move them.
+        A diamond has no such edges, but rectangles and masks do.
+        
+        packed has the packed tile at each cell, with an extra slot at
+        the end for off the board, and is changed in place.
+        Each edge takes the side of the cell with the lower index.
+        """
+        board = self.get_topology(disp_function)
+        
+        is_border = np.zeros(self.num_cells + 1, dtype=bool)
+        is_border[self.border] = True
+        
+        mask = maps.TERRAIN_MASK
+        for d, (shift, adj_shift) in enumerate(maps.MATCH_SHIFTS):
+            adj = board.neighbours[self.border, d]
+            
+            #Only the higher cell of each edge changes, and only its
+            #side facing the lower one, so no change undoes another
+            later = is_border[adj] & (adj > self.border)
+            cells = self.border[later]
+            adj = adj[later]
+            
+            codes = (packed[cells] >> shift) & mask
+            packed[adj] = (packed[adj] & ~(mask << adj_shift))\
+                          | (codes << adj_shift)
+
+@functools.lru_cache(maxsize=MAX_REGIONS)
+def get_diamond_region(half_diag):
+    """
+    Return the diamond used by the swap builders,
+    from (0, 0) to (2 * half_diag, 0).
+    """
+    gxs, gys = np.indices((half_diag * 2 + 1, half_diag * 2 + 1))
+    mask = np.abs(gxs - half_diag) + np.abs(gys - half_diag) <= half_diag
+    
+    return Region(mask, 0, -half_diag,
+                  {'type': 'diamond', 'half_diag': half_diag})
+
+@functools.lru_cache(maxsize=MAX_REGIONS)
+def get_rectangle_region(width, height, min_x=0, min_y=0):
+    """
+    Return the width by height rectangle from (min_x, min_y).
+    """
+    mask = np.ones((width, height), dtype=bool)
+    
+    return Region(mask, min_x, min_y,
+                  {'type': 'rectangle',
+                   'width': width,
+                   'height': height,
+                   'min_x': min_x,
+                   'min_y': min_y})
+
+@functools.lru_cache(maxsize=MAX_REGIONS)
+def get_packed_mask_region(shape, mask_bytes, min_x, min_y):
+    """
+    Return the region of a mask given as bytes, so it can be cached.
+    """
+    mask = np.frombuffer(mask_bytes, dtype=bool).reshape(shape)
+    return Region(mask, min_x, min_y)
+
+def get_mask_region(mask, min_x=0, min_y=0):
+    """
+    Return the region of the cells where mask is true,
+    with mask[0, 0] at (min_x, min_y).
+    """
+    mask = np.asarray(mask, dtype=bool)
+    return get_packed_mask_region(mask.shape, mask.tobytes(), min_x, min_y)
+
+def clear_regions():
+    """
+    Forget the regions made so far.
+    """
+    get_diamond_region.cache_clear()
+    get_rectangle_region.cache_clear()
+    get_packed_mask_region.cache_clear()
\ No newline at end of file
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Nov 13 10:05:17 2021
+
+@author: rober
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import types
+
+import numpy as np
+
+import maps
+import tile_sampler
+
+#Change this whenever the layout of a cache entry changes
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'mapgen', 'samplers')
+
+#The arrays in each cache entry, one .npy file each
+ARRAY_NAMES = ('packed', 'weights', 'probs', 'aliases')
+
+#Terrains have to survive being written as JSON
+SAVABLE_TERRAIN_TYPES = (str, int, float, bool)
+
+#The code that makes the tables in a cache entry. A hash of it goes
+#in the key, so changing any of it uses a new entry
+ENTRY_FUNCTIONS = (tile_sampler.TileCatalogue.__init__,
+                   tile_sampler.get_segment_arrays,
+                   tile_sampler.pack_code_arrays,
+                   tile_sampler.get_weight_array,
+                   tile_sampler.get_alias_tables)
+
+def hash_code(code, hasher):
+    """
+    Add the bytecode of a code object, its constants and the names it
+    uses to a hashlib hasher, with the code of any functions inside it.
+    """
+    hasher.update(code.co_code)
+    hasher.update(repr(code.co_names).encode('utf-8'))
+    
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            hash_code(const, hasher)
+        else:
+            hasher.update(repr(const).encode('utf-8'))
+
+def get_code_hash(functions=ENTRY_FUNCTIONS):
+    """
+    Return a hash of the code of the given functions.
+    Bytecode changes between Python versions, so each version gets
+    its own entries.
+    """
+    hasher = hashlib.sha256()
+    for function in functions:
+        hash_code(function.__code__, hasher)
+    
+    return hasher.hexdigest()
+
+def get_cache_dir():
+    """
+    Return the cache directory, which can be set with MAPGEN_CACHE_DIR.
+    """
+    return os.environ.get('MAPGEN_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+def describe_weights(segment_weights, terrain_weights):
+    """
+    Return a JSON-friendly description of a weight configuration,
+    or None if it can't be described.
+    """
+    terrains = list()
+    for terrain, terrain_weight in terrain_weights.items():
+        if not isinstance(terrain, SAVABLE_TERRAIN_TYPES):
+            return None
+        
+        terrain_segment_weights = terrain_weight.segment_weights
+        if terrain_segment_weights is not None:
+            terrain_segment_weights = [float(weight) for weight
+                                       in terrain_segment_weights]
+        
+        terrains.append([terrain,
+                         float(terrain_weight.weight),
+                         terrain_segment_weights])
+    
+    return {'cache_version': CACHE_VERSION,
+            'weights_version': tile_sampler.WEIGHTS_VERSION,
+            'code_hash': get_code_hash(),
+            'segment_weights': [float(weight) for weight
+                                in segment_weights.segment_weights],
+            'terrains': terrains}
+
+def get_cache_key(description):
+    """
+    Return the stable hash of a weight configuration description.
+    """
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def translate_packed(packed, terrains):
+    """
+    Return cached packed tiles with the current terrain codes.
+    The cached codes are 1 for the first terrain, 2 for the next and so on.
+    """
+    code_table = np.arange(maps.TERRAIN_MASK + 1, dtype=np.int64)
+    for cache_code, terrain in enumerate(terrains, 1):
+        code_table[cache_code] = maps.TERRAINS.code(terrain)
+    
+    if np.array_equal(code_table, np.arange(maps.TERRAIN_MASK + 1)):
+        return packed
+    
+    translated = np.zeros(len(packed), dtype=np.int64)
+    for direction in maps.DIRECTIONS:
+        shift = maps.SECTION_SHIFTS[direction]
+        codes = (packed >> shift) & maps.TERRAIN_MASK
+        translated |= code_table[codes] << shift
+    
+    return translated
+
+def write_entry(entry_dir, description, segment_weights, terrain_weights):
+    """
+    Compile a sampler and write its tables to entry_dir.
+    """
+    terrains = [terrain for terrain, _, _ in description['terrains']]
+    
+    catalogue = tile_sampler.TileCatalogue(terrains)
+    weights = tile_sampler.get_weight_array(catalogue,
+                                            segment_weights,
+                                            terrain_weights)
+    probs, aliases = tile_sampler.get_alias_tables(weights)
+    
+    #Store the tiles with codes from the order of the terrains,
+    #since other processes might have given them other codes
+    cache_codes = np.indices((len(terrains),) * 4).reshape(4, -1).T + 1
+    
+    arrays = {'packed': tile_sampler.pack_code_arrays(cache_codes),
+              'weights': weights,
+              'probs': probs,
+              'aliases': aliases.astype(np.int64)}
+    
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(entry_dir, name + '.npy'), arrays[name])
+    
+    #The description goes last, so an entry with one is complete
+    with open(os.path.join(entry_dir, 'description.json'), 'w') as file:
+        json.dump(description, file)
+
+def read_entry(entry_dir):
+    """
+    Return a sampler from the tables in entry_dir,
+    with the arrays memory-mapped.
+    """
+    with open(os.path.join(entry_dir, 'description.json')) as file:
+        description = json.load(file)
+    
+    arrays = {name: np.load(os.path.join(entry_dir, name + '.npy'),
+                            mmap_mode='r')
+              for name in ARRAY_NAMES}
+    
+    terrains = [terrain for terrain, _, _ in description['terrains']]
+    packed = translate_packed(arrays['packed'], terrains)
+    
+    return tile_sampler.AliasTileSampler.from_arrays(packed,
+                                                     arrays['weights'],
+                                                     arrays['probs'],
+                                                     arrays['aliases'])
+
+def get_weighted_sampler(segment_weights, terrain_weights, cache_dir=None):
+    """
+    Return the same sampler as tile_sampler.get_weighted_sampler,
+    loading its tables from the cache if they've been made before,
+    and adding them to the cache otherwise.
+    
+    Entries are named by a hash of the weights, of the code that makes
+    the tables, and of tile_sampler.WEIGHTS_VERSION, so changing any of
+    them uses a new entry.
+    """
+    description = describe_weights(segment_weights, terrain_weights)
+    if description is None:
+        return tile_sampler.get_weighted_sampler(segment_weights,
+                                                 terrain_weights)
+    
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    
+    entry_dir = os.path.join(cache_dir, get_cache_key(description))
+    
+    if not os.path.exists(os.path.join(entry_dir, 'description.json')):
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        #Write the entry somewhere else and move it into place,
+        #so other processes never see half an entry
+        temp_dir = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            write_entry(temp_dir, description, segment_weights,
+                        terrain_weights)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            #Another process got there first
+            if not os.path.exists(os.path.join(entry_dir,
+                                               'description.json')):
+                raise
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+    
+    return read_entry(entry_dir)
\ No newline at end of file
@@ -7,7 +7,81 @@ Created on Sat Oct 16 16:01:50 2021
 
 import random
 
+import numpy as np
+
 import maps
+import tile_sampler
+import topology
+import regions
+import instruments
+from indexed_set import IndexedSet
+from mismatch_counter import MismatchCounter
+
+def match_tiles(tiles, needed, rng):
+    """
+    Rearrange tiles among cells so as many cells as possible get the
+    tile they need.
+    
+    The cells have to be independent, with none next to another,
+    so moving tiles between them doesn't change what they need.
+    
+    Parameters:
+        tiles:
+            The packed tile at each cell.
+        
+        needed:
+            The packed tile each cell needs.
+        
+        rng:
+            A numpy generator.
+    
+    Return:
+        new_tiles:
+            The rearranged tiles, the same ones as tiles.
+        
+        satisfied:
+            A mask of the cells that got the tile they need.
+    """
+    num = len(tiles)
+    keys = rng.random(num)
+    unmatched = tiles != needed
+    
+    #Line up the cells by the tile they have and by the tile they need.
+    #Cells that already have the tile they need come first in both,
+    #in the same order, so they keep their own tiles.
+    supply_order = np.lexsort((keys, unmatched, tiles))
+    demand_order = np.lexsort((keys, unmatched, needed))
+    
+    types, supply_starts, supply_counts = np.unique(tiles[supply_order],
+                                                    return_index=True,
+                                                    return_counts=True)
+    
+    #Where each cell comes among the cells needing the same tile
+    sorted_needed = needed[demand_order]
+    demand_ranks = np.arange(num)\
+                   - np.searchsorted(sorted_needed, sorted_needed)
+    
+    #The first so many cells needing each tile get one,
+    #up to the number of cells that have it
+    pos = np.minimum(np.searchsorted(types, sorted_needed), len(types) - 1)
+    available = np.where(types[pos] == sorted_needed, supply_counts[pos], 0)
+    gets = demand_ranks < available
+    
+    givers = supply_order[supply_starts[pos[gets]] + demand_ranks[gets]]
+    receivers = demand_order[gets]
+    
+    new_tiles = np.empty_like(tiles)
+    new_tiles[receivers] = tiles[givers]
+    
+    satisfied = np.zeros(num, dtype=bool)
+    satisfied[receivers] = True
+    
+    #The rest of the tiles go to the rest of the cells at random
+    given = np.zeros(num, dtype=bool)
+    given[givers] = True
+    new_tiles[~satisfied] = rng.permutation(tiles[~given])
+    
+    return new_tiles, satisfied
 
 class SwapMapBuilder:
     """
@@ -18,15 +92,28 @@ class SwapMapBuilder:
                  tile_map,
                  stop_amount,
                  border_sampler,
-                 interior_sampler):
+                 interior_sampler,
+                 region=None,
+                 observer=None):
+        """
+        The map fills region, or the diamond with half_diag if there's
+        no region.
+        observer is passed to the builder's Instruments.
+        """
         
         self.half_diag = half_diag
         self.tile_map = tile_map
         
-        if stop_amount is None:
+        if region is None:
+            region = regions.get_diamond_region(half_diag)
+        self.region = region
+        
+        if stop_amount is not None:
+            self.stop_amount = stop_amount
+        elif half_diag is not None:
             self.stop_amount = round(((half_diag ** 2) * 2) / 16)
         else:
-            self.stop_amount = stop_amount
+            self.stop_amount = round(len(region) / 16)
             
         self.border_sampler = border_sampler
         self.interior_sampler = interior_sampler
@@ -34,6 +121,9 @@ class SwapMapBuilder:
         self.tiles_from_coords = dict()
         self.coords_from_tiles = dict()
         self.frozen_coords = set()
+        
+        self.instruments = instruments.Instruments('SwapMapBuilder',
+                                                   observer)
     
     def make_border(self):
         """
@@ -41,37 +131,32 @@ class SwapMapBuilder:
         """
         
         # Get the border and inner coords
-        self.border_coords = set()
+        self.border_coords = self.region.border_coords
+        self.inner_coords = self.region.inner_coords
         
-        # from 0 to half_diag * 2
-        for x in range(self.half_diag * 2 + 1):
-            half_y = self.half_diag - abs(x - self.half_diag)
-            
-            self.border_coords.add(maps.CoordPair(x, -half_y))
-            self.border_coords.add(maps.CoordPair(x, half_y))
+        self.eligible_coords = set(self.inner_coords)
         
-        #This work is being done multiple times now
-        self.inner_coords = set()
-        for x in range(1, self.half_diag * 2):
-            half_y = self.half_diag - abs(x - self.half_diag)
-            
-            for y in range(-half_y + 1, half_y):
-                coords = maps.CoordPair(x, y)
-                if coords in self.border_coords:
-                    raise ValueError('coords: {}'.format(coords))
-                
-                self.inner_coords.add(coords)
+        # The cells are numbered, for keeping the board as arrays
+        self.board = self.region.get_topology(self.tile_map.disp_function)
         
-        self.eligible_coords = self.inner_coords.copy()
+        # No two cells of the same colour are next to each other
+        self.colours = self.region.colours
+        self.inner_mask = self.region.inner_mask
         
-        # Sample the border
-        for coords in self.border_coords:
-            tile = self.border_sampler.random_tile()
-            self.tile_map.add_tile(coords, tile)
+        # Sample the border, with the border cells next to each other
+        # matching, as nothing fixes those edges later
+        packed = np.zeros(self.board.num_cells + 1, dtype=np.int64)
+        border = self.region.border
+        packed[border] = self.border_sampler.random_packed(len(border))
+        self.region.match_border(packed, self.tile_map.disp_function)
+        
+        for coords, tile_packed in zip(self.border_coords,
+                                       packed[border].tolist()):
+            self.tile_map.add_tile(coords, maps.Tile.from_packed(tile_packed))
     
     def add_to_coords_from_tiles(self, coords, tile):
         if not tile in self.coords_from_tiles:
-            self.coords_from_tiles[tile] = set()
+            self.coords_from_tiles[tile] = IndexedSet()
         
         self.coords_from_tiles[tile].add(coords)
     
@@ -80,21 +165,65 @@ class SwapMapBuilder:
         Fill the interior with random tiles, without regard for edges matching.
         """
         
-        self.eligible_coords = self.inner_coords.copy()
+        self.eligible_coords = set(self.inner_coords)
         self.tiles_from_coords.clear()
         self.coords_from_tiles.clear()
         self.frozen_coords.clear()
         
-        # Sample the inner tiles
-        for coords in self.inner_coords:
-            tile = self.interior_sampler.random_tile()
-            
+        # Sample the inner tiles, all at once
+        num_inner = len(self.inner_coords)
+        inner_tiles = self.interior_sampler.random_tiles(num_inner)
+        for coords, tile in zip(self.inner_coords, inner_tiles):
             self.tiles_from_coords[coords] = tile
             self.add_to_coords_from_tiles(coords, tile)
         
         # Put the outer tiles in
         for coords in self.border_coords:
             self.tiles_from_coords[coords] = self.tile_map.at(coords)
+        
+        self.refresh_needed()
+    
+    def refresh_needed(self):
+        """
+        Work out the tile each cell needs for the whole board at once.
+        
+        packed and needed hold the packed tile at, and needed at,
+        each cell of self.board. The extra slot at the end of packed
+        stands for off the board.
+        mismatches counts the mismatched edges as tiles change.
+        """
+        packed = np.zeros(self.board.num_cells + 1, dtype=np.int64)
+        for i, coords in enumerate(self.board.coords_list):
+            packed[i] = self.tiles_from_coords[coords].packed
+        
+        self.mismatches = MismatchCounter(self.board, packed)
+        self.packed = self.mismatches.packed
+        self.needed = self.board.needed_tiles(packed).tolist()
+    
+    def update_needed(self, i):
+        """
+        Update what the neighbours of cell i need,
+        after the tile at cell i changes.
+        """
+        packed = self.packed[i]
+        needed = self.needed
+        off_board = self.board.off_board
+        
+        for adj, (shift, adj_shift) in zip(self.board.neighbour_lists[i],
+                                           maps.MATCH_SHIFTS):
+            if adj == off_board:
+                continue
+            
+            #The neighbour's side facing cell i needs to match
+            #cell i's side facing the neighbour
+            code = (packed >> shift) & maps.TERRAIN_MASK
+            needed[adj] = (needed[adj] & ~(maps.TERRAIN_MASK << adj_shift))\
+                          | (code << adj_shift)
+    
+    def set_packed(self, coords, tile):
+        i = self.board.index(coords)
+        self.mismatches.set_tile(i, tile.packed)
+        self.update_needed(i)
     
     def swap(self, coords_1, coords_2):
         # Get the tiles
@@ -109,6 +238,9 @@ class SwapMapBuilder:
         self.tiles_from_coords[coords_1] = tile_2
         self.tiles_from_coords[coords_2] = tile_1
         
+        self.set_packed(coords_1, tile_2)
+        self.set_packed(coords_2, tile_1)
+        
         # Swap in coords_from_tiles
         self.coords_from_tiles[tile_1].remove(coords_1)
         self.coords_from_tiles[tile_1].add(coords_2)
@@ -124,17 +256,8 @@ class SwapMapBuilder:
             self.coords_from_tiles[tile].remove(coords)
     
     def get_needed_tile(self, coords):
-        # Figure out what tile we need
-        terrains = list()
-        for direction in maps.Direction:
-            adj_coords = self.tile_map.in_direction(coords, direction)
-            adj_tile = self.tiles_from_coords[adj_coords]
-            terrain = adj_tile.sections[maps.OPPOSITES[direction]]
-            terrains.append(terrain)
-        
-        needed_tile = maps.Tile(*terrains)
-        
-        return needed_tile
+        # Look up what tile we need, which is kept up to date
+        return maps.Tile.from_packed(self.needed[self.board.index(coords)])
     
     def do_swapping_iteration(self):
         # Get the interior coords in a random order
@@ -143,6 +266,10 @@ class SwapMapBuilder:
         
         temp_frozen_coords = set()
         
+        #Counted here and handed over at the end, to keep the loop fast
+        accepted = 0
+        rejected = 0
+        
         for coords in shuffled_coords:
             # if these coords are frozen, skip them
             if coords in self.frozen_coords:
@@ -161,20 +288,26 @@ class SwapMapBuilder:
             # needed_tile = maps.Tile(*terrains)
             
             needed_tile = self.get_needed_tile(coords)
-            coords_at = self.coords_from_tiles.get(needed_tile, set()).copy()
-            
-            #Remove the tile we're on
-            coords_at.discard(coords)
+            coords_at = self.coords_from_tiles.get(needed_tile)
             
             #If none of the tiles work, continue
+            #(the tile we're on doesn't count)
             if not coords_at:
+                rejected += 1
+                continue
+            if len(coords_at) == 1 and coords in coords_at:
+                rejected += 1
                 continue
             
-            #Randomly select a tile
-            coords_at = list(coords_at)
-            other_coords = random.choice(coords_at)
+            #Randomly select a tile, other than the one we're on
+            other_coords = coords_at.choice(exclude=coords)
             
             self.swap(coords, other_coords)
+            accepted += 1
+            
+            #Stop as soon as the whole board matches
+            if not self.mismatches.count:
+                break
             
             # Make these coords
             # (and all adjacent coords, if they themselves aren't
@@ -186,10 +319,13 @@ class SwapMapBuilder:
                 
                 temp_frozen_coords.add(adj_coords)
                 # self.freeze_coords(adj_coords)
+        
+        self.instruments.count('swaps_accepted', accepted)
+        self.instruments.count('swaps_rejected', rejected)
     
     def refresh_eligibility(self):
         self.frozen_coords.clear()
-        self.eligible_coords = self.inner_coords.copy()
+        self.eligible_coords = set(self.inner_coords)
         self.coords_from_tiles.clear()
         
         for coords, tile in self.tiles_from_coords.items():
@@ -202,13 +338,15 @@ class SwapMapBuilder:
         self.coords_from_tiles[tile].remove(coords)
         
         self.add_to_coords_from_tiles(coords, new_tile)
+        self.set_packed(coords, new_tile)
     
     def resample_tiles(self):
-        print('Resampling {} tiles'.format(len(self.eligible_coords)))
+        self.instruments.count('resampled_tiles', len(self.eligible_coords))
         
-        for coords in self.eligible_coords:
+        num_eligible = len(self.eligible_coords)
+        new_tiles = self.interior_sampler.random_tiles(num_eligible)
+        for coords, new_tile in zip(self.eligible_coords, new_tiles):
             # tile = self.tiles_from_coords[coords]
-            new_tile = self.interior_sampler.random_tile()
             self.set_tile_at(coords, new_tile)
             
             # self.tiles_from_coords[coords] = new_tile
@@ -217,6 +355,8 @@ class SwapMapBuilder:
             # self.add_to_coords_from_tiles(coords, new_tile)
     
     def fill_in_needed_tiles(self):
+        self.instruments.count('filled_in_tiles', len(self.eligible_coords))
+        
         for coords in self.eligible_coords:
             new_tile = self.get_needed_tile(coords)
             self.set_tile_at(coords, new_tile)
@@ -225,7 +365,12 @@ class SwapMapBuilder:
         #Do iterations until nothing happens
         num_eligible = len(self.eligible_coords)
         while True:
-            self.do_swapping_iteration()
+            with self.instruments.phase('swapping'):
+                self.do_swapping_iteration()
+            self.instruments.count('iterations')
+            
+            if not self.mismatches.count:
+                return
             
             new_num_eligible = len(self.eligible_coords)
             if new_num_eligible == num_eligible:
@@ -239,39 +384,201 @@ class SwapMapBuilder:
         # Resample the tiles that didn't get frozen if there are enough
         # otherwise, just put the tiles we need in and call it good
         if num_eligible > self.stop_amount:
-            self.resample_tiles()
+            with self.instruments.phase('resample'):
+                self.resample_tiles()
         else:
-            self.fill_in_needed_tiles()
+            with self.instruments.phase('fill_in'):
+                self.fill_in_needed_tiles()
     
-    def make_map(self):
-        #Get the initial board
-        self.make_border()
-        self.sample_inner_tiles()
+    def get_board_arrays(self):
+        """
+        Return the packed tile at each cell, with an extra 0 at the end
+        for off the board, and a mask of the eligible cells.
+        """
+        packed = np.array(self.packed, dtype=np.int64)
+        eligible = np.array([coords in self.eligible_coords
+                             for coords in self.board.coords_list])
         
-        # Put tiles into possible positions until you can't
-        self.do_swapping_iterations()
-        print('1 Iteration')
+        return packed, eligible
+    
+    def set_board_arrays(self, packed, eligible):
+        """
+        Put the tiles and eligibility from arrays back on the board.
+        """
+        self.tiles_from_coords.clear()
+        self.coords_from_tiles.clear()
+        self.eligible_coords = set()
+        self.frozen_coords.clear()
         
-        done = False
-        i = 2
-        while not done:
-            #See if the map works as is
-            done = True
-            try:
-                test_map = maps.TileMap(self.tile_map.disp_function)
-                for coords, tile in self.tiles_from_coords.items():
-                    test_map.add_tile(coords, tile)
-            except ValueError:
-                done = False
+        for coords, tile_packed, is_eligible, is_inner\
+                in zip(self.board.coords_list,
+                       packed.tolist(),
+                       eligible.tolist(),
+                       self.inner_mask.tolist()):
+            tile = maps.Tile.from_packed(tile_packed)
+            self.tiles_from_coords[coords] = tile
             
-            if done:
+            if is_eligible:
+                self.eligible_coords.add(coords)
+                self.add_to_coords_from_tiles(coords, tile)
+            elif is_inner:
+                self.frozen_coords.add(coords)
+        
+        self.refresh_needed()
+    
+    def do_batched_iteration(self, packed, eligible, rng):
+        """
+        Like do_swapping_iteration, but one colour of the checkerboard
+        at a time, with every cell of the colour done at once.
+        Tiles only move between cells of the same colour, so the tiles
+        the cells of a colour need don't change while they move.
+        Cells that get the tile they need stop being eligible.
+        
+        Changes packed and eligible in place.
+        """
+        for colour in (0, 1):
+            cells = np.flatnonzero(eligible & (self.colours == colour))
+            if not len(cells):
+                continue
+            
+            needed = self.board.needed_tiles(packed)[cells]
+            new_tiles, satisfied = match_tiles(packed[cells], needed, rng)
+            
+            packed[cells] = new_tiles
+            eligible[cells[satisfied]] = False
+            
+            num_satisfied = np.count_nonzero(satisfied)
+            self.instruments.count('swaps_accepted', num_satisfied)
+            self.instruments.count('swaps_rejected',
+                                   len(cells) - num_satisfied)
+    
+    def count_mismatched(self, packed):
+        """
+        Return the number of cells without the tile they need,
+        border cells included, so the map matches when this is 0.
+        """
+        mismatched = topology.get_mismatched_cells(packed[:-1], packed,
+                                                   self.board.neighbours)
+        
+        return int(np.count_nonzero(mismatched))
+    
+    def do_batched_iterations(self, packed, eligible, rng):
+        """
+        Like do_swapping_iterations, with do_batched_iteration.
+        """
+        #Do iterations until nothing happens
+        num_eligible = np.count_nonzero(eligible)
+        while True:
+            with self.instruments.phase('swapping'):
+                self.do_batched_iteration(packed, eligible, rng)
+            self.instruments.count('iterations')
+            
+            if not self.count_mismatched(packed):
+                return
+            
+            new_num_eligible = np.count_nonzero(eligible)
+            if new_num_eligible == num_eligible:
                 break
             
+            num_eligible = new_num_eligible
+        
+        # Resample the tiles that didn't get frozen if there are enough
+        # otherwise, just put the tiles we need in and call it good
+        cells = np.flatnonzero(eligible)
+        if num_eligible > self.stop_amount:
+            with self.instruments.phase('resample'):
+                self.instruments.count('resampled_tiles', len(cells))
+                packed[cells] = self.interior_sampler.random_packed(len(cells))
+        else:
+            with self.instruments.phase('fill_in'):
+                self.instruments.count('filled_in_tiles', len(cells))
+                
+                # One colour at a time, so each cell gets what it needs
+                # after its neighbours are filled in
+                for colour in (0, 1):
+                    colour_cells = cells[self.colours[cells] == colour]
+                    needed = self.board.needed_tiles(packed)
+                    packed[colour_cells] = needed[colour_cells]
+    
+    def start_board(self):
+        """
+        Put in the border and fill the interior with random tiles.
+        """
+        with self.instruments.phase('make_border'):
+            self.make_border()
+        with self.instruments.phase('sample_inner_tiles'):
+            self.sample_inner_tiles()
+    
+    def report_round(self, i, num_mismatched, num_eligible):
+        """
+        Send the state of the board after a round of iterations
+        to the instruments.
+        """
+        self.instruments.count('rounds')
+        self.instruments.emit('round',
+                              round=i,
+                              mismatched=num_mismatched,
+                              eligible=num_eligible,
+                              frozen=len(self.inner_coords) - num_eligible)
+    
+    def save_tiles(self):
+        """
+        Save the inner tiles to the map.
+        """
+        with self.instruments.phase('save'):
+            self.tile_map.add_tiles({coords: self.tiles_from_coords[coords]
+                                     for coords in self.inner_coords})
+    
+    def make_map_batched(self):
+        """
+        Like make_map, with batched iterations on arrays.
+        The mismatches in round events count cells, not edges.
+        """
+        #Get the initial board
+        self.start_board()
+        
+        packed, eligible = self.get_board_arrays()
+        rng = tile_sampler.get_numpy_rng()
+        
+        i = 1
+        while True:
+            self.do_batched_iterations(packed, eligible, rng)
+            
+            num_mismatched = self.count_mismatched(packed)
+            self.report_round(i, num_mismatched,
+                              int(np.count_nonzero(eligible)))
+            i += 1
+            
+            if not num_mismatched:
+                break
+        
+        self.set_board_arrays(packed, eligible)
+        
+        #Save what we have to the map
+        self.save_tiles()
+    
+    def make_map(self, batched=False):
+        """
+        Fill the map, sending a round event with the number of
+        mismatched edges after each round of iterations.
+        """
+        if batched:
+            return self.make_map_batched()
+        
+        #Get the initial board
+        self.start_board()
+        
+        # Put tiles into possible positions until you can't
+        i = 1
+        while True:
             self.do_swapping_iterations()
-            print('{} Iterations'.format(i))
+            self.report_round(i, self.mismatches.count,
+                              len(self.eligible_coords))
             i += 1
+            
+            #See if the map works as is
+            if not self.mismatches.count:
+                break
         
         #Save what we have to the map
-        for coords, tile in self.tiles_from_coords.items():
-            if coords in self.inner_coords:
-                self.tile_map.add_tile(coords, tile)
\ No newline at end of file
+        self.save_tiles()
\ No newline at end of file
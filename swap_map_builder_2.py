@@ -7,7 +7,40 @@ Created on Sat Oct 16 18:42:40 2021
 
 import random
 
+import numpy as np
+
 import maps
+import regions
+import instruments
+import annealing
+import tile_sampler
+from mismatch_counter import MismatchCounter, get_swap_deltas
+
+#The column of the opposite side, for each column of a neighbour table
+OPPOSITE_COLUMNS = np.array([maps.SECTION_INDICES[maps.OPPOSITES[direction]]
+                             for direction in maps.DIRECTIONS])
+
+#The code off the board, which no side matches, as no tile has
+#the wildcard on a side
+OFF_BOARD_CODE = maps.WILDCARD
+
+#Terrain codes have to fit in the uint8s BatchSwapper keeps them in
+assert maps.TERRAIN_BITS <= 8
+
+def count_unequal(codes_1, codes_2):
+    """
+    Return the number of places each row of four codes differs,
+    for flat uint8 arrays of codes, four to a row.
+    """
+    unequal = codes_1 != codes_2
+    
+    #Each row of bools is one 32 bit word, so counting its bits counts
+    #the rows far faster than count_nonzero along an axis.
+    #bitwise_count needs numpy 2.0
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(unequal.view(np.uint32)).ravel()
+    
+    return np.count_nonzero(unequal.reshape(-1, 4), axis=1)
 
 def num_differences(tile_1, tile_2):
     """
@@ -15,60 +48,280 @@ def num_differences(tile_1, tile_2):
     """
     num = 0
     
-    for direction in maps.Direction:
+    for code_1, code_2 in zip(tile_1.codes, tile_2.codes):
         #None matches everything
-        if tile_1.sections[direction] == None:
-            continue
-        if tile_2.sections[direction] == None:
+        if code_1 == maps.WILDCARD or code_2 == maps.WILDCARD:
             continue
         
-        if tile_1.sections[direction] != tile_2.sections[direction]:
+        if code_1 != code_2:
             num += 1
     
     return num
 
+def num_packed_differences(packed_1, packed_2):
+    """
+    Return the number of differences between two packed tiles,
+    as in num_differences.
+    """
+    num = 0
+    
+    mask = maps.TERRAIN_MASK
+    for shift, _ in maps.MATCH_SHIFTS:
+        code_1 = (packed_1 >> shift) & mask
+        code_2 = (packed_2 >> shift) & mask
+        
+        if code_1 != code_2 and maps.WILDCARD not in (code_1, code_2):
+            num += 1
+    
+    return num
+
+class BatchSwapper:
+    """
+    Makes random swaps like StochSwapMapBuilder.do_random_swap,
+    a batch at a time with numpy.
+    
+    The pairs of a batch are drawn and judged against the board all at
+    once. The batch is then cut at the first pair with a cell or a
+    neighbour changed by an earlier swap in it, so every pair that's
+    kept is judged just as it would be one at a time. The pairs after
+    the cut are dropped without counting, as if never drawn.
+    
+    The batch size grows while whole batches are kept and shrinks to
+    about twice what was kept when they aren't.
+    
+    If not exact, only the pairs changed by an earlier swap in the
+    batch are dropped, and the rest are kept. The swaps made never
+    touch each other, so each is still judged right, but pairs near
+    other swaps are dropped more often, so it's only close to making
+    swaps one at a time. Batches stay much bigger while most swaps are
+    taken, early on.
+    
+    packed is an array of the packed tile at each cell, with an extra
+    slot at the end for off the board, and count the number of
+    mismatched edges.
+    The board is also kept as codes, with a row of the section codes
+    of each cell, in the order of the neighbour table, and facing_codes,
+    with a row of the codes each cell's sides meet, so the swaps can be
+    judged without unpacking tiles.
+    """
+    def __init__(self, board, packed, count, rng,
+                 batch_size=256, max_batch_size=1 << 16, exact=True):
+        self.board = board
+        self.exact = exact
+        self.packed = np.array(packed, dtype=np.int64)
+        self.count = count
+        self.rng = rng
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        
+        self.codes = np.full((board.num_cells + 1, 4), OFF_BOARD_CODE,
+                             dtype=np.uint8)
+        for d, direction in enumerate(maps.DIRECTIONS):
+            self.codes[:-1, d] = maps.get_section_codes(self.packed[:-1],
+                                                        direction)
+        
+        #Where in the flattened codes the side facing each side
+        #of each cell is
+        self.facing = board.neighbours * 4 + OPPOSITE_COLUMNS
+        
+        #With a spare row at the end, where sides facing off the board
+        #are written to
+        self.facing_codes = np.full_like(self.codes, OFF_BOARD_CODE)
+        self.facing_codes[:-1] = self.codes.ravel()[self.facing]
+        
+        #Rows of four codes as single words, which are far faster to
+        #pick out
+        self.code_words = self.codes.view(np.uint32).ravel()
+        self.facing_words = self.facing_codes.view(np.uint32).ravel()
+        
+        #The first swap of a batch to change each cell or a neighbour,
+        #with no_swap for cells with none
+        self.no_swap = np.iinfo(np.int64).max
+        self.first_change = np.full(board.num_cells + 1, self.no_swap)
+    
+    def get_deltas(self, cells_1, cells_2):
+        """
+        Return how much the count would change with each swap,
+        as in get_swap_deltas.
+        """
+        codes_1 = self.code_words[cells_1].view(np.uint8)
+        codes_2 = self.code_words[cells_2].view(np.uint8)
+        facing_1 = self.facing_words[cells_1].view(np.uint8)
+        facing_2 = self.facing_words[cells_2].view(np.uint8)
+        
+        #Edges off the board never match, before or after,
+        #so they make no difference
+        deltas = count_unequal(codes_2, facing_1).astype(np.int64)
+        deltas -= count_unequal(codes_1, facing_1)
+        deltas += count_unequal(codes_1, facing_2)
+        deltas -= count_unequal(codes_2, facing_2)
+        
+        #Cells next to each other change what the other one faces,
+        #which get_swap_deltas takes care of
+        adjacent = np.flatnonzero((self.board.neighbours[cells_1]
+                                   == cells_2[:, None]).any(axis=1))
+        if len(adjacent):
+            deltas[adjacent] = get_swap_deltas(self.board, self.packed,
+                                               cells_1[adjacent],
+                                               cells_2[adjacent])
+        
+        return deltas
+    
+    def do_batch(self, num_swaps, temperature):
+        """
+        Propose up to num_swaps swaps, stopping early at a conflict,
+        if exact, or once every edge matches.
+        Returns how many were proposed and how many were made.
+        """
+        board = self.board
+        packed = self.packed
+        
+        cells_1 = self.rng.integers(board.num_cells, size=num_swaps)
+        cells_2 = self.rng.integers(board.num_cells, size=num_swaps)
+        
+        deltas = self.get_deltas(cells_1, cells_2)
+        
+        if temperature > 0:
+            probabilities = np.exp(-np.maximum(deltas, 0) / temperature)
+            accepted = self.rng.random(num_swaps) < probabilities
+        else:
+            accepted = deltas < 0
+        
+        #Swapping the same tiles changes nothing
+        changes = np.flatnonzero(accepted
+                                 & (packed[cells_1] != packed[cells_2]))
+        
+        #A swap reads both cells and their neighbours, so it's changed
+        #by an earlier swap of either cell or of one of their neighbours
+        kept = np.ones(num_swaps, dtype=bool)
+        num_kept = num_swaps
+        if len(changes):
+            changed = np.concatenate((cells_1[changes], cells_2[changes]))
+            touched = np.concatenate((changed[:, None],
+                                      board.neighbours[changed]), axis=1)
+            
+            first_change = self.first_change
+            np.minimum.at(first_change, touched.ravel(),
+                          np.repeat(np.tile(changes, 2), 5))
+            
+            changed_before = np.minimum(first_change[cells_1],
+                                        first_change[cells_2])\
+                             < np.arange(num_swaps)
+            
+            first_change[touched] = self.no_swap
+            
+            if not self.exact:
+                kept = ~changed_before
+            elif changed_before.any():
+                num_kept = int(np.argmax(changed_before))
+        
+        #Stop as soon as every edge matches
+        kept_deltas = np.where(accepted & kept, deltas, 0)
+        counts = self.count + np.cumsum(kept_deltas)
+        if not counts[:num_kept].all():
+            num_kept = int(np.argmin(counts[:num_kept] != 0)) + 1
+        
+        kept[num_kept:] = False
+        
+        made = changes[kept[changes]]
+        made_1 = cells_1[made]
+        made_2 = cells_2[made]
+        packed[made_1], packed[made_2] = packed[made_2], packed[made_1]
+        
+        words = self.code_words
+        words[made_1], words[made_2] = words[made_2], words[made_1]
+        
+        #Each side of a cell is the side its neighbour there faces
+        swapped = np.concatenate((made_1, made_2))
+        self.facing_codes.ravel()[self.facing[swapped]] = self.codes[swapped]
+        
+        if num_kept:
+            self.count = int(counts[num_kept - 1])
+        
+        num_proposed = int(np.count_nonzero(kept))
+        if num_proposed == num_swaps\
+                or (not self.exact and num_proposed * 2 >= num_swaps):
+            self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+        else:
+            self.batch_size = max(2 * num_proposed, 16)
+        
+        return num_proposed, int(np.count_nonzero(accepted & kept))
+    
+    def do_swaps(self, num_swaps, temperature=0.0):
+        """
+        Propose num_swaps swaps, or fewer if every edge comes to match.
+        Returns how many were proposed and how many were made.
+        """
+        num_done = 0
+        num_accepted = 0
+        
+        while num_done < num_swaps and self.count:
+            batch_size = min(self.batch_size, num_swaps - num_done)
+            num_kept, batch_accepted = self.do_batch(batch_size, temperature)
+            
+            num_done += num_kept
+            num_accepted += batch_accepted
+        
+        return num_done, num_accepted
+
 class StochSwapMapBuilder:
-    def __init__(self, half_diag, tile_map, sampler, num_swaps):
+    def __init__(self, half_diag, tile_map, sampler, num_swaps, region=None,
+                 observer=None):
+        """
+        The map fills region, or the diamond with half_diag if there's
+        no region.
+        observer is passed to the builder's Instruments.
+        """
         self.half_diag = half_diag
         self.tile_map = tile_map
         self.sampler = sampler
         self.num_swaps = num_swaps
         
-        self.all_coords = set()
-        self.tiles_from_coords = dict()
+        self.instruments = instruments.Instruments('StochSwapMapBuilder',
+                                                   observer)
         
-        # Initialize all_coords
-        for x in range(self.half_diag * 2 + 1):
-            half_y = self.half_diag - abs(x - self.half_diag)
-            
-            for y in range(-half_y, half_y + 1):
-                coords = maps.CoordPair(x, y)
-                
-                self.all_coords.add(coords)
+        if region is None:
+            region = regions.get_diamond_region(half_diag)
+        self.region = region
+        
+        self.tiles_from_coords = dict()
         
         # For random sampling
-        self.all_coords_list = list(self.all_coords)
+        self.all_coords_list = region.coords_list
         
-        # Sample the initial tiles
-        for coords in self.all_coords:
-            tile = self.sampler.random_tile()
+        # Sample the initial tiles, all at once
+        with self.instruments.phase('sample'):
+            tiles = self.sampler.random_tiles(len(region))
+        for coords, tile in zip(self.all_coords_list, tiles):
             self.tiles_from_coords[coords] = tile
+        
+        # Keep count of the mismatched edges as tiles move
+        self.board = region.get_topology(self.tile_map.disp_function)
+        
+        packed = np.zeros(self.board.num_cells + 1, dtype=np.int64)
+        packed[:-1] = [tile.packed for tile in tiles]
+        
+        self.mismatches = MismatchCounter(self.board, packed)
+        
+        #The tiles that would be better at a cell, from the tile it
+        #needs and the tile it has, for do_targeted_swap
+        self.better_tiles = dict()
+        self.num_tile_types = 0
     
     def get_needed_tile(self, coords):
         # Figure out what tile we need
-        terrains = list()
-        for direction in maps.Direction:
+        # coords off the board leave the wildcard in place
+        packed = 0
+        for direction in maps.DIRECTIONS:
             adj_coords = self.tile_map.in_direction(coords, direction)
             
-            if not adj_coords in self.all_coords:
-                terrain = None
-            else:
+            if adj_coords in self.tiles_from_coords:
                 adj_tile = self.tiles_from_coords[adj_coords]
-                terrain = adj_tile.sections[maps.OPPOSITES[direction]]
-            
-            terrains.append(terrain)
+                _, adj_i = maps.MATCH_INDICES[direction]
+                packed |= adj_tile.codes[adj_i]\
+                          << maps.SECTION_SHIFTS[direction]
         
-        needed_tile = maps.Tile(*terrains)
+        needed_tile = maps.Tile.from_packed(packed)
         
         return needed_tile
     
@@ -78,57 +331,278 @@ class StochSwapMapBuilder:
         return num_differences(tile, needed)
     
     def swap(self, coords_1, coords_2):
-        tile_1 = self.tiles_from_coords[coords_1]
-        tile_2 = self.tiles_from_coords[coords_2]
+        self.swap_cells(self.board.index(coords_1),
+                        self.board.index(coords_2))
+    
+    def swap_cells(self, i, j):
+        """
+        Swap the tiles of the cells with indices i and j.
+        """
+        coords_list = self.all_coords_list
+        coords_i = coords_list[i]
+        coords_j = coords_list[j]
+        
+        tile_i = self.tiles_from_coords[coords_i]
+        tile_j = self.tiles_from_coords[coords_j]
+        
+        self.tiles_from_coords[coords_i] = tile_j
+        self.tiles_from_coords[coords_j] = tile_i
         
-        self.tiles_from_coords[coords_1] = tile_2
-        self.tiles_from_coords[coords_2] = tile_1
+        self.mismatches.set_tile(i, tile_j.packed)
+        self.mismatches.set_tile(j, tile_i.packed)
     
-    def do_random_swap(self):
+    def set_tile_at(self, coords, tile):
+        self.tiles_from_coords[coords] = tile
+        self.mismatches.set_tile(self.board.index(coords), tile.packed)
+    
+    def do_random_swap(self, temperature=0.0):
         """
         Swap two randomly chosen coords if doing so improves the map.
+        Returns whether they were swapped.
+        
+        The cost is the change in mismatched edges, worked out from just
+        the edges of the two cells, so it's right for cells next to
+        each other too.
+        Above a temperature of 0, swaps that don't improve the map are
+        also made, with the Metropolis probability.
         """
-        coords_1 = random.choice(self.all_coords_list)
-        coords_2 = random.choice(self.all_coords_list)
+        num_cells = self.board.num_cells
+        i = random.randrange(num_cells)
+        j = random.randrange(num_cells)
         
-        tile_1 = self.tiles_from_coords[coords_1]
-        tile_2 = self.tiles_from_coords[coords_2]
+        return self.try_swap(i, j, temperature)
+    
+    def try_swap(self, i, j, temperature=0.0):
+        """
+        Swap the tiles of cells i and j if that improves the map,
+        or with the Metropolis probability if it doesn't.
+        Returns whether they were swapped.
+        """
+        delta = self.mismatches.swap_delta(i, j)
+        
+        if delta >= 0:
+            if temperature <= 0:
+                return False
+            
+            probability = annealing.acceptance_probability(delta, temperature)
+            if random.random() >= probability:
+                return False
+        
+        self.swap_cells(i, j)
+        return True
+    
+    def get_better_tiles(self, i):
+        """
+        Return the packed tiles on the board that would have fewer
+        differences from the tile cell i needs than the one it has.
+        """
+        mismatches = self.mismatches
+        mismatches.index_tiles()
+        cells_from_tile = mismatches.cells_from_tile
+        
+        #Tiles only move around while swapping, but if new ones come
+        #in, the lists have to be made again
+        if len(cells_from_tile) != self.num_tile_types:
+            self.better_tiles.clear()
+            self.num_tile_types = len(cells_from_tile)
         
-        needed_1 = self.get_needed_tile(coords_1)
-        needed_2 = self.get_needed_tile(coords_2)
+        needed = mismatches.get_needed(i)
+        packed = mismatches.packed[i]
         
-        current_cost = num_differences(tile_1, needed_1) +\
-                       num_differences(tile_2, needed_2)
+        better = self.better_tiles.get((needed, packed))
+        if better is None:
+            error = num_packed_differences(packed, needed)
+            better = [tile for tile in cells_from_tile
+                      if num_packed_differences(tile, needed) < error]
+            
+            self.better_tiles[(needed, packed)] = better
+        
+        return better
+    
+    def do_targeted_swap(self, temperature=0.0):
+        """
+        Like do_random_swap, but the first cell is drawn from the cells
+        with mismatched edges, and the second from the cells with a
+        tile that would have fewer there, so once the map is mostly
+        right the swaps aren't wasted on cells that already match.
+        If no tile would be better, the second cell is drawn from
+        the whole board.
+        """
+        mismatches = self.mismatches
+        if not mismatches.erroneous:
+            return False
+        
+        i = mismatches.erroneous.choice()
         
-        swapped_cost = num_differences(tile_1, needed_2) +\
-                       num_differences(tile_2, needed_1)
+        cells = None
+        better = self.get_better_tiles(i)
+        if better:
+            cells = mismatches.cells_from_tile[random.choice(better)]
         
-        if swapped_cost < current_cost:
-            self.swap(coords_1, coords_2)
+        if cells:
+            j = cells.choice()
+        else:
+            j = random.randrange(self.board.num_cells)
+        
+        return self.try_swap(i, j, temperature)
+    
+    def set_board(self, packed):
+        """
+        Put the packed tiles back on the board, as from mismatches.packed.
+        """
+        for i, (tile_packed, old_packed) in enumerate(zip(packed,
+                                                          self.mismatches
+                                                          .packed)):
+            if tile_packed != old_packed:
+                self.set_tile_at(self.all_coords_list[i],
+                                 maps.Tile.from_packed(tile_packed))
     
     def fill_in_needed(self):
+        """
+        Give every cell the tile it needs, one at a time, so each
+        matches the cells filled in before it.
+        Sides off the board keep what the tile there has, so border
+        cells next to each other get matched too.
+        """
         filled_in = 0
-        for coords in self.all_coords:
+        for coords in self.all_coords_list:
             needed = self.get_needed_tile(coords)
             
-            skip = False
-            for direction in maps.Direction:
-                if needed.sections[direction] == None:
-                    skip = True
-                    break
-            if skip:
-                continue
+            match_mask = tile_sampler.get_match_mask(needed.packed)
+            needed = maps.Tile.from_packed(
+                needed.packed
+                | (self.tiles_from_coords[coords].packed & ~match_mask))
             
             if needed != self.tiles_from_coords[coords]:
                 filled_in += 1
-                self.tiles_from_coords[coords] = needed
-        print('Filled in {} tiles'.format(filled_in))
+                self.set_tile_at(coords, needed)
+        
+        self.instruments.count('filled_in_tiles', filled_in)
     
-    def make_map(self, num_swaps):
-        for _ in range(num_swaps):
-            self.do_random_swap()
+    def is_consistent(self):
+        """
+        Return whether every edge on the board matches.
+        """
+        return self.mismatches.count == 0
+    
+    def do_swaps(self, num_swaps, temperature=0.0, targeted=False):
+        """
+        Propose num_swaps swaps with do_random_swap, or do_targeted_swap
+        if targeted, or fewer if every edge comes to match,
+        like BatchSwapper.do_swaps.
+        Returns how many were proposed and how many were made.
+        """
+        mismatches = self.mismatches
+        
+        propose = self.do_random_swap
+        if targeted:
+            propose = self.do_targeted_swap
+        
+        num_done = 0
+        num_accepted = 0
+        while num_done < num_swaps and mismatches.count:
+            num_accepted += propose(temperature)
+            num_done += 1
+        
+        return num_done, num_accepted
+    
+    def do_sweeps(self, num_swaps, schedule=None, patience=None,
+                  batched=False, targeted=False, exact=True):
+        """
+        Do up to num_swaps random swaps, a sweep of as many swaps as
+        there are cells at a time, stopping once every edge matches.
+        
+        schedule gives the temperature for each sweep, from the number
+        of the sweep, as in the annealing module. With no schedule,
+        only swaps that improve the map are made.
+        If patience is given, stops after that many sweeps without the
+        number of mismatched edges going down.
+        The board with the fewest mismatched edges is kept.
+        If batched, the swaps are made by a BatchSwapper, exact or not,
+        and if targeted, by do_targeted_swap. They can't both be used.
+        
+        A sweep event goes to the instruments after every sweep,
+        with the number of mismatched edges, so the energy can be
+        followed.
+        """
+        sweep_size = self.board.num_cells
+        
+        do_swaps = lambda num, temperature: self.do_swaps(num, temperature,
+                                                          targeted)
+        get_count = lambda: self.mismatches.count
+        get_packed = lambda: list(self.mismatches.packed)
+        if batched:
+            if targeted:
+                raise ValueError('targeted swaps can\'t be batched')
+            
+            swapper = BatchSwapper(self.board,
+                                   self.mismatches.packed,
+                                   self.mismatches.count,
+                                   tile_sampler.get_numpy_rng(),
+                                   exact=exact)
+            do_swaps = swapper.do_swaps
+            get_count = lambda: swapper.count
+            get_packed = lambda: swapper.packed.tolist()
+        
+        plateau = None
+        if patience is not None:
+            plateau = annealing.PlateauDetector(patience)
+        
+        #Annealing can make the board worse, so keep the best one
+        best_count = get_count()
+        best_packed = None
+        if schedule is not None:
+            best_packed = get_packed()
+        
+        accepted = 0
+        num_done = 0
+        
+        sweep = 0
+        while num_done < num_swaps and get_count():
+            temperature = 0.0 if schedule is None else schedule(sweep)
+            
+            sweep_done, sweep_accepted = do_swaps(
+                min(sweep_size, num_swaps - num_done), temperature)
+            num_done += sweep_done
+            accepted += sweep_accepted
+            
+            sweep += 1
+            self.instruments.emit('sweep',
+                                  sweep=sweep,
+                                  swaps=num_done,
+                                  accepted=accepted,
+                                  temperature=temperature,
+                                  mismatched=get_count())
+            
+            if get_count() < best_count and schedule is not None:
+                best_count = get_count()
+                best_packed = get_packed()
+            
+            if plateau is not None and plateau.update(get_count()):
+                self.instruments.emit('plateau', sweep=sweep, swaps=num_done)
+                break
+        
+        #Put the board the swapper ended with, or the best one, back
+        if best_packed is not None and get_count() > best_count:
+            self.set_board(best_packed)
+        elif batched:
+            self.set_board(get_packed())
+        
+        self.instruments.count('swaps_accepted', accepted)
+        self.instruments.count('swaps_rejected', num_done - accepted)
+    
+    def make_map(self, num_swaps, schedule=None, patience=None,
+                 batched=False, targeted=False, exact=True):
+        """
+        Do up to num_swaps random swaps with do_sweeps, then fill in
+        the rest.
+        """
+        with self.instruments.phase('swapping'):
+            self.do_sweeps(num_swaps, schedule, patience, batched, targeted,
+                           exact)
         
-        self.fill_in_needed()
+        with self.instruments.phase('fill_in'):
+            self.fill_in_needed()
         
-        for coords, tile in self.tiles_from_coords.items():
-            self.tile_map.add_tile(coords, tile)
\ No newline at end of file
+        with self.instruments.phase('save'):
+            self.tile_map.add_tiles(self.tiles_from_coords)
\ No newline at end of file
@@ -6,9 +6,12 @@ Created on Fri Oct 15 13:34:52 2021
 """
 
 from random import randint
+from bisect import bisect_left, bisect_right
+import random
 import math
 import itertools
 
+import numpy as np
 from numpy import sign
 
 import maps
@@ -81,6 +84,24 @@ class TerrainWeight:
                     weight *= self.segment_weights[segment.size - 1]
         
         return weight
+    
+    def get_weight_array(self, catalogue):
+        """
+        Return the weights this terrainweight assigns to every tile
+        in a TileCatalogue.
+        """
+        is_terrain = catalogue.codes == maps.TERRAINS.code(self.terrain)
+        
+        #Handle the terrain weight
+        weights = float(self.weight) ** is_terrain.sum(axis=1)
+        
+        #Handle the segment weights, if any
+        if self.segment_weights is not None:
+            weights *= get_segment_weight_array(catalogue,
+                                                self.segment_weights,
+                                                is_terrain)
+        
+        return weights
 
 class SegmentWeights:
     """
@@ -99,6 +120,104 @@ class SegmentWeights:
             weight *= self.segment_weights[segment.size - 1]
         
         return weight
+    
+    def get_weight_array(self, catalogue):
+        """
+        Return the weights this segmentweights assigns to every tile
+        in a TileCatalogue.
+        """
+        return get_segment_weight_array(catalogue, self.segment_weights)
+
+def get_segment_arrays(codes):
+    """
+    Return where the segments of the given tiles start, and their sizes.
+    
+    Parameters:
+        codes:
+            An (N, 4) array of terrain codes, in maps.DIRECTIONS order.
+    
+    Return:
+        starts:
+            An (N, 4) bool array, true where a segment starts.
+            The segment of a tile with only one terrain starts at 0.
+        
+        sizes:
+            An (N, 4) array of the size of the segment starting at each
+            section, where one does.
+    """
+    #A segment starts wherever the terrain differs from the one before,
+    #going around the tile
+    starts = codes != np.roll(codes, 1, axis=1)
+    starts[~starts.any(axis=1), 0] = True
+    
+    #The size of a segment is how far away the next one starts
+    sizes = np.full(codes.shape, 4, dtype=np.int64)
+    for i in range(4):
+        for dist in (3, 2, 1):
+            sizes[:, i] = np.where(starts[:, (i + dist) % 4],
+                                   dist,
+                                   sizes[:, i])
+    
+    return starts, sizes
+
+def get_segment_weight_array(catalogue, segment_weights, mask=None):
+    """
+    Return the product of the segment weights of each tile's segments,
+    counting only segments that start where mask is true, if it's given.
+    """
+    segment_weights = np.asarray(segment_weights, dtype=float)
+    
+    starts = catalogue.segment_starts
+    if mask is not None:
+        starts = starts & mask
+    
+    factors = np.where(starts,
+                       segment_weights[catalogue.segment_sizes - 1],
+                       1.0)
+    
+    return factors.prod(axis=1)
+
+def pack_code_arrays(codes):
+    """
+    Return the packed forms of an (N, 4) array of terrain codes.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    
+    packed = np.zeros(len(codes), dtype=np.int64)
+    for i, direction in enumerate(maps.DIRECTIONS):
+        packed |= codes[:, i] << maps.SECTION_SHIFTS[direction]
+    
+    return packed
+
+class TileCatalogue:
+    """
+    All possible tiles with the given terrain types,
+    held as an (N, 4) array of terrain codes in maps.DIRECTIONS order.
+    The tiles are in the same order as get_all_tiles makes them.
+    """
+    def __init__(self, terrains):
+        self.terrains = list(terrains)
+        
+        terrain_codes = np.array([maps.TERRAINS.code(terrain)
+                                  for terrain in self.terrains],
+                                 dtype=np.int64)
+        
+        #Every 4-tuple of terrain indices, last section changing fastest
+        num = len(self.terrains)
+        combs = np.indices((num,) * 4).reshape(4, -1).T
+        
+        self.codes = terrain_codes[combs]
+        self.packed = pack_code_arrays(self.codes)
+        
+        self.segment_starts, self.segment_sizes\
+            = get_segment_arrays(self.codes)
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    def get_tiles(self):
+        return [maps.Tile.from_packed(packed)
+                for packed in self.packed.tolist()]
 
 def get_all_tiles(terrains):
     """
@@ -145,6 +264,46 @@ def get_weights(tiles, terrains, segment_weights, terrain_weights):
     
     return weights
 
+#sampler_cache makes samplers again when the code of get_weight_array
+#changes. Change this as well if the weights change some other way,
+#like through a function it calls
+WEIGHTS_VERSION = 1
+
+def get_weight_array(catalogue, segment_weights, terrain_weights):
+    """
+    Return the weights for every tile in a TileCatalogue,
+    the same as get_weights gives.
+    
+    Rather than going over the tiles once per terrain, this gathers all
+    the weights into tables indexed by terrain code,
+    so each section and segment takes one lookup.
+    """
+    num_codes = maps.TERRAIN_MASK + 1
+    
+    #The factor for each section, and for each segment by size
+    section_factors = np.ones(num_codes)
+    segment_factors = np.tile(np.asarray(segment_weights.segment_weights,
+                                         dtype=float),
+                              (num_codes, 1))
+    
+    for _, terrain_weight in terrain_weights.items():
+        code = maps.TERRAINS.code(terrain_weight.terrain)
+        
+        section_factors[code] *= terrain_weight.weight
+        
+        if terrain_weight.segment_weights is not None:
+            segment_factors[code] *= terrain_weight.segment_weights
+    
+    weights = section_factors[catalogue.codes].prod(axis=1)
+    
+    factors = np.where(catalogue.segment_starts,
+                       segment_factors[catalogue.codes,
+                                       catalogue.segment_sizes - 1],
+                       1.0)
+    weights *= factors.prod(axis=1)
+    
+    return weights
+
 def wrap_dict(d):
     """
     Return a wrapper function for the given dictionary.
@@ -206,6 +365,81 @@ def get_counts_from_weights(weights, target_total_count):
     
     return counts
 
+def get_match_mask(packed):
+    """
+    Return the mask keeping the sections of a packed description
+    that aren't wildcards.
+    """
+    mask = 0
+    for direction in maps.DIRECTIONS:
+        section_mask = maps.TERRAIN_MASK << maps.SECTION_SHIFTS[direction]
+        if packed & section_mask:
+            mask |= section_mask
+    
+    return mask
+
+class MatchTables:
+    """
+    Tables for drawing a weighted tile matching a description,
+    a tile with None for the sections that can be anything.
+    
+    For each set of mentioned sections, the tiles are sorted by those
+    sections, so the tiles matching a description are one run of the
+    table. Cumulative weights let a tile in the run be picked by bisection.
+    The table for a set of sections is made the first time it's needed.
+    """
+    def __init__(self, packed, weights):
+        self.packed = np.asarray(packed, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=float)
+        self.tables_from_masks = dict()
+    
+    def get_table(self, mask):
+        """
+        Return the sorted keys, packed tiles and cumulative weights
+        for the given mask, as lists.
+        """
+        table = self.tables_from_masks.get(mask)
+        if table is not None:
+            return table
+        
+        keys = self.packed & mask
+        order = np.argsort(keys, kind='stable')
+        
+        #cumulative[i] is the total weight of the tiles before tile i,
+        #so the tiles from start to end weigh
+        #cumulative[end] - cumulative[start]
+        cumulative = np.zeros(len(order) + 1)
+        np.cumsum(self.weights[order], out=cumulative[1:])
+        
+        table = (keys[order].tolist(),
+                 self.packed[order].tolist(),
+                 cumulative.tolist())
+        self.tables_from_masks[mask] = table
+        
+        return table
+    
+    def sample(self, desc):
+        """
+        Return a random tile matching desc, or None if no tile with any
+        weight does.
+        """
+        keys, packed, cumulative = self.get_table(get_match_mask(desc.packed))
+        
+        start = bisect_left(keys, desc.packed)
+        end = bisect_right(keys, desc.packed, start)
+        
+        low = cumulative[start]
+        high = cumulative[end]
+        if not high > low:
+            return None
+        
+        #Find the tile whose stretch of weight the target is in,
+        #which skips over tiles with no weight
+        target = low + random.random() * (high - low)
+        i = bisect_right(cumulative, target, start + 1, end) - 1
+        
+        return maps.Tile.from_packed(packed[i])
+
 class TileSampler:
     """
     A class to sample tiles randomly from a given distribution
@@ -213,6 +447,8 @@ class TileSampler:
     def __init__(self, tiles, count_func):
         self.total_count = 0
         self.tiles_from_nums = dict()
+        self.counts_from_tiles = dict()
+        self.match_tables = None
         
         #Set which numbers go to which tiles
         for tile in tiles:
@@ -222,12 +458,209 @@ class TileSampler:
                 self.tiles_from_nums[num] = tile
                 
             self.total_count += count
+            self.counts_from_tiles[tile] = count
     
     def random_tile(self):
         """
         Select a random tile.
         """
         return self.tiles_from_nums[randint(0, self.total_count-1)]
+    
+    def random_tiles(self, num):
+        """
+        Select num random tiles.
+        """
+        return [self.random_tile() for _ in range(num)]
+    
+    def random_packed(self, num):
+        """
+        Return num random tiles in packed form.
+        """
+        return np.array([tile.packed for tile in self.random_tiles(num)],
+                        dtype=np.int64)
+    
+    def sample_matching(self, desc):
+        """
+        Select a random tile matching desc, a tile with None for the
+        sections that can be anything. Returns None if no tile matches.
+        """
+        if self.match_tables is None:
+            tiles = list(self.counts_from_tiles)
+            self.match_tables = MatchTables([tile.packed for tile in tiles],
+                                            [self.counts_from_tiles[tile]
+                                             for tile in tiles])
+        
+        return self.match_tables.sample(desc)
+
+def get_numpy_rng():
+    """
+    Return a numpy generator seeded from the random module,
+    so random.seed also fixes batch draws.
+    """
+    return np.random.default_rng(random.getrandbits(64))
+
+def get_alias_tables(weights):
+    """
+    Return the probability and alias tables for the given weights,
+    using the alias method.
+    
+    Outcome i is drawn by picking a column j uniformly, then taking j
+    with probability probs[j] and aliases[j] otherwise.
+    """
+    num = len(weights)
+    scaled = np.asarray(weights, dtype=float) * (num / np.sum(weights))
+    
+    probs = np.ones(num)
+    aliases = np.arange(num)
+    
+    small = np.flatnonzero(scaled < 1)
+    large = np.flatnonzero(scaled >= 1)
+    
+    if not len(small) or not len(large):
+        return probs, aliases
+    
+    #This gives the same kind of tables as Vose's method, without a loop.
+    #Lay the shortfalls of the small columns end to end, and the excesses
+    #of the large columns end to end. Each small column is topped up by
+    #the large column whose stretch of excess its shortfall starts in.
+    shortfalls = 1 - scaled[small]
+    shortfall_ends = np.cumsum(shortfalls)
+    shortfall_starts = shortfall_ends - shortfalls
+    excess_ends = np.cumsum(scaled[large] - 1)
+    
+    donors = np.searchsorted(excess_ends, shortfall_starts, side='right')
+    donors = np.minimum(donors, len(large) - 1)
+    
+    probs[small] = scaled[small]
+    aliases[small] = large[donors]
+    
+    #A large column whose excess runs out partway through a shortfall
+    #gives away that much more than its excess,
+    #so the next large column tops it up by the difference
+    straddling = np.searchsorted(shortfall_starts, excess_ends) - 1
+    overshoots = np.where(straddling >= 0,
+                          shortfall_ends[straddling] - excess_ends,
+                          0)
+    
+    #The last large column ends with the last shortfall,
+    #up to rounding error
+    overshoots[-1] = 0
+    topped_up = np.flatnonzero(overshoots > 0)
+    
+    probs[large[topped_up]] = 1 - overshoots[topped_up]
+    aliases[large[topped_up]] = large[topped_up + 1]
+    
+    return probs, aliases
+
+class AliasTileSampler:
+    """
+    A class to sample tiles randomly from real-valued weights,
+    in constant time per tile.
+    """
+    def __init__(self, tiles, weight_func):
+        tiles = list(tiles)
+        
+        packed = np.array([tile.packed for tile in tiles], dtype=np.int64)
+        weights = np.array([weight_func(tile) for tile in tiles],
+                           dtype=float)
+        
+        self.set_tables(packed, weights)
+    
+    @classmethod
+    def from_arrays(cls, packed, weights, probs=None, aliases=None):
+        """
+        Return a sampler for the given packed tiles and their weights.
+        The alias tables are made from the weights if they aren't given.
+        """
+        sampler = cls.__new__(cls)
+        sampler.set_tables(np.asarray(packed, dtype=np.int64),
+                           np.asarray(weights, dtype=float),
+                           probs,
+                           aliases)
+        
+        return sampler
+    
+    def set_tables(self, packed, weights, probs=None, aliases=None):
+        if not len(packed):
+            raise ValueError('no tiles')
+        
+        if np.any(weights < 0) or not np.sum(weights) > 0:
+            raise ValueError('bad weights: {}'.format(weights))
+        
+        self.packed = packed
+        self.weights = weights
+        self._tiles = None
+        self.match_tables = None
+        
+        if probs is None or aliases is None:
+            probs, aliases = get_alias_tables(self.weights)
+        
+        self.probs = np.asarray(probs, dtype=float)
+        self.aliases = np.asarray(aliases, dtype=np.int64)
+        
+        #For drawing one tile at a time without going through numpy,
+        #made on the first draw
+        self.packed_list = None
+        self.probs_list = None
+        self.aliases_list = None
+    
+    @property
+    def tiles(self):
+        #Only make the Tile objects if they're asked for
+        if self._tiles is None:
+            self._tiles = [maps.Tile.from_packed(packed)
+                           for packed in self.packed.tolist()]
+        
+        return self._tiles
+    
+    def random_tile(self):
+        """
+        Select a random tile.
+        """
+        if self.packed_list is None:
+            self.packed_list = self.packed.tolist()
+            self.probs_list = self.probs.tolist()
+            self.aliases_list = self.aliases.tolist()
+        
+        i = randint(0, len(self.packed_list) - 1)
+        if random.random() >= self.probs_list[i]:
+            i = self.aliases_list[i]
+        
+        return maps.Tile.from_packed(self.packed_list[i])
+    
+    def random_indices(self, num):
+        """
+        Return the indices in self.packed of num random tiles.
+        """
+        rng = get_numpy_rng()
+        
+        indices = rng.integers(0, len(self.packed), size=num)
+        use_alias = rng.random(num) >= self.probs[indices]
+        
+        return np.where(use_alias, self.aliases[indices], indices)
+    
+    def random_tiles(self, num):
+        """
+        Select num random tiles.
+        """
+        return [maps.Tile.from_packed(packed)
+                for packed in self.random_packed(num).tolist()]
+    
+    def random_packed(self, num):
+        """
+        Return num random tiles in packed form.
+        """
+        return self.packed[self.random_indices(num)]
+    
+    def sample_matching(self, desc):
+        """
+        Select a random tile matching desc, a tile with None for the
+        sections that can be anything. Returns None if no tile matches.
+        """
+        if self.match_tables is None:
+            self.match_tables = MatchTables(self.packed, self.weights)
+        
+        return self.match_tables.sample(desc)
 
 def get_uniform_sampler(tiles):
     count_func = lambda x: 1 if x in tiles else 0
@@ -240,24 +673,25 @@ class OneTileSampler:
     
     def random_tile(self):
         return self.tile.copy()
+    
+    def random_tiles(self, num):
+        return [self.tile] * num
+    
+    def random_packed(self, num):
+        return np.full(num, self.tile.packed, dtype=np.int64)
+    
+    def sample_matching(self, desc):
+        if (self.tile.packed & get_match_mask(desc.packed)) != desc.packed:
+            return None
+        
+        return self.tile
 
 def get_weighted_sampler(segment_weights, terrain_weights):
     #Get the terrain types and all the tiles
-    terrain_types = set(terrain_weights)
-    tiles = get_all_tiles(terrain_types)
+    catalogue = TileCatalogue(terrain_weights)
     
     #Get the tile weights
-    weights = get_weights(tiles,
-                          terrain_types,
-                          segment_weights,
-                          terrain_weights)
-    
-    total_count = get_target_total_counts(weights, 1000)
-    counts = get_counts_from_weights(weights, total_count)
-    
-    # for tile, count in counts.items():
-    #     print('{}: {} times'.format(tile, count))
-    
-    count_func = wrap_dict(counts)
+    weights = get_weight_array(catalogue, segment_weights, terrain_weights)
     
-    return TileSampler(tiles, count_func)
\ No newline at end of file
+    #Sample from the weights themselves, rather than rounded counts
+    return AliasTileSampler.from_arrays(catalogue.packed, weights)
\ No newline at end of file
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 31 10:12:44 2021
+
+@author: rober
+"""
+
+import numpy as np
+
+import maps
+
+#The direction for each unit displacement
+DIRECTIONS_FROM_DISPS = {(disp.x, disp.y): direction
+                         for direction, disp in maps.ADJ_DISPS.items()}
+
+class Topology:
+    """
+    A finite board, with its cells numbered from 0 to num_cells - 1
+    and a precomputed table of the neighbours of every cell.
+    
+    neighbours[i, d] is the index of the cell next to cell i in
+    direction maps.DIRECTIONS[d], or off_board if there's none.
+    off_board is num_cells, so arrays indexed by cell can have one extra
+    slot at the end standing in for everything off the board.
+    
+    A topology can be used as the disp_function of a map.
+    
+    description is a dict saying how to make the topology again,
+    for saving it with a map.
+    """
+    def __init__(self, xs, ys, base_disp_function, description=None):
+        self.xs = np.asarray(xs, dtype=np.int64)
+        self.ys = np.asarray(ys, dtype=np.int64)
+        self.base_disp_function = base_disp_function
+        self.description = description
+        
+        self.num_cells = len(self.xs)
+        self.off_board = self.num_cells
+        
+        keys = maps.coord_key(self.xs, self.ys)
+        self.order = np.argsort(keys)
+        self.sorted_keys = keys[self.order]
+        
+        if np.any(np.diff(self.sorted_keys) == 0):
+            raise ValueError('repeated coordinates')
+        
+        self.coords_list = [maps.CoordPair(x, y) for x, y
+                            in zip(self.xs.tolist(), self.ys.tolist())]
+        self.indices_from_coords = {coords: i for i, coords
+                                    in enumerate(self.coords_list)}
+        
+        #Get the neighbour table
+        self.neighbours = np.zeros((self.num_cells, 4), dtype=np.int64)
+        for direction in maps.DIRECTIONS:
+            adj_xs, adj_ys, valid = maps.disp_arrays(self.xs, self.ys,
+                                                     maps.ADJ_DISPS[direction],
+                                                     base_disp_function)
+            
+            adj = self.indices(adj_xs, adj_ys)
+            adj[~valid] = self.off_board
+            
+            self.neighbours[:, maps.SECTION_INDICES[direction]] = adj
+        
+        #For looking up one cell at a time without going through numpy
+        self.neighbour_lists = self.neighbours.tolist()
+    
+    def indices(self, xs, ys):
+        """
+        Return the cell indices of the given coordinate arrays,
+        with off_board for coordinates not on the board.
+        """
+        keys = maps.coord_key(np.asarray(xs, dtype=np.int64),
+                              np.asarray(ys, dtype=np.int64))
+        
+        pos = np.searchsorted(self.sorted_keys, keys)
+        pos = np.minimum(pos, self.num_cells - 1)
+        
+        found = self.sorted_keys[pos] == keys
+        
+        return np.where(found, self.order[pos], self.off_board)
+    
+    def neighbours_of(self, indices):
+        """
+        Return the (n, 4) array of the neighbours of the given cells.
+        """
+        return self.neighbours[indices]
+    
+    def index(self, coords):
+        return self.indices_from_coords.get(coords, self.off_board)
+    
+    def on_board(self, coords):
+        return coords in self.indices_from_coords
+    
+    def in_direction(self, coords, direction):
+        """
+        Return the coords next to the given ones in the given direction,
+        or None if they're off the board.
+        """
+        return self(coords, maps.ADJ_DISPS[direction])
+    
+    def __call__(self, coords, disp):
+        """
+        Displace the coords by disp, like a displacement function.
+        """
+        direction = DIRECTIONS_FROM_DISPS.get((disp.x, disp.y))
+        i = self.indices_from_coords.get(coords)
+        
+        #Fall back on the displacement function for anything not
+        #in the neighbour table
+        if direction is None or i is None:
+            new_coords = self.base_disp_function(coords, disp)
+            
+            if not new_coords in self.indices_from_coords:
+                return None
+            
+            return new_coords
+        
+        adj = self.neighbour_lists[i][maps.SECTION_INDICES[direction]]
+        if adj == self.off_board:
+            return None
+        
+        return self.coords_list[adj]
+    
+    def needed_tiles(self, packed):
+        """
+        Return the packed tile that matches all the neighbours of each
+        cell, with the wildcard on sides with no neighbour.
+        
+        packed is the packed tile of every cell, with one extra slot at
+        the end for off the board, which should be 0.
+        """
+        return get_needed_tiles(packed, self.neighbours)
+    
+    def disp_arrays(self, xs, ys, disp):
+        """
+        Displace whole arrays of coordinates, like maps.disp_arrays.
+        """
+        direction = DIRECTIONS_FROM_DISPS.get((disp.x, disp.y))
+        
+        if direction is None:
+            new_xs, new_ys, valid = maps.disp_arrays(xs, ys, disp,
+                                                     self.base_disp_function)
+            adj = self.indices(new_xs, new_ys)
+            adj[~valid] = self.off_board
+        else:
+            adj = self.indices(xs, ys)
+            on_board = adj != self.off_board
+            
+            adj[on_board] = self.neighbours[adj[on_board],
+                                            maps.SECTION_INDICES[direction]]
+        
+        valid = adj != self.off_board
+        
+        #Off-board coordinates get the coordinates of cell 0,
+        #so they're still in range
+        adj = np.where(valid, adj, 0)
+        
+        return self.xs[adj], self.ys[adj], valid
+
+def get_needed_tiles(packed, neighbours):
+    """
+    Return the packed tile that matches all the neighbours of some
+    cells, given their rows of a neighbour table, as in
+    Topology.needed_tiles.
+    """
+    packed = np.asarray(packed, dtype=np.int64)
+    needed = np.zeros(len(neighbours), dtype=np.int64)
+    
+    for direction in maps.DIRECTIONS:
+        adj = packed[neighbours[:, maps.SECTION_INDICES[direction]]]
+        codes = maps.get_section_codes(adj, maps.OPPOSITES[direction])
+        needed |= codes << maps.SECTION_SHIFTS[direction]
+    
+    return needed
+
+def get_mismatched_cells(tiles, packed, neighbours):
+    """
+    Return a mask of which of some cells, with the packed tiles tiles
+    and the given rows of a neighbour table, have a side that doesn't
+    match the neighbour there.
+    Sides off the board match anything.
+    """
+    tiles = np.asarray(tiles, dtype=np.int64)
+    needed = get_needed_tiles(packed, neighbours)
+    
+    mismatched = np.zeros(len(tiles), dtype=bool)
+    for direction in maps.DIRECTIONS:
+        codes = maps.get_section_codes(tiles, direction)
+        needed_codes = maps.get_section_codes(needed, direction)
+        
+        mismatched |= (needed_codes != maps.WILDCARD)\
+                      & (codes != needed_codes)
+    
+    return mismatched
+
+def get_torus_topology(width, height):
+    """
+    Return the topology of a width by height torus.
+    """
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+    
+    return Topology(xs.ravel(), ys.ravel(),
+                    maps.get_torus_disp(width, height),
+                    {'type': 'torus', 'width': width, 'height': height})
+
+def get_rectangle_topology(width, height, min_x=0, min_y=0):
+    """
+    Return the topology of a bounded width by height rectangle.
+    """
+    xs, ys = np.meshgrid(np.arange(min_x, min_x + width),
+                         np.arange(min_y, min_y + height),
+                         indexing='ij')
+    
+    description = {'type': 'rectangle',
+                   'width': width,
+                   'height': height,
+                   'min_x': min_x,
+                   'min_y': min_y}
+    
+    return Topology(xs.ravel(), ys.ravel(), maps.boundless_disp, description)
+
+def get_diamond_coords(half_diag):
+    """
+    Return the x and y arrays of the diamond used by the swap builders,
+    from (0, 0) to (2 * half_diag, 0).
+    """
+    xs = list()
+    ys = list()
+    
+    for x in range(half_diag * 2 + 1):
+        half_y = half_diag - abs(x - half_diag)
+        
+        for y in range(-half_y, half_y + 1):
+            xs.append(x)
+            ys.append(y)
+    
+    return np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64)
+
+def get_diamond_topology(half_diag):
+    """
+    Return the topology of a diamond, as made by get_diamond_coords.
+    """
+    xs, ys = get_diamond_coords(half_diag)
+    
+    return Topology(xs, ys, maps.boundless_disp,
+                    {'type': 'diamond', 'half_diag': half_diag})
+
+def get_topology(description):
+    """
+    Return the topology with the given description.
+    """
+    if description['type'] == 'torus':
+        return get_torus_topology(description['width'],
+                                  description['height'])
+    
+    if description['type'] == 'rectangle':
+        return get_rectangle_topology(description['width'],
+                                      description['height'],
+                                      description['min_x'],
+                                      description['min_y'])
+    
+    if description['type'] == 'diamond':
+        return get_diamond_topology(description['half_diag'])
+    
+    raise ValueError('unknown topology: {}'.format(description))
\ No newline at end of file